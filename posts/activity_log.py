@@ -0,0 +1,195 @@
+"""
+Буферизированная запись журнала активности пользователей (`usersActivity.log`).
+
+Запрос только кладет запись в ограниченную очередь процесса.
+Фоновый поток забирает записи пачками и дописывает их в файл одной операцией записи:
+по размеру пачки или по таймауту. Ротация файлов выполняется под файловой блокировкой,
+поэтому несколько воркеров gunicorn могут писать в один журнал.
+
+Если очередь переполнена, запись отбрасывается (запрос не ждет диск),
+а количество отброшенных записей попадает в журнал отдельной строкой.
+"""
+import atexit
+import gzip
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+DEFAULTS = {
+    "PATH": "usersActivity.log",
+    "QUEUE_SIZE": 10000,
+    "BATCH_SIZE": 500,
+    "FLUSH_INTERVAL": 1.0,  # Секунды.
+    "MAX_BYTES": 50 * 1024 * 1024,
+    "BACKUP_COUNT": 10,
+    "COMPRESS": True,  # Сжимать ротированные файлы в gzip.
+}
+
+
+def get_config() -> dict:
+    return {**DEFAULTS, **getattr(settings, "ACTIVITY_LOG", {})}
+
+
+class ActivityLogWriter:
+    def __init__(self, path, queue_size: int, batch_size: int, flush_interval: float,
+                 max_bytes: int, backup_count: int, compress: bool):
+        self.path = Path(path)
+        self.lock_path = self.path.with_name(self.path.name + ".lock")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls) -> "ActivityLogWriter":
+        config = get_config()
+        return cls(
+            path=config["PATH"],
+            queue_size=config["QUEUE_SIZE"],
+            batch_size=config["BATCH_SIZE"],
+            flush_interval=config["FLUSH_INTERVAL"],
+            max_bytes=config["MAX_BYTES"],
+            backup_count=config["BACKUP_COUNT"],
+            compress=config["COMPRESS"],
+        )
+
+    def log(self, record: dict) -> None:
+        """Положить запись в очередь. Никогда не блокирует запрос."""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self._dropped += 1
+
+    def flush(self) -> None:
+        """Синхронно записать все, что накопилось в очереди."""
+        while True:
+            batch = self._drain(self.batch_size)
+            if not batch:
+                break
+            self._write(batch)
+
+    def _ensure_started(self) -> None:
+        # После `fork` (gunicorn --preload) поток родителя в дочернем процессе не существует.
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="activity-log-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            batch.extend(self._drain(self.batch_size - len(batch)))
+            if batch or self._dropped:
+                try:
+                    self._write(batch)
+                except OSError:
+                    # Журнал не должен ронять воркер. Записи этой пачки теряются.
+                    pass
+
+    def _drain(self, limit: int) -> list:
+        batch = []
+        while len(batch) < limit:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _take_dropped(self) -> int:
+        with self._dropped_lock:
+            dropped, self._dropped = self._dropped, 0
+        return dropped
+
+    def _write(self, batch: list) -> None:
+        dropped = self._take_dropped()
+        if dropped:
+            batch.append({"ts": time.time(), "event": "dropped", "count": dropped})
+        data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in batch).encode("utf-8")
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_path, "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._rotate_if_needed(len(data))
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, data)
+                finally:
+                    os.close(fd)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _rotate_if_needed(self, incoming: int) -> None:
+        if not self.max_bytes or not self.backup_count:
+            return
+        try:
+            size = self.path.stat().st_size
+        except FileNotFoundError:
+            return
+        if size + incoming <= self.max_bytes:
+            return
+
+        suffix = ".gz" if self.compress else ""
+        # usersActivity.log.1 -> usersActivity.log.2 и т.д.
+        for index in range(self.backup_count - 1, 0, -1):
+            source = self.path.with_name(f"{self.path.name}.{index}{suffix}")
+            if source.exists():
+                source.replace(self.path.with_name(f"{self.path.name}.{index + 1}{suffix}"))
+
+        rotated = self.path.with_name(f"{self.path.name}.1")
+        self.path.replace(rotated)
+        if self.compress:
+            with open(rotated, "rb") as source, gzip.open(f"{rotated}.gz", "wb") as target:
+                shutil.copyfileobj(source, target)
+            rotated.unlink()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer() -> ActivityLogWriter:
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = ActivityLogWriter.from_settings()
+                atexit.register(_writer.flush)
+    return _writer
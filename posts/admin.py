@@ -1,14 +1,19 @@
 from django.contrib import admin
 from django.db.models import QuerySet, F
-from django.db.models.functions import Upper
-from .models import Note, User, Tag
+from django.db.models.functions import Coalesce, Substr, Upper
+from .models import Note, User, Tag, OutboxEmail, ImageVariantTask
+from .api.authentication import invalidate_user
+from .fragment_cache import invalidate_note_cards
+from .images import get_variant_urls
+from .large_admin import LargeTableAdminMixin, get_config as get_large_tables_config
+from .search import get_search_backend, search_notes
+from django.utils import timezone
 from django.utils.safestring import mark_safe
-from django.db.models import Count
 
 
 @admin.register(Note)
-class NoteAdmin(admin.ModelAdmin):
-    list_display = ["image", 'title', 'content', 'created_at', 'mod_time', 'user']
+class NoteAdmin(LargeTableAdminMixin, admin.ModelAdmin):
+    list_display = ["image", 'title', 'content_excerpt', 'created_at', 'mod_time', 'user', 'tags_function']
     search_fields = ['title', 'content']
     date_hierarchy = "created_at"
     # Действия
@@ -24,12 +29,37 @@ class NoteAdmin(admin.ModelAdmin):
         ("content", {"fields": ("content",)})
     )
 
-    # def get_queryset(self, request):
-    #     return (
-    #         Note.objects.all()
-    #         .select_related("user")  # Вытягивание связанных данных из таблицы User в один запрос
-    #         .prefetch_related("tags")  # Вытягивание связанных данных из таблицы Tag в отдельные запросы
-    #     )
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        if not self._is_changelist(request):
+            # Форма изменения читает заметку целиком, связи и выдержка ей не нужны.
+            return queryset
+        return (
+            queryset
+            .select_related("user")  # Вытягивание связанных данных из таблицы User в один запрос
+            .prefetch_related("tags")  # Вытягивание связанных данных из таблицы Tag в отдельные запросы
+            # Полный текст заметки для списка не нужен, начало текста обрезается в базе.
+            .defer("content", "search_vector")
+            .annotate(_content_excerpt=Substr("content", 1, 100))
+        )
+
+    def _is_changelist(self, request) -> bool:
+        match = request.resolver_match
+        opts = self.model._meta
+        return match is not None and match.url_name == f"{opts.app_label}_{opts.model_name}_changelist"
+
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term or not get_large_tables_config()["ENABLED"]:
+            return super().get_search_results(request, queryset, search_term)
+        # Поиск по индексу (GIN / FTS5) вместо `icontains` по всей таблице.
+        # Список упорядочен не по рангу, поэтому ранг и фрагменты с подсветкой не вычисляем.
+        return search_notes(queryset, search_term, annotate=False), False
+
+    def save_model(self, request, obj: Note, form, change):
+        if change:
+            # Время изменения - версия заметки для ETag / Last-Modified.
+            obj.mod_time = timezone.now()
+        super().save_model(request, obj, form, change)
 
     @admin.action(description='Confirm')
     def confirm_note(self, request, queryset):
@@ -37,19 +67,29 @@ class NoteAdmin(admin.ModelAdmin):
 
     @admin.action(description="Upper Title")
     def title_up(self, form, queryset: QuerySet[Note]):
-        queryset.update(title=Upper(F("title")))
+        now = timezone.now()
+        queryset.update(title=Upper(F("title")), mod_time=now, changed_at=now)
+        # `update` не вызывает сигнал `post_save`, поэтому обновляем поисковый индекс и кэш карточек явно.
+        get_search_backend().reindex(queryset)
+        invalidate_note_cards(queryset.values_list("uuid", flat=True))
 
     @admin.display()
     def short_content(self, obj: Note) -> str:
         return obj.content[:50] + "..."
 
+    @admin.display(description="Content")
+    def content_excerpt(self, obj: Note) -> str:
+        return obj._content_excerpt
+
     @admin.display(description="IMG")
     def preview_image(self, obj: Note) -> str:
         if obj.image:
-            return mark_safe(f'<img src="{obj.image.url}" height="64" />')
+            variants = get_variant_urls(obj)
+            url = variants["thumbnail"] if variants else obj.image.url
+            return mark_safe(f'<img src="{url}" height="64" />')
         return "X"
 
-    @admin.display()
+    @admin.display(description="Теги")
     def tags_function(self, obj: Note) -> str:
         tags = list(obj.tags.all())
         text = ""
@@ -59,14 +99,18 @@ class NoteAdmin(admin.ModelAdmin):
 
 
 @admin.register(User)
-class UserAdmin(admin.ModelAdmin):
+class UserAdmin(LargeTableAdminMixin, admin.ModelAdmin):
     list_display = ["is_active", 'username', 'first_name', 'last_name', 'note_count']
     search_fields = ['username', 'first_name']
     actions = ["is_active_switch"]
 
     @admin.action(description='is_active_switch')
     def is_active_switch(self, request, queryset):
-        queryset.update(is_active=True)
+        # `update` не вызывает `post_save`: записи кэша аутентификации удаляются явно.
+        user_ids = list(queryset.values_list("pk", flat=True))
+        User.objects.filter(pk__in=user_ids).update(is_active=True)
+        for user_id in user_ids:
+            invalidate_user(user_id)
 
     fieldsets = (
         # 1  tuple(None, dict)
@@ -93,11 +137,46 @@ class UserAdmin(admin.ModelAdmin):
         ("Важные даты", {"fields": ("last_login", "date_joined")}),
     )
 
-    @admin.display(description='Кол-во заметок')
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term or not get_large_tables_config()["ENABLED"]:
+            return super().get_search_results(request, queryset, search_term)
+        # `LIKE 'term%'` по имени пользователя использует индекс `users_username_..._like`.
+        return queryset.filter(username__startswith=search_term.strip()), False
+
+    def get_queryset(self, request):
+        # Готовый счетчик из `UserNoteCounter` (см. `posts/counters.py`) вместо COUNT на каждую строку.
+        return super().get_queryset(request).annotate(_note_count=Coalesce("note_counter__note_count", 0))
+
+    @admin.display(description='Кол-во заметок', ordering="_note_count")
     def note_count(self, obj):
-        return obj.note_set.count()
+        return obj._note_count
 
 
 @admin.register(Tag)
 class TagAdmin(admin.ModelAdmin):
     list_display = ["name"]
+
+
+@admin.register(OutboxEmail)
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = ["subject", "to", "status", "attempts", "next_attempt_at", "created_at", "sent_at"]
+    list_filter = ["status"]
+    readonly_fields = ["last_error"]
+    actions = ["retry"]
+
+    @admin.action(description="Отправить повторно")
+    def retry(self, request, queryset):
+        queryset.exclude(status=OutboxEmail.Status.SENT).update(
+            status=OutboxEmail.Status.PENDING, attempts=0, next_attempt_at=timezone.now()
+        )
+
+
+@admin.register(ImageVariantTask)
+class ImageVariantTaskAdmin(admin.ModelAdmin):
+    list_display = ["note", "attempts", "next_attempt_at", "created_at"]
+    readonly_fields = ["note", "last_error"]
+    actions = ["retry"]
+
+    @admin.action(description="Повторить")
+    def retry(self, request, queryset):
+        queryset.update(attempts=0, last_error="", next_attempt_at=timezone.now())
@@ -0,0 +1,181 @@
+"""
+Аутентификация API с кэшем в памяти процесса.
+
+* `CachedJWTAuthentication` - пользователь по `jti` access токена, без запроса к таблице `users`
+  на каждый запрос. В режиме `API_AUTH_CACHE["STATELESS"]` пользователь - `StatelessUser` из claims
+  токена, база не используется совсем. Его нельзя сохранить (`save()` бросает исключение), поэтому
+  view должны использовать только `request.user.pk`;
+* `CachedBasicAuthentication` - результат проверки логина и пароля по HMAC от учетных данных,
+  PBKDF2 считается только при первом запросе.
+
+Запись живет не дольше токена и не дольше `API_AUTH_CACHE["TTL"]` секунд.
+При сохранении или удалении пользователя (смена пароля, деактивация) его записи
+удаляются сигналом (`posts/models.py`). Другим процессам сигнал сообщает через общий кэш Django:
+ключ `auth-generation:<id>` получает новое значение, и запись процесса, сохраненная
+при другом значении, считается промахом. Нужен общий кэш (Redis); с `LocMemCache`
+каждый процесс видит только свои изменения.
+"""
+import copy
+import hashlib
+import hmac
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.utils.functional import cached_property
+from rest_framework.authentication import BasicAuthentication
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+
+DEFAULTS = {
+    "ENABLED": True,
+    "TTL": 60,
+    "MAX_ENTRIES": 10000,
+    "STATELESS": False,
+}
+
+
+def get_config() -> dict:
+    return {**DEFAULTS, **getattr(settings, "API_AUTH_CACHE", {})}
+
+
+def generation_key(user_pk) -> str:
+    return f"auth-generation:{user_pk}"
+
+
+def current_generation(user_pk) -> str:
+    # Пока пользователя не меняли, ключа нет: поколение - пустая строка.
+    return cache.get(generation_key(user_pk), "")
+
+
+class AuthCache:
+    """
+    LRU кэш `ключ -> (пользователь, время истечения, поколение)` с удалением всех записей
+    пользователя. Поколение - значение `generation_key` в общем кэше на момент записи.
+    """
+
+    def __init__(self):
+        self._entries: "OrderedDict[str, tuple[object, float, str]]" = OrderedDict()
+        self._keys_by_user: dict[object, set[str]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            user, expires_at, generation = entry
+            if expires_at <= time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+        # Пользователя изменили в другом процессе.
+        if current_generation(user.pk) != generation:
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    self._remove(key)
+            return None
+        # Копия - чтобы запросы в разных потоках не делили один объект.
+        return copy.copy(user)
+
+    def set(self, key: str, user, expires_at: float, generation=None) -> None:
+        """`generation` лучше прочитать (`current_generation`) до загрузки пользователя из базы:
+        тогда изменение между загрузкой и записью тоже сделает запись устаревшей."""
+        config = get_config()
+        expires_at = min(expires_at, time.time() + config["TTL"])
+        if generation is None:
+            generation = current_generation(user.pk)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (copy.copy(user), expires_at, generation)
+            self._keys_by_user.setdefault(user.pk, set()).add(key)
+            while len(self._entries) > config["MAX_ENTRIES"]:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_user(self, user_pk) -> None:
+        with self._lock:
+            for key in list(self._keys_by_user.get(user_pk, ())):
+                self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_user.clear()
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        keys = self._keys_by_user.get(entry[0].pk)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_user[entry[0].pk]
+
+
+auth_cache = AuthCache()
+
+
+class StatelessUser(TokenUser):
+    """`TokenUser` с первичным ключом типа модели: simplejwt кладет id в токен строкой."""
+
+    @cached_property
+    def id(self):
+        return get_user_model()._meta.pk.to_python(self.token[jwt_settings.USER_ID_CLAIM])
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+
+    def get_user(self, validated_token):
+        config = get_config()
+        if config["STATELESS"]:
+            return self.get_stateless_user(validated_token)
+        if not config["ENABLED"]:
+            return super().get_user(validated_token)
+
+        key = f"jwt:{validated_token.get(jwt_settings.JTI_CLAIM)}"
+        user = auth_cache.get(key)
+        if user is None:
+            generation = current_generation(validated_token.get(jwt_settings.USER_ID_CLAIM))
+            user = super().get_user(validated_token)
+            auth_cache.set(key, user, validated_token["exp"], generation)
+        return user
+
+    def get_stateless_user(self, validated_token):
+        """Пользователь из claims токена без запроса к базе (есть только первичный ключ).
+
+        Не экземпляр `User`: собранный из токена объект с пустыми полями нельзя сохранить
+        поверх настоящей строки (например, через `PATCH /api/auth/users/me/`).
+        """
+        if jwt_settings.USER_ID_CLAIM not in validated_token:
+            raise InvalidToken("Token contained no recognizable user identification")
+        return StatelessUser(validated_token)
+
+
+class CachedBasicAuthentication(BasicAuthentication):
+
+    def authenticate_credentials(self, userid, password, request=None):
+        if not get_config()["ENABLED"]:
+            return super().authenticate_credentials(userid, password, request)
+
+        # Пароль не хранится в памяти в открытом виде.
+        digest = hmac.new(settings.SECRET_KEY.encode(), f"{userid}\0{password}".encode(), hashlib.sha256)
+        key = f"basic:{digest.hexdigest()}"
+        user = auth_cache.get(key)
+        if user is None:
+            user, _ = super().authenticate_credentials(userid, password, request)
+            auth_cache.set(key, user, time.time() + get_config()["TTL"])
+        return user, None
+
+
+def invalidate_user(user_pk) -> None:
+    auth_cache.invalidate_user(user_pk)
+    # Записи живут не дольше `TTL`: после этого старое поколение уже не встретится.
+    cache.set(generation_key(user_pk), uuid.uuid4().hex, timeout=get_config()["TTL"] + 1)
@@ -0,0 +1,100 @@
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from posts.conditional import get_note_version, make_etag
+
+
+def set_validators(response, etag: str, last_modified) -> None:
+    response["ETag"] = etag
+    if last_modified is not None:
+        response["Last-Modified"] = http_date(last_modified.timestamp())
+
+
+def note_etag(note) -> str:
+    return make_etag(note.uuid, note.version.isoformat())
+
+
+class ConditionalNoteMixin:
+    """
+    ETag / Last-Modified для одной заметки.
+    GET с `If-None-Match` / `If-Modified-Since` получает 304,
+    PUT / PATCH / DELETE с устаревшим `If-Match` получают 412.
+    Права на заметку проверяются раньше `If-Match`: чужой заметке - 403, а не 412.
+    """
+
+    def _note_validators(self, request) -> tuple[str, object] | tuple[None, None]:
+        note_uuid = self.kwargs[self.lookup_url_kwarg or self.lookup_field]
+        version = get_note_version(request, note_uuid)
+        if version is None:
+            return None, None
+        return make_etag(note_uuid, version.isoformat()), version
+
+    def get_object(self):
+        # `update` / `destroy` получают заметку (с проверкой прав) до `If-Match`, DRF - еще раз.
+        if not hasattr(self, "_object"):
+            self._object = super().get_object()
+        return self._object
+
+    def _write_precondition_response(self, request):
+        note = self.get_object()
+        return get_conditional_response(request, etag=note_etag(note), last_modified=int(note.version.timestamp()))
+
+    def retrieve(self, request, *args, **kwargs):
+        # Легкий запрос версии: на 304 заметка не загружается.
+        etag, last_modified = self._note_validators(request)
+        if etag is not None:
+            response = get_conditional_response(request, etag=etag, last_modified=int(last_modified.timestamp()))
+            if response is not None:
+                return response
+        response = super().retrieve(request, *args, **kwargs)
+        set_validators(response, *self._note_validators(request))
+        return response
+
+    def update(self, request, *args, **kwargs):
+        response = self._write_precondition_response(request)
+        if response is not None:
+            return response
+        response = super().update(request, *args, **kwargs)
+        note = self._updated_note
+        set_validators(response, note_etag(note), note.version)
+        return response
+
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        self._updated_note = serializer.instance
+
+    def destroy(self, request, *args, **kwargs):
+        response = self._write_precondition_response(request)
+        if response is not None:
+            return response
+        return super().destroy(request, *args, **kwargs)
+
+
+class ConditionalListMixin:
+    """
+    ETag для списка: отданные заметки с их версиями, общее кол-во (при пагинации - из запроса
+    `COUNT` пагинатора) и параметры запроса - без отдельного запроса к базе.
+    Клиент, который опрашивает список, получает 304, пока ничего не изменилось
+    (страница при этом все равно собирается, экономится передача и разбор ответа).
+    `Last-Modified` не отдается: после удаления заметки страница меняется, а время не растет.
+    """
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        # Без пагинации сериализатор выполнит сам queryset, повторный проход берет его кэш.
+        self._listed_notes = page if page is not None else queryset
+        self._listed_count = self.paginator.page.paginator.count if page is not None else None
+        return page
+
+    def list(self, request, *args, **kwargs):
+        response = super().list(request, *args, **kwargs)
+        notes = list(self._listed_notes)
+        count = self._listed_count if self._listed_count is not None else len(notes)
+        etag = make_etag(
+            request.get_full_path(), count, *(f"{note.uuid}:{note.version.isoformat()}" for note in notes),
+        )
+        conditional = get_conditional_response(request, etag=etag)
+        if conditional is not None:
+            return conditional
+        set_validators(response, etag, None)
+        return response
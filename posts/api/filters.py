@@ -0,0 +1,17 @@
+from rest_framework.filters import SearchFilter
+
+from posts.search import search_notes
+
+
+class NoteSearchFilter(SearchFilter):
+    """
+    Реагирует на (query) параметр `search`, как и `SearchFilter`,
+    но ищет через общий движок полнотекстового поиска (`posts/search.py`).
+    Результаты упорядочены по релевантности, если не указан параметр `ordering`.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        search = " ".join(self.get_search_terms(request))
+        if not search:
+            return queryset
+        return search_notes(queryset, search).order_by("-rank", "-uuid")
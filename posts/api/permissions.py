@@ -1,9 +1,19 @@
 from rest_framework.permissions import BasePermission, SAFE_METHODS
+from rest_framework_simplejwt.models import TokenUser
 
 
 class IsOwnerOrReadOnly(BasePermission):
     def has_object_permission(self, request, view, obj):
         return (
             request.method in SAFE_METHODS
-            or request.user.is_superuser or request.user and request.user.is_authenticated and obj.user == request.user
+            or request.user.is_superuser or request.user and request.user.is_authenticated and obj.user_id == request.user.pk
         )
+
+
+class IsDatabaseUser(BasePermission):
+    """Запрещает действия, которым нужна строка пользователя из базы, для `TokenUser`
+    (режим `API_AUTH_CACHE["STATELESS"]`): его поля не загружены, и сохранять его нельзя."""
+    message = "Недоступно для токена без загрузки пользователя из базы."
+
+    def has_permission(self, request, view):
+        return not isinstance(request.user, TokenUser)
@@ -1,6 +1,8 @@
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 from rest_framework import serializers
 
+from posts.images import get_variant_urls
 from posts.models import Note, User, Tag
 
 
@@ -17,6 +19,35 @@ class TagListSerializer(serializers.ModelSerializer):
         write_only_fields = ['name']
 
 
+class TagCountSerializer(TagListSerializer):
+    """Тег с кол-вом заметок (счетчик `TagNoteCounter`, см. `posts/counters.py`)."""
+
+    note_count = serializers.SerializerMethodField()
+
+    class Meta(TagListSerializer.Meta):
+        fields = ['id', 'name', 'note_count']
+
+    def get_note_count(self, tag: Tag) -> int:
+        # У только что созданного тега аннотации нет.
+        return getattr(tag, "note_count", 0)
+
+
+class NoteTagSerializer(TagListSerializer):
+    """Тег внутри заметки. Существующее имя не ошибка - такой тег будет переиспользован."""
+
+    class Meta(TagListSerializer.Meta):
+        extra_kwargs = {"name": {"validators": []}}
+
+
+class NoteExportQuerySerializer(serializers.Serializer):
+    """Фильтры выгрузки заметок (query параметры)."""
+
+    user = serializers.CharField(required=False, help_text="Имя владельца")
+    tag = serializers.ListField(child=serializers.CharField(), required=False, help_text="Теги (все сразу)")
+    mod_time_after = serializers.DateTimeField(required=False)
+    mod_time_before = serializers.DateTimeField(required=False)
+
+
 class ImageSerializer(serializers.Serializer):
     image = serializers.ImageField(write_only=True)
 
@@ -24,13 +55,26 @@ class ImageSerializer(serializers.Serializer):
         fields = ["image"]
 
 
+class ImageVariantsField(serializers.ReadOnlyField):
+    """URL уменьшенных копий картинки: `thumbnail`, `srcset`, `webp_srcset` (или null, пока их нет)."""
+
+    def __init__(self, **kwargs):
+        kwargs["source"] = "*"
+        super().__init__(**kwargs)
+
+    def to_representation(self, note: Note) -> dict | None:
+        request = self.context.get("request")
+        return get_variant_urls(note, request.build_absolute_uri if request is not None else None)
+
+
 class NoteSerializer(serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
-    tags = TagListSerializer(many=True)
+    tags = NoteTagSerializer(many=True)
+    image_variants = ImageVariantsField()
 
     class Meta:
         model = Note
-        fields = ["uuid", "title", "content", "created_at", "mod_time", "image", "tags", "user"]
+        fields = ["uuid", "title", "content", "created_at", "mod_time", "image", "image_variants", "tags", "user"]
         read_only_fields = ["uuid", "user", "created_at", "mod_time"]
         write_only_fields = ["title", "content", "image", "tags"]
 
@@ -38,14 +82,20 @@ class NoteSerializer(serializers.ModelSerializer):
         tags = validated_data.pop("tags")
 
         note = Note.objects.create(**validated_data)
+        # Теги создаются одним запросом, а связи с заметкой добавляются одним `INSERT`.
+        note.tags.add(*Tag.objects.get_or_create_many(tag["name"] for tag in tags))
+
+        return note
 
-        tags_objects: list[Tag] = []
+    def update(self, instance: Note, validated_data) -> Note:
+        tags = validated_data.pop("tags", None)
 
-        for tag in tags:
-            obj, created = Tag.objects.get_or_create(name=tag["name"])
-            tags_objects.append(obj)
+        validated_data["mod_time"] = timezone.now()
+        note = super().update(instance, validated_data)
 
-        note.tags.set(tags_objects)
+        # При частичном обновлении (PATCH) без `tags` теги не меняются.
+        if tags is not None:
+            note.tags.set(Tag.objects.get_or_create_many(tag["name"] for tag in tags))
 
         return note
 
@@ -53,10 +103,11 @@ class NoteSerializer(serializers.ModelSerializer):
 class NoteListSerializer(serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
     tags = TagListSerializer(many=True)
+    image_variants = ImageVariantsField()
 
     class Meta:
         model = Note
-        fields = ["uuid", "title", "created_at", "mod_time", "image", "user", "tags"]
+        fields = ["uuid", "title", "created_at", "mod_time", "image", "image_variants", "user", "tags"]
 
 
 class NoteCreateSerializer(serializers.ModelSerializer):
@@ -0,0 +1,231 @@
+"""
+Черный список refresh токенов с фильтром Блума в памяти процесса.
+
+При `ROTATE_REFRESH_TOKENS` и `BLACKLIST_AFTER_ROTATION` каждый refresh проверяет токен
+запросом к `BlacklistedToken` (JOIN с `OutstandingToken`). Здесь проверка идет по фильтру Блума:
+если jti в фильтре нет - токен точно не отозван и запроса к базе нет,
+при возможном совпадении проверяем базу.
+
+Фильтр обновляется не чаще раза в `TOKEN_BLACKLIST["SYNC_INTERVAL"]` секунд
+одним запросом новых строк и полностью пересобирается
+раз в `REBUILD_INTERVAL` секунд или при переполнении - тогда из него уходят истекшие токены.
+Пересборка идет в фоновом потоке, запросы до ее конца проверяются старым фильтром
+(в нем нет пропусков, только больше ложных срабатываний).
+Токены, отозванные в этом процессе, попадают в фильтр сразу, в других процессах - через `SYNC_INTERVAL`.
+
+Транзакции фиксируются не в порядке id: строка может стать видна позже строк с большим id.
+Поэтому обновление читает не `id > последний`, а все id, появившиеся за `SYNC_MARGIN` секунд
+до прошлого обновления (по запомненному наибольшему id на тот момент). Пропустить строку может
+только транзакция, которая фиксировалась дольше `SYNC_MARGIN` секунд после вставки.
+
+Истекшие строки удаляет команда `prune_token_blacklist`.
+"""
+import hashlib
+import logging
+import math
+import threading
+import time
+from collections import deque
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+from rest_framework.exceptions import ValidationError
+from rest_framework_simplejwt.serializers import (
+    TokenBlacklistSerializer, TokenRefreshSerializer, TokenVerifySerializer,
+)
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+from rest_framework_simplejwt.tokens import RefreshToken, UntypedToken
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "SYNC_INTERVAL": 2,
+    "REBUILD_INTERVAL": 60 * 60,
+    "CAPACITY": 100000,
+    "ERROR_RATE": 0.001,
+    # Сколько секунд транзакция с отзывом токена может фиксироваться (плюс расхождение часов серверов).
+    "SYNC_MARGIN": 60,
+}
+
+
+def get_config() -> dict:
+    return {**DEFAULTS, **getattr(settings, "TOKEN_BLACKLIST", {})}
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray(math.ceil(self.size / 8))
+        self.count = 0
+
+    def _positions(self, value: str):
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "big")
+        second = int.from_bytes(digest[8:], "big") | 1
+        for i in range(self.hash_count):
+            yield (first + i * second) % self.size
+
+    def add(self, value: str) -> None:
+        if value in self:
+            return
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+class RevocationFilter:
+    """Множество отозванных jti процесса (с ложными срабатываниями, но без пропусков)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._bloom: BloomFilter | None = None
+        self._last_id = 0
+        # `(time.monotonic(), наибольший id, видимый на тот момент)` за последние `SYNC_MARGIN` секунд.
+        self._snapshots: deque[tuple[float, int]] = deque()
+        self._synced_at = 0.0
+        self._built_at = 0.0
+        # jti, отозванные в процессе во время пересборки: в новый фильтр они добавляются при замене.
+        self._rebuilding: list[str] | None = None
+
+    def might_contain(self, jti: str) -> bool:
+        self.sync()
+        return jti in self._bloom
+
+    def add(self, jti: str) -> None:
+        with self._lock:
+            if self._bloom is not None:
+                self._bloom.add(jti)
+            if self._rebuilding is not None:
+                self._rebuilding.append(jti)
+
+    def sync(self, force: bool = False) -> None:
+        config = get_config()
+        now = time.monotonic()
+        if not force and self._bloom is not None and now - self._synced_at < config["SYNC_INTERVAL"]:
+            return
+        if self._bloom is None:
+            # Первый фильтр строится в запросе: без него проверять нечем.
+            with self._build_lock:
+                if self._bloom is None:
+                    self._rebuild(config)
+            return
+        with self._lock:
+            rows = BlacklistedToken.objects.filter(id__gt=self._sync_floor(config))
+            self._last_id = self._add_rows(self._bloom, rows, self._last_id)
+            # Наибольший id мог быть выдан уже во время запроса: время снимка - конец чтения.
+            self._snapshots.append((time.monotonic(), self._last_id))
+            self._synced_at = now
+            needs_rebuild = (
+                self._rebuilding is None
+                and (self._bloom.count > self._bloom.capacity or now - self._built_at >= config["REBUILD_INTERVAL"])
+            )
+            if needs_rebuild:
+                self._rebuilding = []
+        if needs_rebuild:
+            # Полная пересборка читает весь список: в фоне, запросы пока проверяются старым фильтром.
+            threading.Thread(
+                target=self._rebuild_in_background, args=(config,), name="token-blacklist-rebuild", daemon=True,
+            ).start()
+
+    def _sync_floor(self, config: dict) -> int:
+        """
+        Наибольший id, видимый за `SYNC_MARGIN` секунд до прошлого обновления. Строка, которой
+        тогда не было видно, вставлена позже этого момента минус `SYNC_MARGIN` - и id у нее больше.
+        """
+        cutoff = self._synced_at - config["SYNC_MARGIN"]
+        while len(self._snapshots) > 1 and self._snapshots[1][0] <= cutoff:
+            self._snapshots.popleft()
+        return self._snapshots[0][1]
+
+    def _rebuild_in_background(self, config: dict) -> None:
+        try:
+            self._rebuild(config)
+        except Exception:
+            logger.exception("Не удалось пересобрать фильтр черного списка токенов")
+            with self._lock:
+                self._rebuilding = None
+        finally:
+            connection.close()
+
+    def _rebuild(self, config: dict) -> None:
+        started = time.monotonic()
+        cutoff = timezone.now() - timedelta(seconds=config["SYNC_MARGIN"])
+        # Истекшие токены все равно не пройдут проверку `exp`, в фильтр их не берем.
+        rows = BlacklistedToken.objects.filter(token__expires_at__gt=timezone.now())
+        total = rows.count()
+        bloom = BloomFilter(max(config["CAPACITY"], total * 2), config["ERROR_RATE"])
+        last_id = 0
+        # Строки, вставленные раньше `SYNC_MARGIN`, уже зафиксированы: у незафиксированных id больше.
+        floor = 0
+        values = rows.order_by("id").values_list("id", "token__jti", "blacklisted_at")
+        for row_id, jti, blacklisted_at in values.iterator(chunk_size=5000):
+            bloom.add(jti)
+            last_id = max(last_id, row_id)
+            if blacklisted_at < cutoff:
+                floor = max(floor, row_id)
+        with self._lock:
+            # Строки, зафиксированные за время пересборки.
+            last_id = self._add_rows(bloom, BlacklistedToken.objects.filter(id__gt=floor), last_id)
+            for jti in self._rebuilding or ():
+                bloom.add(jti)
+            self._bloom = bloom
+            self._last_id = last_id
+            self._rebuilding = None
+            now = time.monotonic()
+            self._snapshots = deque([(started - config["SYNC_MARGIN"], floor), (now, last_id)])
+            self._synced_at = self._built_at = now
+
+    @staticmethod
+    def _add_rows(bloom: BloomFilter, rows, last_id: int = 0) -> int:
+        """Добавить jti строк в фильтр; возвращает наибольший id строк (не меньше `last_id`)."""
+        for row_id, jti in rows.order_by("id").values_list("id", "token__jti").iterator(chunk_size=5000):
+            bloom.add(jti)
+            last_id = max(last_id, row_id)
+        return last_id
+
+
+revocation_filter = RevocationFilter()
+
+
+class FilteredRefreshToken(RefreshToken):
+    def check_blacklist(self) -> None:
+        if revocation_filter.might_contain(self.payload[jwt_settings.JTI_CLAIM]):
+            super().check_blacklist()
+
+    def blacklist(self):
+        result = super().blacklist()
+        revocation_filter.add(self.payload[jwt_settings.JTI_CLAIM])
+        return result
+
+
+class FilteredTokenRefreshSerializer(TokenRefreshSerializer):
+    token_class = FilteredRefreshToken
+
+
+class FilteredTokenBlacklistSerializer(TokenBlacklistSerializer):
+    token_class = FilteredRefreshToken
+
+
+class FilteredTokenVerifySerializer(TokenVerifySerializer):
+    def validate(self, attrs: dict) -> dict:
+        token = UntypedToken(attrs["token"])
+        if jwt_settings.BLACKLIST_AFTER_ROTATION:
+            jti = token.get(jwt_settings.JTI_CLAIM)
+            revoked = (
+                jti is not None and revocation_filter.might_contain(jti)
+                and BlacklistedToken.objects.filter(token__jti=jti).exists()
+            )
+            if revoked:
+                raise ValidationError(_("Token is blacklisted"))
+        return {}
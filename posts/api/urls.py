@@ -1,4 +1,4 @@
-from django.urls import path
+from django.urls import path, re_path
 
 from . import views
 
@@ -10,6 +10,7 @@ urlpatterns = [
     path("posts/", views.NoteListCreateAPIView.as_view(), name="note-list-create"),
     path("posts/<uuid:pk>", views.NoteDetailAPIView.as_view(), name="note"),
     path("posts/image", views.UploadImageAPIView.as_view(), name="note-image-upload"),
+    re_path(r"^posts/export\.(?P<export_format>ndjson|csv)$", views.NoteExportAPIView.as_view(), name="note-export"),
     path("tags/", views.TagListCreateApiView.as_view(), name="tag")
 
 ]
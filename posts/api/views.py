@@ -3,24 +3,31 @@ from rest_framework.response import Response
 from rest_framework.generics import GenericAPIView, ListCreateAPIView, RetrieveUpdateDestroyAPIView
 from rest_framework.permissions import IsAuthenticatedOrReadOnly
 from rest_framework.serializers import ModelSerializer
-from rest_framework.filters import SearchFilter, OrderingFilter
+from rest_framework.filters import OrderingFilter
 from rest_framework.pagination import PageNumberPagination
-from django.core.files.uploadedfile import InMemoryUploadedFile
-from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.db.models.functions import Coalesce
+from django.http import StreamingHttpResponse
+import csv
 import uuid
 
+from posts.api.conditional import ConditionalListMixin, ConditionalNoteMixin
+from posts.api.filters import NoteSearchFilter
 from posts.api.permissions import IsOwnerOrReadOnly
-from posts.api.serializers import ImageSerializer, NoteSerializer, NoteListSerializer, \
-    TagListSerializer, NoteDetailSerializer, NoteCreateSerializer
+from posts.api.serializers import ImageSerializer, NoteExportQuerySerializer, NoteSerializer, NoteListSerializer, \
+    TagCountSerializer, NoteDetailSerializer, NoteCreateSerializer
 
-from posts.models import Note, Tag
+from posts.models import MediaDeletion, Note, Tag
+from posts.notes_transfer import encode_record, iter_record_batches
+from posts.storage import content_addressed_storage
 
 
-class NoteListCreateAPIView(ListCreateAPIView):
-    queryset = Note.objects.all()
+class NoteListCreateAPIView(ConditionalListMixin, ListCreateAPIView):
+    # `user` и `tags` выводятся для каждой записи, поэтому вытягиваем их заранее.
+    queryset = Note.objects.select_related("user").prefetch_related("tags")
+    query_budget = 6
     permission_classes = [IsAuthenticatedOrReadOnly]
-    filter_backends = [SearchFilter, OrderingFilter]  # Реагирует на (query) параметр `search`
-    search_fields = ['@title', '@content']  # Используем полнотекстовый поиск Postgres
+    filter_backends = [NoteSearchFilter, OrderingFilter]  # Реагирует на (query) параметр `search`
     ordering_fields = ["created_at", "mode_time", "user_username"]
     pagination_class = PageNumberPagination
 
@@ -30,11 +37,12 @@ class NoteListCreateAPIView(ListCreateAPIView):
         return NoteListSerializer
 
     def perform_create(self, serializer):
-        serializer.save(user=self.request.user)
+        serializer.save(user_id=self.request.user.pk)
 
 
-class NoteDetailAPIView(RetrieveUpdateDestroyAPIView):
-    queryset = Note.objects.all()
+class NoteDetailAPIView(ConditionalNoteMixin, RetrieveUpdateDestroyAPIView):
+    queryset = Note.objects.select_related("user").prefetch_related("tags")
+    query_budget = 8
     serializer_class = NoteSerializer
     lookup_field = 'pk'
     lookup_url_kwarg = 'pk'
@@ -57,7 +65,7 @@ class NoteListCreateGenericAPIView(GenericAPIView):
     def post(self, request, *args, **kwargs):
         serializer: ModelSerializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        note = serializer.save(user=self.request.user)
+        note = serializer.save(user_id=self.request.user.pk)
         serializer = NoteDetailSerializer(instance=note)
         return Response(serializer.data, status=201)
 
@@ -96,20 +104,99 @@ class DetailNoteGenericAPIView(GenericAPIView):
         return Response(status=204)
 
 
+class _Echo:
+    """Буфер для `csv.writer`, который сразу возвращает записанную строку."""
+
+    def write(self, value: str) -> str:
+        return value
+
+
+class NoteExportAPIView(GenericAPIView):
+    """
+    Выгрузка заметок целиком: `/api/posts/export.ndjson` или `/api/posts/export.csv`.
+    Фильтры: `user`, `tag` (можно несколько), `mod_time_after`, `mod_time_before`.
+
+    Ответ потоковый: заметки читаются пачками через серверный курсор (см. `posts/notes_transfer.py`)
+    и отдаются по мере чтения, без COUNT и OFFSET, память не зависит от кол-ва заметок.
+    NDJSON в том же формате, что и у команды `export_notes` (его принимает `import_notes`).
+    """
+
+    queryset = Note.objects.all()
+    # Запросы за время потоковой отдачи идут уже после view и в бюджет не попадают.
+    query_budget = 3
+    batch_size = 1000
+    csv_columns = ["uuid", "title", "content", "created_at", "mod_time", "user", "tags", "image"]
+    content_types = {
+        "ndjson": "application/x-ndjson",
+        "csv": "text/csv; charset=utf-8",
+    }
+
+    def perform_content_negotiation(self, request, force=False):
+        # Формат задан адресом, `Accept: application/x-ndjson` не должен давать 406.
+        return super().perform_content_negotiation(request, force=True)
+
+    def get(self, request, export_format: str, *args, **kwargs):
+        params = NoteExportQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        queryset = self.filter_export(self.get_queryset(), params.validated_data)
+
+        if export_format == "csv":
+            chunks = self.csv_chunks(queryset)
+        else:
+            chunks = self.ndjson_chunks(queryset)
+        response = StreamingHttpResponse(chunks, content_type=self.content_types[export_format])
+        response["Content-Disposition"] = f'attachment; filename="notes.{export_format}"'
+        # Иначе nginx копит ответ в буфере и клиент не получает данные сразу.
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    @staticmethod
+    def filter_export(queryset, filters: dict):
+        if "user" in filters:
+            queryset = queryset.filter(user__username=filters["user"])
+        for tag in filters.get("tag", []):
+            queryset = queryset.filter(tags__name=tag)
+        if "mod_time_after" in filters:
+            queryset = queryset.filter(mod_time__gte=filters["mod_time_after"])
+        if "mod_time_before" in filters:
+            queryset = queryset.filter(mod_time__lt=filters["mod_time_before"])
+        return queryset
+
+    def ndjson_chunks(self, queryset):
+        for records in iter_record_batches(queryset, self.batch_size):
+            yield "".join(encode_record(record) for record in records)
+
+    def csv_chunks(self, queryset):
+        writer = csv.writer(_Echo())
+        # Заголовок уходит клиенту до первого запроса к базе.
+        yield writer.writerow(self.csv_columns)
+        for records in iter_record_batches(queryset, self.batch_size):
+            yield "".join(
+                writer.writerow([
+                    record["uuid"], record["title"], record["content"], record["created_at"],
+                    record["mod_time"], record["user"], ",".join(record["tags"]), record["image"],
+                ])
+                for record in records
+            )
+
+
 class UploadImageAPIView(GenericAPIView):
     serializer_class = ImageSerializer
 
     def post(self, request, *args, **kwargs):
         serializer = self.serializer_class(data=request.data)
         serializer.is_valid(raise_exception=True)
-        image: InMemoryUploadedFile = serializer.validated_data["image"]
-        with open(f"{settings.MEDIA_ROOT}/images/{image.name}", "bw") as image_file:
-            image_file.write(image.read())
-        return Response({"name": image.name, "url": "images/" + image.name})
+        image: UploadedFile = serializer.validated_data["image"]
+        # Файл записывается частями, имя - хэш содержимого (одинаковые картинки не дублируются).
+        name = content_addressed_storage.save(f"images/{image.name}", image)
+        # Ссылку загрузки освободит `collect_media`, когда на файл не будет ссылаться ни одна заметка.
+        MediaDeletion.objects.enqueue(uploads=[name])
+        return Response({"name": image.name, "url": content_addressed_storage.url(name)})
 
 
 class TagListCreateApiView(ListCreateAPIView):
-    queryset = Tag.objects.all()
-    serializer_class = TagListSerializer
+    queryset = Tag.objects.annotate(note_count=Coalesce("note_counter__note_count", 0))
+    query_budget = 3
+    serializer_class = TagCountSerializer
     lookup_field = 'id'
     permission_classes = [IsAuthenticatedOrReadOnly]
@@ -0,0 +1,316 @@
+"""
+Нагрузочные замеры приложения заметок (команды `seed_benchmark` и `benchmark`).
+
+Данные создаются детерминированно (`random.Random(seed)`), поэтому замеры на одном размере
+набора сравнимы между релизами. Все пользователи набора называются `bench_<n>`
+и имеют пароль `BENCHMARK_PASSWORD`.
+
+Для каждого адреса считаются пропускная способность, p50/p95/p99 задержки,
+кол-во SQL запросов (только в процессе) и пиковый RSS. Результат можно сохранить
+как базовый и сравнивать с ним следующие прогоны.
+"""
+import json
+import os
+import random
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.contrib.auth.hashers import make_password
+
+from .models import Note, Tag, User
+from .notes_transfer import insert_as_is
+from .query_budget import QueryCounter, execute_wrapper_all
+from .search import get_search_backend
+
+
+BENCHMARK_PASSWORD = "bench-password"
+USERNAME_PREFIX = "bench_"
+
+WORDS = (
+    "python django postgres redis cache index query note tag user search page token image "
+    "заметка поиск тег пользователь страница запрос индекс кэш база данные картинка текст"
+).split()
+
+
+@dataclass
+class Endpoint:
+    name: str
+    method: str
+    path: str
+    data: dict | None = None
+    authenticated: bool = False
+
+
+@dataclass
+class EndpointResult:
+    name: str
+    requests: int
+    errors: int
+    rps: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    queries: float | None
+    peak_rss_mb: float
+    regressions: list[str] = field(default_factory=list)
+
+
+# Наполнение.
+
+def seed(size: int, seed_value: int = 42, batch_size: int = 5000, progress=None) -> None:
+    """Создать `size` заметок с тегами и пользователями (примерно 100 заметок на пользователя)."""
+    rng = random.Random(seed_value)
+    password = make_password(BENCHMARK_PASSWORD)
+
+    User.objects.bulk_create(
+        [
+            User(username=f"{USERNAME_PREFIX}{index}", email=f"{USERNAME_PREFIX}{index}@example.com", password=password)
+            for index in range(max(1, size // 100))
+        ],
+        batch_size=batch_size,
+    )
+    user_ids = [user.pk for user in User.objects.filter(username__startswith=USERNAME_PREFIX).order_by("pk")]
+    tags = Tag.objects.get_or_create_many(f"{word}-{index}" for word in WORDS for index in range(5))
+    tag_ids = [tag.pk for tag in tags]
+
+    started_at = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+    through = Note.tags.through
+    created = 0
+    while created < size:
+        count = min(batch_size, size - created)
+        notes = []
+        links = []
+        for index in range(created, created + count):
+            note_uuid = uuid.UUID(int=rng.getrandbits(128), version=4)
+            moment = started_at + timedelta(minutes=index)
+            notes.append(Note(
+                uuid=note_uuid,
+                title=" ".join(rng.choices(WORDS, k=rng.randint(2, 6))).capitalize(),
+                content="<p>" + " ".join(rng.choices(WORDS, k=rng.randint(20, 200))) + "</p>",
+                created_at=moment,
+                mod_time=moment if rng.random() < 0.3 else None,
+                user_id=rng.choice(user_ids),
+            ))
+            links.extend(
+                through(note_id=note_uuid, tag_id=tag_id) for tag_id in rng.sample(tag_ids, rng.randint(0, 4))
+            )
+        # `created_at` задан явно: `bulk_create` подставил бы текущее время (`auto_now_add`).
+        insert_as_is(Note, notes, batch_size=batch_size)
+        through.objects.bulk_create(links, batch_size=batch_size)
+        # `bulk_create` не вызывает сигналы - поисковый индекс заполняем явно.
+        get_search_backend().reindex(Note.objects.filter(uuid__in=[note.uuid for note in notes]))
+        created += count
+        if progress is not None:
+            progress(created)
+
+
+def clear() -> int:
+    deleted, _ = Note.objects.filter(user__username__startswith=USERNAME_PREFIX).delete()
+    User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+    return deleted
+
+
+def default_endpoints() -> list[Endpoint]:
+    note = Note.objects.filter(user__username__startswith=USERNAME_PREFIX).order_by("uuid").values("uuid").first()
+    username = (
+        User.objects.filter(username__startswith=USERNAME_PREFIX)
+        .order_by("pk").values_list("username", flat=True).first()
+    )
+    endpoints = [
+        Endpoint("home", "GET", "/"),
+        Endpoint("filter", "GET", "/filter?search=django"),
+        Endpoint("api-posts", "GET", "/api/posts/", authenticated=True),
+        Endpoint("api-token", "POST", "/api/token/", data={"username": username, "password": BENCHMARK_PASSWORD}),
+    ]
+    if note is not None:
+        endpoints.insert(2, Endpoint("note", "GET", f"/post/{note['uuid']}"))
+    return endpoints
+
+
+# Замеры.
+
+def percentile(values: list[float], percent: int) -> float:
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[percent - 1]
+
+
+def peak_rss_mb() -> float:
+    # На Linux `ru_maxrss` в килобайтах.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def summarize(name: str, latencies: list[float], errors: int, elapsed: float,
+              queries: float | None, rss_mb: float) -> EndpointResult:
+    latencies_ms = [latency * 1000 for latency in latencies] or [0.0]
+    return EndpointResult(
+        name=name,
+        requests=len(latencies),
+        errors=errors,
+        rps=round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        p50_ms=round(percentile(latencies_ms, 50), 2),
+        p95_ms=round(percentile(latencies_ms, 95), 2),
+        p99_ms=round(percentile(latencies_ms, 99), 2),
+        queries=queries,
+        peak_rss_mb=round(rss_mb, 1),
+    )
+
+
+def run_in_process(endpoints: list[Endpoint], requests: int, warmup: int) -> list[EndpointResult]:
+    """Запросы через `django.test.Client` в текущем процессе, с подсчетом SQL запросов."""
+    from django.test import Client
+
+    user = User.objects.filter(username__startswith=USERNAME_PREFIX).order_by("pk").first()
+    results = []
+    for endpoint in endpoints:
+        client = Client()
+        if endpoint.authenticated and user is not None:
+            client.force_login(user)
+
+        def call():
+            if endpoint.method == "POST":
+                return client.post(endpoint.path, endpoint.data or {})
+            return client.get(endpoint.path)
+
+        for _ in range(warmup):
+            call()
+
+        latencies = []
+        errors = 0
+        counter = QueryCounter()
+        started = time.perf_counter()
+        with execute_wrapper_all(counter):
+            for _ in range(requests):
+                request_started = time.perf_counter()
+                response = call()
+                latencies.append(time.perf_counter() - request_started)
+                errors += response.status_code >= 400
+        elapsed = time.perf_counter() - started
+        results.append(summarize(
+            endpoint.name, latencies, errors, elapsed, round(counter.count / max(requests, 1), 1), peak_rss_mb(),
+        ))
+    return results
+
+
+def run_gunicorn(endpoints: list[Endpoint], requests: int, warmup: int,
+                 concurrency: int, workers: int, port: int) -> list[EndpointResult]:
+    """Запросы по HTTP к локальному gunicorn (`project.wsgi`) в `concurrency` потоков."""
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "project.wsgi:application",
+         "--bind", f"127.0.0.1:{port}", "--workers", str(workers), "--log-level", "warning"],
+        env={**os.environ},
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        _wait_for_port(port)
+        token = _obtain_token(base_url, endpoints)
+        results = []
+        for endpoint in endpoints:
+            call = _http_call(base_url, endpoint, token)
+            for _ in range(warmup):
+                call()
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                outcomes = list(executor.map(lambda _: call(), range(requests)))
+            elapsed = time.perf_counter() - started
+            latencies = [latency for latency, _ in outcomes]
+            errors = sum(not ok for _, ok in outcomes)
+            results.append(summarize(endpoint.name, latencies, errors, elapsed, None, _process_tree_rss_mb(server.pid)))
+        return results
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def _wait_for_port(port: int, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(("127.0.0.1", port)) == 0:
+                return
+        time.sleep(0.2)
+    raise RuntimeError(f"gunicorn не запустился на порту {port}")
+
+
+def _obtain_token(base_url: str, endpoints: list[Endpoint]) -> str | None:
+    credentials = next((endpoint.data for endpoint in endpoints if endpoint.path == "/api/token/"), None)
+    if credentials is None:
+        return None
+    request = urllib.request.Request(
+        base_url + "/api/token/", data=urllib.parse.urlencode(credentials).encode(), method="POST",
+    )
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)["access"]
+
+
+def _http_call(base_url: str, endpoint: Endpoint, token: str | None):
+    headers = {"Authorization": f"Bearer {token}"} if endpoint.authenticated and token else {}
+    data = urllib.parse.urlencode(endpoint.data).encode() if endpoint.method == "POST" and endpoint.data else None
+
+    def call() -> tuple[float, bool]:
+        request = urllib.request.Request(base_url + endpoint.path, data=data, headers=headers, method=endpoint.method)
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+                ok = response.status < 400
+        except urllib.error.HTTPError as error:
+            ok = error.code < 400
+        return time.perf_counter() - started, ok
+
+    return call
+
+
+def _process_tree_rss_mb(pid: int) -> float:
+    """Сумма пиковых RSS (`VmHWM`) мастера gunicorn и его воркеров (Linux `/proc`)."""
+    total_kb = 0
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/status") as file:
+                status = dict(line.split(":", 1) for line in file if ":" in line)
+        except OSError:
+            continue
+        if int(entry) == pid or status.get("PPid", "").strip() == str(pid):
+            total_kb += int(status.get("VmHWM", "0 kB").split()[0])
+    return total_kb / 1024
+
+
+# Сравнение с базовым прогоном.
+
+def save_baseline(path: str, results: list[EndpointResult], meta: dict) -> None:
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump({"meta": meta, "results": [asdict(result) for result in results]}, file, ensure_ascii=False, indent=2)
+
+
+def compare(results: list[EndpointResult], baseline_path: str, threshold: float) -> list[EndpointResult]:
+    """Отметить регрессии: задержка p95 / p99 выросла больше чем на `threshold`, стало больше запросов."""
+    if not os.path.exists(baseline_path):
+        return results
+    with open(baseline_path, encoding="utf-8") as file:
+        baseline = {result["name"]: result for result in json.load(file)["results"]}
+
+    for result in results:
+        previous = baseline.get(result.name)
+        if previous is None:
+            continue
+        for metric in ("p95_ms", "p99_ms"):
+            if previous[metric] and getattr(result, metric) > previous[metric] * (1 + threshold):
+                result.regressions.append(f"{metric} {previous[metric]} -> {getattr(result, metric)}")
+        if previous["rps"] and result.rps < previous["rps"] * (1 - threshold):
+            result.regressions.append(f"rps {previous['rps']} -> {result.rps}")
+        if previous.get("queries") is not None and result.queries is not None and result.queries > previous["queries"]:
+            result.regressions.append(f"queries {previous['queries']} -> {result.queries}")
+    return results
@@ -0,0 +1,288 @@
+"""
+Двухуровневый кэш: LRU в памяти процесса перед `RedisCache`.
+
+    CACHES = {
+        "default": {
+            "BACKEND": "posts.cache_backend.TwoTierRedisCache",
+            "LOCATION": "redis://...",
+            "OPTIONS": {"LOCAL_MAX_ENTRIES": 1000, "LOCAL_TIMEOUT": 30},
+        }
+    }
+
+* Чтение сначала идет в локальный LRU, при промахе - в Redis (значение и оставшийся TTL
+  одним pipeline). Найденное значение кладется в LRU на `min(TTL в Redis, LOCAL_TIMEOUT)`.
+* Запись и удаление идут в Redis, затем в свой LRU, и только после этого другим процессам
+  через pub/sub канал уходит список измененных ключей - они удаляют их из своего LRU. Если сообщение потерялось,
+  устаревшее значение живет не дольше `LOCAL_TIMEOUT`.
+* Попадания и промахи учитываются в метриках текущего запроса (`posts/metrics.py`).
+* `stats()` - счетчики попаданий в LRU / Redis, промахов и вытеснений по префиксу ключа
+  (часть до первого `:`, например `note-card`).
+"""
+import logging
+import os
+import pickle
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict, defaultdict
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.cache.backends.redis import RedisCache
+
+from .metrics import record_cache
+
+
+logger = logging.getLogger(__name__)
+
+CLEAR_ALL = "*"
+
+
+class LocalLRU:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple[bytes, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> tuple[bool, object]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            if entry[1] <= time.monotonic():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+        # Храним pickle, чтобы изменение полученного объекта не меняло кэш.
+        return True, pickle.loads(entry[0])
+
+    def set(self, key: str, value, ttl: float) -> int:
+        """Сохранить значение на `ttl` секунд. Возвращает кол-во вытесненных записей."""
+        if ttl <= 0:
+            self.delete([key])
+            return 0
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        evicted = 0
+        with self._lock:
+            self._entries[key] = (data, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                evicted += 1
+        return evicted
+
+    def delete(self, keys) -> None:
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class TwoTierRedisCache(RedisCache):
+
+    def __init__(self, server, params):
+        params = dict(params)
+        options = dict(params.get("OPTIONS", {}))
+        self.local_timeout = options.pop("LOCAL_TIMEOUT", 30)
+        local_max_entries = options.pop("LOCAL_MAX_ENTRIES", 1000)
+        self.invalidation_channel = options.pop("INVALIDATION_CHANNEL", "cache-invalidation")
+        params["OPTIONS"] = options
+        super().__init__(server, params)
+
+        self._local = LocalLRU(local_max_entries)
+        self._stats: dict[str, Counter] = defaultdict(Counter)
+        self._stats_lock = threading.Lock()
+        self._sender_id = uuid.uuid4().hex
+        self._listener_pid = None
+
+    # Статистика.
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        with self._stats_lock:
+            return {prefix: dict(counters) for prefix, counters in self._stats.items()}
+
+    def _count(self, key: str, name: str, amount: int = 1) -> None:
+        if name in ("local_hits", "remote_hits"):
+            record_cache(hits=amount)
+        elif name == "misses":
+            record_cache(misses=amount)
+        if amount:
+            with self._stats_lock:
+                self._stats[key.split(":", 1)[0]][name] += amount
+
+    # Инвалидация между процессами.
+
+    def _ensure_listener(self) -> None:
+        # После fork (gunicorn --preload) поток подписки нужно запустить в каждом воркере.
+        if self._listener_pid == os.getpid():
+            return
+        self._listener_pid = os.getpid()
+        self._sender_id = uuid.uuid4().hex
+        self._local.clear()
+        try:
+            pubsub = self._cache.get_client().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{self.invalidation_channel: self._on_invalidation})
+            pubsub.run_in_thread(sleep_time=1, daemon=True)
+        except Exception:
+            logger.exception("Не удалось подписаться на канал инвалидации кэша")
+
+    def _on_invalidation(self, message) -> None:
+        sender, _, keys = message["data"].decode().partition("|")
+        if sender == self._sender_id:
+            return
+        if keys == CLEAR_ALL:
+            self._local.clear()
+        else:
+            self._local.delete(keys.split("\0"))
+
+    def _publish(self, full_keys) -> None:
+        try:
+            self._cache.get_client(write=True).publish(
+                self.invalidation_channel, f"{self._sender_id}|{chr(0).join(full_keys)}",
+            )
+        except Exception:
+            logger.exception("Не удалось отправить инвалидацию кэша")
+
+    def _local_ttl(self, timeout) -> float:
+        if timeout is None:
+            return self.local_timeout
+        return min(timeout, self.local_timeout)
+
+    # Чтение.
+
+    def get(self, key, default=None, version=None):
+        self._ensure_listener()
+        full_key = self.make_and_validate_key(key, version=version)
+        found, value = self._local.get(full_key)
+        if found:
+            self._count(key, "local_hits")
+            return value
+
+        result = self._fetch([full_key]).get(full_key)
+        if result is None:
+            self._count(key, "misses")
+            return default
+        self._count(key, "remote_hits")
+        return result
+
+    def get_many(self, keys, version=None):
+        self._ensure_listener()
+        full_keys = {self.make_and_validate_key(key, version=version): key for key in keys}
+        result = {}
+        missing = []
+        for full_key, key in full_keys.items():
+            found, value = self._local.get(full_key)
+            if found:
+                self._count(key, "local_hits")
+                result[key] = value
+            else:
+                missing.append(full_key)
+
+        fetched = self._fetch(missing)
+        for full_key in missing:
+            key = full_keys[full_key]
+            if full_key in fetched:
+                self._count(key, "remote_hits")
+                result[key] = fetched[full_key]
+            else:
+                self._count(key, "misses")
+        return result
+
+    def _fetch(self, full_keys: list[str]) -> dict:
+        """Значения из Redis с переносом в LRU на оставшийся TTL."""
+        if not full_keys:
+            return {}
+        pipeline = self._cache.get_client().pipeline(transaction=False)
+        for full_key in full_keys:
+            pipeline.get(full_key)
+            pipeline.pttl(full_key)
+        replies = pipeline.execute()
+
+        result = {}
+        for index, full_key in enumerate(full_keys):
+            raw, pttl = replies[2 * index], replies[2 * index + 1]
+            if raw is None:
+                continue
+            value = self._cache._serializer.loads(raw)
+            result[full_key] = value
+            # -1 - ключ без срока жизни.
+            ttl = self.local_timeout if pttl is None or pttl < 0 else self._local_ttl(pttl / 1000)
+            evicted = self._local.set(full_key, value, ttl)
+            self._count(full_key.split(":", 2)[-1], "evictions", evicted)
+        return result
+
+    # Запись.
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._ensure_listener()
+        super().set(key, value, timeout, version)
+        full_key = self.make_and_validate_key(key, version=version)
+        evicted = self._local.set(full_key, value, self._local_ttl(self.get_backend_timeout(timeout)))
+        self._count(key, "evictions", evicted)
+        self._publish([full_key])
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        self._ensure_listener()
+        failed = super().set_many(data, timeout, version)
+        ttl = self._local_ttl(self.get_backend_timeout(timeout))
+        full_keys = []
+        for key, value in data.items():
+            full_key = self.make_and_validate_key(key, version=version)
+            full_keys.append(full_key)
+            self._count(key, "evictions", self._local.set(full_key, value, ttl))
+        self._publish(full_keys)
+        return failed
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        added = super().add(key, value, timeout, version)
+        if added:
+            self._invalidate([self.make_and_validate_key(key, version=version)])
+        return added
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        touched = super().touch(key, timeout, version)
+        self._invalidate([self.make_and_validate_key(key, version=version)])
+        return touched
+
+    def incr(self, key, delta=1, version=None):
+        value = super().incr(key, delta, version)
+        self._invalidate([self.make_and_validate_key(key, version=version)])
+        return value
+
+    def delete(self, key, version=None):
+        deleted = super().delete(key, version)
+        self._invalidate([self.make_and_validate_key(key, version=version)])
+        return deleted
+
+    def delete_many(self, keys, version=None):
+        super().delete_many(keys, version)
+        self._invalidate([self.make_and_validate_key(key, version=version) for key in keys])
+
+    def clear(self):
+        cleared = super().clear()
+        self._local.clear()
+        self._publish([CLEAR_ALL])
+        return cleared
+
+    def _invalidate(self, full_keys: list[str]) -> None:
+        self._ensure_listener()
+        self._local.delete(full_keys)
+        self._publish(full_keys)
+
+
+class InstrumentedLocMemCache(LocMemCache):
+    """`LocMemCache` (без Redis), который сообщает попадания и промахи в метрики запроса."""
+
+    _missing = object()
+
+    def get(self, key, default=None, version=None):
+        # `get_many`, `has_key` и `get_or_set` базового класса тоже идут через `get`.
+        value = super().get(key, self._missing, version)
+        if value is self._missing:
+            record_cache(misses=1)
+            return default
+        record_cache(hits=1)
+        return value
@@ -0,0 +1,46 @@
+"""
+Валидаторы для условных запросов (ETag / Last-Modified) по заметкам.
+
+Версия заметки - `Note.version`: `changed_at` (любое изменение, включая копии картинки и теги),
+для старых заметок - `mod_time` или `created_at`.
+Она читается отдельным легким запросом без колонки `content`,
+поэтому на ответ 304 не тратится загрузка и рендер всей заметки.
+"""
+import hashlib
+from datetime import datetime
+
+from django.core.exceptions import ValidationError
+
+from .models import Note
+
+
+def make_etag(*parts) -> str:
+    return '"' + hashlib.md5("|".join(str(part) for part in parts).encode()).hexdigest() + '"'
+
+
+def get_note_version(request, note_uuid) -> datetime | None:
+    """Время последнего изменения заметки. Результат запоминается на время запроса."""
+    cache: dict = request.__dict__.setdefault("_note_versions", {})
+    key = str(note_uuid)
+    if key not in cache:
+        try:
+            row = Note.objects.filter(uuid=note_uuid).values_list("changed_at", "mod_time", "created_at").first()
+        except ValidationError:  # Неправильный UUID.
+            row = None
+        cache[key] = next(value for value in row if value is not None) if row else None
+    return cache[key]
+
+
+# Функции для декоратора `django.views.decorators.http.condition`.
+
+def note_etag(request, note_uuid, **kwargs) -> str | None:
+    version = get_note_version(request, note_uuid)
+    if version is None:
+        return None
+    # HTML страница зависит от пользователя (кнопки владельца, меню).
+    user_id = request.user.pk if request.user.is_authenticated else ""
+    return make_etag(note_uuid, version.isoformat(), user_id)
+
+
+def note_last_modified(request, note_uuid, **kwargs) -> datetime | None:
+    return get_note_version(request, note_uuid)
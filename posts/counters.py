@@ -0,0 +1,105 @@
+"""
+Денормализованные счетчики заметок.
+
+* `UserNoteCounter` - кол-во заметок пользователя (админка);
+* `TagNoteCounter` - кол-во заметок с тегом (API тегов);
+* `UserTagCounter` - кол-во заметок пользователя с тегом (теги в профиле).
+
+Счетчики меняются сигналами `Note` (`posts/models.py`) в одной транзакции с записью заметки
+(`Note.save`, удаление и `tags.add/remove` выполняются в `transaction.atomic`), на страницах читаются готовые значения вместо `COUNT` / `DISTINCT` на каждый запрос.
+Изменения в обход сигналов (`QuerySet.update`, сырой SQL) исправляет команда `reconcile_counters`.
+"""
+from collections import Counter
+from functools import reduce
+from operator import or_
+
+from django.db import models, transaction
+from django.db.models import F, Q
+
+from .models import Note, TagNoteCounter, UserNoteCounter, UserTagCounter
+
+
+def _change(model: type[models.Model], keys: list[dict], delta: int) -> None:
+    """Прибавить `delta` к счетчикам с ключами `keys`, создав недостающие строки."""
+    if not keys or not delta:
+        return
+    with transaction.atomic(savepoint=False):
+        if delta > 0:
+            # INSERT ... ON CONFLICT DO NOTHING, затем атомарный UPDATE - без гонок между запросами.
+            model.objects.bulk_create([model(**key) for key in keys], ignore_conflicts=True)
+        model.objects.filter(_keys_filter(keys)).update(note_count=F("note_count") + delta)
+
+
+def _keys_filter(keys: list[dict]) -> Q:
+    """Условие на строки с ключами `keys`: `IN` по последнему полю для каждого значения остальных."""
+    *first_fields, last_field = keys[0]
+    groups: dict[tuple, list] = {}
+    for key in keys:
+        groups.setdefault(tuple(key[field] for field in first_fields), []).append(key[last_field])
+    return reduce(or_, (
+        Q(**dict(zip(first_fields, first)), **{f"{last_field}__in": values}) for first, values in groups.items()
+    ))
+
+
+def _change_grouped(model: type[models.Model], counts: Counter, fields: tuple[str, ...], delta: int) -> None:
+    """Прибавить `count * delta` к каждому счетчику, одинаковые изменения - одним запросом."""
+    groups: dict[int, list[dict]] = {}
+    for key, count in counts.items():
+        groups.setdefault(count, []).append(dict(zip(fields, key)))
+    for count, keys in groups.items():
+        _change(model, keys, count * delta)
+
+
+def change_user_notes(user_id: int, delta: int) -> None:
+    _change(UserNoteCounter, [{"user_id": user_id}], delta)
+
+
+def change_tag_notes(pairs: list[tuple[int, int]], delta: int) -> None:
+    """Изменить счетчики тегов для связей (пользователь, тег) на `delta` каждую."""
+    if not pairs:
+        return
+    with transaction.atomic(savepoint=False):
+        _change_grouped(TagNoteCounter, Counter((tag_id,) for _, tag_id in pairs), ("tag_id",), delta)
+        _change_grouped(UserTagCounter, Counter(pairs), ("user_id", "tag_id"), delta)
+
+
+def add_notes(user_ids: list[int], pairs: list[tuple[int, int]]) -> None:
+    """Учесть заметки, добавленные в обход сигналов (`bulk_create`, `COPY`): владельцы и связи (пользователь, тег)."""
+    with transaction.atomic(savepoint=False):
+        _change_grouped(UserNoteCounter, Counter((user_id,) for user_id in user_ids), ("user_id",), 1)
+        change_tag_notes(pairs, 1)
+
+
+def move_note(note: Note, old_user_id: int) -> None:
+    """Заметку передали другому пользователю."""
+    tag_ids = list(note.tags.values_list("pk", flat=True))
+    with transaction.atomic(savepoint=False):
+        change_user_notes(old_user_id, -1)
+        change_user_notes(note.user_id, 1)
+        _change(UserTagCounter, [{"user_id": old_user_id, "tag_id": tag_id} for tag_id in tag_ids], -1)
+        _change(UserTagCounter, [{"user_id": note.user_id, "tag_id": tag_id} for tag_id in tag_ids], 1)
+
+
+def get_tag_pairs(instance, reverse: bool, pk_set, through: bool = True) -> list[tuple[int, int]]:
+    """
+    Связи (пользователь, тег) для сигнала `m2m_changed`.
+    `through=True` - только существующие связи (перед удалением), `pk_set=None` - все связи (`clear`).
+    """
+    if not reverse:
+        # `note.tags.add/remove/clear(...)`.
+        if not through:
+            return [(instance.user_id, tag_id) for tag_id in pk_set]
+        tag_ids = Note.tags.through.objects.filter(note=instance)
+        if pk_set is not None:
+            tag_ids = tag_ids.filter(tag_id__in=pk_set)
+        return [(instance.user_id, tag_id) for tag_id in tag_ids.values_list("tag_id", flat=True)]
+
+    # `tag.notes.add/remove/clear(...)`.
+    if not through:
+        user_ids = Note.objects.filter(pk__in=pk_set).values_list("user_id", flat=True)
+    else:
+        links = Note.tags.through.objects.filter(tag=instance)
+        if pk_set is not None:
+            links = links.filter(note_id__in=pk_set)
+        user_ids = links.values_list("note__user_id", flat=True)
+    return [(user_id, instance.pk) for user_id in user_ids]
@@ -0,0 +1,272 @@
+"""
+Чтение с реплик, запись в основную базу.
+
+    DATABASES = {"default": {...}, "replica_1": {...}}
+    DATABASE_ROUTERS = ["posts.db_router.PrimaryReplicaRouter"]
+    DATABASE_REPLICATION = {"REPLICAS": ["replica_1"]}
+    MIDDLEWARE = [..., "posts.db_router.ReplicaRoutingMiddleware", ...]
+
+* На реплики идет только чтение внутри HTTP запроса (`ReplicaRoutingMiddleware`). Команды
+  (воркеры очередей), фоновые потоки и сигналы вне запроса читают с основной базы:
+  они обычно читают то, что только что записано.
+* Запись, чтение внутри `transaction.atomic` и модели из `PRIMARY_APPS` (сессии, черный
+  список токенов) - всегда основная база.
+* После первой записи в запросе все следующие чтения этого запроса идут в основную базу.
+* После POST / PUT / PATCH / DELETE клиент закрепляется за основной базой на `STICKY_SECONDS`:
+  cookie `COOKIE_NAME` (браузер и клиенты с cookie) и ключ в кэше по id пользователя
+  (API клиенты с JWT без cookie). Так пользователь видит свои изменения, пока реплика догоняет.
+* Каждая реплика проверяется в фоновом потоке не чаще раза в `HEALTH_CHECK_INTERVAL` секунд:
+  недоступная или отстающая больше чем на `MAX_LAG` секунд исключается до следующей проверки.
+  Если живых реплик нет, чтение идет в основную базу. Для Postgres у реплик задан `connect_timeout`,
+  чтобы зависшее подключение не держало поток проверки.
+
+Локально: скопируйте файл SQLite базы после `migrate` и добавьте его как реплику:
+
+    DATABASES["replica_1"] = {"ENGINE": "django.db.backends.sqlite3", "NAME": BASE_DIR / "replica.sqlite3"}
+    DATABASE_REPLICATION = {"REPLICAS": ["replica_1"]}
+
+Для Postgres реплики задаются переменной `DATABASE_REPLICA_HOSTS` (см. `project/settings.py`).
+Миграции применяются только к основной базе.
+"""
+import contextvars
+import logging
+import random
+import threading
+import time
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "REPLICAS": [],
+    "STICKY_SECONDS": 10,
+    "MAX_LAG": 5.0,
+    "HEALTH_CHECK_INTERVAL": 5.0,
+    "PRIMARY_APPS": ["sessions", "token_blacklist"],
+    "COOKIE_NAME": "primary_until",
+}
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS", "TRACE")
+
+# Отставание реплики Postgres в секундах. Если все полученное WAL уже применено, отставания нет,
+# даже если последняя транзакция была давно (на основной базе нет записи).
+POSTGRES_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+
+def get_config() -> dict:
+    return {**DEFAULTS, **getattr(settings, "DATABASE_REPLICATION", {})}
+
+
+# Состояние запроса.
+
+@dataclass
+class RoutingState:
+    pinned: bool = False
+
+
+_current: contextvars.ContextVar[RoutingState | None] = contextvars.ContextVar("db_routing", default=None)
+
+
+def pin_to_primary() -> None:
+    """Остаток текущего запроса читать с основной базы."""
+    state = _current.get()
+    if state is not None:
+        state.pinned = True
+
+
+def primary_key_for(user_id) -> str:
+    return f"db-primary:{user_id}"
+
+
+# Проверка реплик.
+
+@dataclass
+class ReplicaStatus:
+    healthy: bool
+    lag: float | None
+    checked_at: float
+
+
+def replica_lag(alias: str) -> float:
+    db_connection = connections[alias]
+    # Проверка не относится к запросу: не попадает в бюджет запросов и метрики.
+    wrappers, db_connection.execute_wrappers = db_connection.execute_wrappers, []
+    try:
+        with db_connection.cursor() as cursor:
+            if db_connection.vendor == "postgresql":
+                cursor.execute(POSTGRES_LAG_SQL)
+                return float(cursor.fetchone()[0])
+            cursor.execute("SELECT 1")
+            return 0.0
+    finally:
+        db_connection.execute_wrappers = wrappers
+
+
+class ReplicaMonitor:
+    """
+    Состояние реплик в процессе. Проверка идет в фоновом потоке не чаще раза в
+    `HEALTH_CHECK_INTERVAL` секунд, запрос получает последний известный результат и не ждет
+    подключения к недоступной реплике. Пока реплика ни разу не проверена, чтение идет в основную базу.
+    """
+
+    def __init__(self):
+        self._statuses: dict[str, ReplicaStatus] = {}
+        self._lock = threading.Lock()
+        self._checking = False
+
+    def healthy_replicas(self, config: dict) -> list[str]:
+        now = time.monotonic()
+        healthy = []
+        stale = []
+        for alias in config["REPLICAS"]:
+            status = self._statuses.get(alias)
+            if status is None or now - status.checked_at >= config["HEALTH_CHECK_INTERVAL"]:
+                stale.append(alias)
+            if status is not None and status.healthy:
+                healthy.append(alias)
+        if stale:
+            self._schedule_check(stale, config)
+        return healthy
+
+    def _schedule_check(self, aliases: list[str], config: dict) -> None:
+        with self._lock:
+            if self._checking:
+                return
+            self._checking = True
+        threading.Thread(
+            target=self._check_in_background, args=(aliases, config), name="replica-monitor", daemon=True,
+        ).start()
+
+    def _check_in_background(self, aliases: list[str], config: dict) -> None:
+        try:
+            for alias in aliases:
+                self.check(alias, config)
+        finally:
+            self._checking = False
+            for alias in aliases:
+                connections[alias].close()
+
+    def check(self, alias: str, config: dict) -> ReplicaStatus:
+        """Проверить реплику сейчас (в текущем потоке) и запомнить результат."""
+        try:
+            lag = replica_lag(alias)
+        except DatabaseError as error:
+            connections[alias].close()
+            logger.warning("Replica %s is unavailable: %s", alias, error)
+            status = ReplicaStatus(False, None, time.monotonic())
+        else:
+            status = ReplicaStatus(lag <= config["MAX_LAG"], lag, time.monotonic())
+            if not status.healthy:
+                logger.warning("Replica %s lags %.1fs behind, reading from primary", alias, lag)
+        self._statuses[alias] = status
+        return status
+
+    def statuses(self) -> dict[str, ReplicaStatus]:
+        return dict(self._statuses)
+
+    def reset(self) -> None:
+        self._statuses.clear()
+
+
+monitor = ReplicaMonitor()
+
+
+# Роутер и middleware.
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _current.get()
+        if state is None or state.pinned:
+            return DEFAULT_DB_ALIAS
+        config = get_config()
+        if model._meta.app_label in config["PRIMARY_APPS"] or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        replicas = monitor.healthy_replicas(config)
+        return random.choice(replicas) if replicas else DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        # Дальше в этом запросе читаем записанное из основной базы.
+        pin_to_primary()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *get_config()["REPLICAS"]}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaRoutingMiddleware:
+    """Ставится после `AuthenticationMiddleware`."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        config = get_config()
+        if not config["REPLICAS"]:
+            return self.get_response(request)
+
+        state = RoutingState(pinned=self._is_pinned(request, config))
+        token = _current.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+
+        if request.method not in SAFE_METHODS:
+            self._pin(request, response, config)
+        return response
+
+    def _is_pinned(self, request, config: dict) -> bool:
+        try:
+            if float(request.COOKIES.get(config["COOKIE_NAME"], 0)) > time.time():
+                return True
+        except ValueError:
+            pass
+        user_id = _request_user_id(request)
+        return user_id is not None and cache.get(primary_key_for(user_id)) is not None
+
+    def _pin(self, request, response, config: dict) -> None:
+        seconds = config["STICKY_SECONDS"]
+        response.set_cookie(
+            config["COOKIE_NAME"], f"{time.time() + seconds:.0f}", max_age=seconds, httponly=True, samesite="Lax",
+        )
+        # DRF выставляет пользователя из JWT и в `request` Django.
+        user = getattr(request, "user", None)
+        if user is not None and user.is_authenticated:
+            cache.set(primary_key_for(user.pk), 1, timeout=seconds)
+
+
+def _request_user_id(request):
+    """id пользователя без запросов к базе: из сессии или из JWT (без проверки подписи -
+    от него зависит только выбор базы)."""
+    user_id = request.session.get(SESSION_KEY) if hasattr(request, "session") else None
+    if user_id is not None:
+        return user_id
+
+    header = request.headers.get("Authorization", "")
+    if not header.startswith("Bearer "):
+        return None
+    from rest_framework_simplejwt.exceptions import TokenError
+    from rest_framework_simplejwt.settings import api_settings
+    from rest_framework_simplejwt.tokens import UntypedToken
+
+    try:
+        return UntypedToken(header.removeprefix("Bearer "), verify=False).get(api_settings.USER_ID_CLAIM)
+    except TokenError:
+        return None
@@ -1,10 +1,12 @@
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.contrib.auth.tokens import default_token_generator
 from django.utils.encoding import force_bytes
 from django.utils.http import urlsafe_base64_encode
 from django.contrib.sites.shortcuts import get_current_site
 from django.template.loader import render_to_string
-from django.core.mail import EmailMultiAlternatives
+
+from .models import OutboxEmail
 
 
 class BaseEmailSender:
@@ -26,13 +28,17 @@ class BaseEmailSender:
             raise NotImplemented("Укажите тему письма в атрибуте класса")
         return self.subject
 
-    def send_mail(self):
-        mail = EmailMultiAlternatives(
+    def send_mail(self) -> OutboxEmail:
+        """
+        Письмо не отправляется во время запроса, а сохраняется в очередь `OutboxEmail`.
+        Отправляет его команда `python manage.py send_outbox`.
+        """
+        return OutboxEmail.objects.create(
             subject=self.get_subject() + " на сайте " + self._get_domain(),
-            to=[self._user.email]
+            from_email=settings.DEFAULT_FROM_EMAIL,
+            to=[self._user.email],
+            html_body=self._get_mail_body(),
         )
-        mail.attach_alternative(self._get_mail_body(), "text/html")
-        mail.send()
 
     def _get_mail_body(self) -> str:
         context = {
@@ -0,0 +1,60 @@
+"""
+Кэш HTML карточек заметок для `posts-lists.html`.
+
+Карточка кэшируется по `note.uuid`. Вместе с HTML хранится отметка версии
+(`Note.version`), поэтому измененная заметка не покажет старую карточку,
+даже если сигнал не сработал (например после `QuerySet.update`).
+Все карточки страницы читаются одним `get_many` и записываются одним `set_many`.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from django.utils.translation import get_language
+
+from .models import Note
+
+
+CARD_TEMPLATE = "note-card.html"
+
+
+def card_cache_key(note_uuid) -> str:
+    return f"note-card:{note_uuid}"
+
+
+def _card_version(note: Note) -> str:
+    return f"{note.version.isoformat()}|{get_language()}"
+
+
+def render_note_cards(notes) -> str:
+    notes = list(notes)
+    # Результаты поиска содержат подсветку под конкретный запрос, их не кэшируем.
+    cacheable = [note for note in notes if getattr(note, "headline", None) is None]
+
+    cached: dict = cache.get_many([card_cache_key(note.uuid) for note in cacheable])
+
+    cards: list[str] = []
+    missing: dict = {}
+    for note in notes:
+        key = card_cache_key(note.uuid)
+        version = _card_version(note)
+        entry = cached.get(key)
+        if entry is not None and entry["version"] == version:
+            cards.append(entry["html"])
+            continue
+
+        html = render_to_string(CARD_TEMPLATE, {"note": note})
+        cards.append(html)
+        if getattr(note, "headline", None) is None:
+            missing[key] = {"version": version, "html": html}
+
+    if missing:
+        cache.set_many(missing, timeout=getattr(settings, "NOTE_CARD_CACHE_TIMEOUT", 60 * 60 * 24))
+
+    return mark_safe("".join(cards))
+
+
+def invalidate_note_cards(note_uuids) -> None:
+    keys = [card_cache_key(note_uuid) for note_uuid in note_uuids]
+    if keys:
+        cache.delete_many(keys)
@@ -1,38 +1,242 @@
+"""
+История просмотренных заметок.
 
+Хранилище выбирается настройкой `HISTORY["BACKEND"]`:
+
+* `RedisHistoryBackend` - отсортированное множество (ZSET) на владельца,
+  оценка - время просмотра. Вставка без дублей за O(log n), лишнее обрезается;
+* `DatabaseHistoryBackend` - таблица `HistoryEntry` для авторизованных пользователей,
+  история доступна с любого устройства;
+* `SessionHistoryBackend` - сессия, для анонимных пользователей без Redis. Сессия сохраняется,
+  только если история изменилась (повторный просмотр последней заметки ее не пишет);
+* `MemoryHistoryBackend` - память процесса (у каждого воркера своя история), для разработки.
+
+По умолчанию ("auto"): Redis, если он настроен, иначе база для авторизованных
+пользователей и сессия для анонимных. Если выбран бэкенд только для авторизованных
+(`DatabaseHistoryBackend`), анонимные пользователи получают бэкенд по умолчанию.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
 from django.core.handlers.wsgi import WSGIRequest
-from django.shortcuts import render
+from django.db.models import Case, QuerySet, When
+from django.utils import timezone
+from django.utils.module_loading import import_string
 
-from .models import Note
+from .models import HistoryEntry, Note
 
 
-class HistoryService:
+def get_history_config() -> dict:
+    return {"BACKEND": "auto", "LIMIT": 20, **getattr(settings, "HISTORY", {})}
 
-    def __init__(self, request: WSGIRequest):
-        self._session = request.session
 
-        # Если у сессии пользователя нет ключа `favorites`, то мы его создаем
-        self._session.setdefault("history", [])
+class BaseHistoryBackend:
+    supports_anonymous = True
+
+    def __init__(self, limit: int):
+        self.limit = limit
+
+    def add(self, request: WSGIRequest, note_uuid: str) -> None:
+        raise NotImplementedError
+
+    def remove(self, request: WSGIRequest, note_uuid: str) -> None:
+        raise NotImplementedError
+
+    def get_ids(self, request: WSGIRequest) -> list[str]:
+        """UUID заметок от последней просмотренной к первой."""
+        raise NotImplementedError
+
+    def get_notes(self, request: WSGIRequest) -> QuerySet:
+        """Заметки в порядке просмотра (последняя первая) одним запросом."""
+        ids = self.get_ids(request)
+        if not ids:
+            return Note.objects.none()
+        order = Case(*[When(uuid=note_uuid, then=position) for position, note_uuid in enumerate(ids)])
+        return Note.objects.filter(uuid__in=ids).order_by(order)
+
+    @staticmethod
+    def get_owner(request: WSGIRequest, create: bool = False) -> str | None:
+        """Ключ владельца истории: пользователь или (для анонимных) ключ сессии."""
+        if request.user.is_authenticated:
+            return f"user:{request.user.pk}"
+        if request.session.session_key is None and create:
+            request.session.save()
+        if request.session.session_key is None:
+            return None
+        return f"session:{request.session.session_key}"
+
+
+class DatabaseHistoryBackend(BaseHistoryBackend):
+    supports_anonymous = False
+    # Лишние записи удаляются пачкой, когда их больше `trim_slack`, а не при каждом просмотре.
+    # Читается история всегда не длиннее `limit`.
+    trim_slack = 20
+
+    def add(self, request: WSGIRequest, note_uuid: str) -> None:
+        user = request.user
+        viewed_at = timezone.now()
+        # Повторный просмотр - один UPDATE.
+        if HistoryEntry.objects.filter(user=user, note_id=note_uuid).update(viewed_at=viewed_at):
+            return
+        # ON CONFLICT - если ту же заметку параллельно добавил другой запрос.
+        HistoryEntry.objects.bulk_create(
+            [HistoryEntry(user=user, note_id=note_uuid, viewed_at=viewed_at)],
+            update_conflicts=True,
+            unique_fields=["user", "note"],
+            update_fields=["viewed_at"],
+        )
+        stale = list(
+            HistoryEntry.objects.filter(user=user).order_by("-viewed_at").values_list("pk", flat=True)[self.limit:]
+        )
+        if len(stale) > self.trim_slack:
+            HistoryEntry.objects.filter(pk__in=stale).delete()
+
+    def remove(self, request: WSGIRequest, note_uuid: str) -> None:
+        HistoryEntry.objects.filter(user=request.user, note_id=note_uuid).delete()
+
+    def get_ids(self, request: WSGIRequest) -> list[str]:
+        return [
+            str(note_uuid) for note_uuid in
+            HistoryEntry.objects.filter(user=request.user)
+            .order_by("-viewed_at").values_list("note_id", flat=True)[:self.limit]
+        ]
+
+    def get_notes(self, request: WSGIRequest) -> QuerySet:
+        return (
+            Note.objects.filter(history_entries__user=request.user)
+            .order_by("-history_entries__viewed_at")[:self.limit]
+        )
+
+
+class RedisHistoryBackend(BaseHistoryBackend):
+    _clients: dict = {}  # Один пул соединений на процесс для каждого URL.
+
+    def __init__(self, limit: int, url: str | None = None):
+        import redis
+
+        super().__init__(limit)
+        url = url or settings.REDIS_CACHE
+        if url not in self._clients:
+            self._clients[url] = redis.Redis.from_url(url)
+        self._client = self._clients[url]
+        self._ttl = settings.SESSION_COOKIE_AGE
+
+    def _key(self, owner: str) -> str:
+        return f"{settings.CACHES['default'].get('KEY_PREFIX', '')}history:{owner}"
+
+    def add(self, request: WSGIRequest, note_uuid: str) -> None:
+        key = self._key(self.get_owner(request, create=True))
+        pipeline = self._client.pipeline(transaction=False)
+        pipeline.zadd(key, {str(note_uuid): time.time()})
+        pipeline.zremrangebyrank(key, 0, -self.limit - 1)
+        pipeline.expire(key, self._ttl)
+        pipeline.execute()
 
-        # Если вдруг это был не список, то задаем его явно.
-        if not isinstance(self._session["history"], list):
-            self._session["history"] = []
+    def remove(self, request: WSGIRequest, note_uuid: str) -> None:
+        owner = self.get_owner(request)
+        if owner is not None:
+            self._client.zrem(self._key(owner), str(note_uuid))
+
+    def get_ids(self, request: WSGIRequest) -> list[str]:
+        owner = self.get_owner(request)
+        if owner is None:
+            return []
+        return [value.decode() for value in self._client.zrevrange(self._key(owner), 0, self.limit - 1)]
+
+
+class SessionHistoryBackend(BaseHistoryBackend):
+    """История в сессии: общая для всех воркеров без Redis."""
+
+    session_key = "history"
+
+    def add(self, request: WSGIRequest, note_uuid: str) -> None:
+        note_uuid = str(note_uuid)
+        history = self.get_ids(request)
+        if history[:1] == [note_uuid]:
+            return  # Не перезаписываем сессию, если история не изменилась.
+        request.session[self.session_key] = [note_uuid, *(uuid for uuid in history if uuid != note_uuid)][:self.limit]
+
+    def remove(self, request: WSGIRequest, note_uuid: str) -> None:
+        history = self.get_ids(request)
+        if str(note_uuid) in history:
+            history.remove(str(note_uuid))
+            request.session[self.session_key] = history
+
+    def get_ids(self, request: WSGIRequest) -> list[str]:
+        history = request.session.get(self.session_key, [])
+        # Старый формат сессии или мусор - начинаем историю заново.
+        return list(history[:self.limit]) if isinstance(history, list) else []
+
+
+class MemoryHistoryBackend(BaseHistoryBackend):
+    """
+    История в памяти процесса. Общая для всех запросов воркера, ограничена `max_owners` владельцами.
+    У каждого воркера gunicorn своя история, поэтому только для разработки и тестов.
+    """
+
+    max_owners = 10000
+
+    _histories: "OrderedDict[str, OrderedDict[str, None]]" = OrderedDict()
+    _lock = threading.Lock()
+
+    def add(self, request: WSGIRequest, note_uuid: str) -> None:
+        owner = self.get_owner(request, create=True)
+        with self._lock:
+            history = self._histories.setdefault(owner, OrderedDict())
+            self._histories.move_to_end(owner)
+            history[str(note_uuid)] = None
+            history.move_to_end(str(note_uuid))
+            if len(history) > self.limit:
+                history.popitem(last=False)
+            if len(self._histories) > self.max_owners:
+                self._histories.popitem(last=False)
+
+    def remove(self, request: WSGIRequest, note_uuid: str) -> None:
+        owner = self.get_owner(request)
+        with self._lock:
+            self._histories.get(owner, {}).pop(str(note_uuid), None)
+
+    def get_ids(self, request: WSGIRequest) -> list[str]:
+        owner = self.get_owner(request)
+        with self._lock:
+            return list(reversed(self._histories.get(owner, {})))
+
+
+def get_history_backend(request: WSGIRequest) -> BaseHistoryBackend:
+    config = get_history_config()
+    if config["BACKEND"] != "auto":
+        backend = import_string(config["BACKEND"])(config["LIMIT"])
+        if backend.supports_anonymous or request.user.is_authenticated:
+            return backend
+    if getattr(settings, "REDIS_CACHE", None):
+        return RedisHistoryBackend(config["LIMIT"])
+    if request.user.is_authenticated:
+        return DatabaseHistoryBackend(config["LIMIT"])
+    return SessionHistoryBackend(config["LIMIT"])
+
+
+class HistoryService:
+
+    def __init__(self, request: WSGIRequest):
+        self._request = request
+        self._backend = get_history_backend(request)
 
     def add_to_history(self, note: Note) -> None:
-        self._session["history"].append(str(note.uuid))
-        self.remove_from_history(note.uuid)
-        self._session.save()
+        self._backend.add(self._request, note.uuid)
 
-    def remove_from_history(self, note_uuid: int) -> None:
-        history: list = self._session["history"]
-        if len(history) > 20:
-            history.pop(0)
-        if note_uuid in history:
-            history.remove(note_uuid)
+    def remove_from_history(self, note_uuid) -> None:
+        self._backend.remove(self._request, note_uuid)
 
     @property
-    def history_ids(self) -> list[int]:
-        return self._session["history"]
+    def history_ids(self) -> list[str]:
+        """UUID заметок от последней просмотренной к первой."""
+        return self._backend.get_ids(self._request)
+
+    def get_notes(self) -> QuerySet:
+        return self._backend.get_notes(self._request)
 
 
-def favorite_service_preprocessor(request: WSGIRequest) -> dict[str, list[int]]:
+def favorite_service_preprocessor(request: WSGIRequest) -> dict[str, list[str]]:
     return {"history_ids": HistoryService(request).history_ids}
@@ -0,0 +1,139 @@
+"""
+Уменьшенные копии картинок заметок (`Note.image`).
+
+Для каждой картинки создаются копии нескольких ширин в исходном формате (JPEG или PNG)
+и в WebP. Файлы сохраняются в хранилище картинок заметок (`posts/storage.py`).
+Информация о копиях хранится в `Note.image_variants`:
+
+    {
+        "source": "cas/ab/cd/abcd...jpg",
+        "variants": [{"width": 160, "fallback": "cas/12/34/1234...jpg", "webp": "cas/56/78/5678...webp"}, ...]
+    }
+
+Копии создаются не в процессах веб-сервера: при сохранении заметки в той же транзакции
+записывается задача `ImageVariantTask`, ее выполняет команда `generate_image_variants --loop`
+(отдельный воркер, как `send_outbox`). Задача не теряется при перезапуске сервера,
+а обработка картинок не отнимает у запросов процессор и память.
+Пока копий нет, шаблоны показывают оригинал.
+"""
+import io
+from pathlib import PurePosixPath
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from .models import ImageVariantTask, Note
+
+
+DEFAULTS = {
+    "WORKERS": 2,
+    "WIDTHS": [160, 320, 640, 1280],
+    "QUALITY": 80,
+}
+
+
+def get_config() -> dict:
+    return {**DEFAULTS, **getattr(settings, "IMAGE_VARIANTS", {})}
+
+
+def variants_are_current(note: Note) -> bool:
+    if not note.image:
+        return not note.image_variants
+    return note.image_variants.get("source") == note.image.name
+
+
+def schedule_variants(notes: list[Note]) -> None:
+    """
+    Поставить создание копий в очередь (в текущей транзакции, одним запросом).
+    Задача, которая уже есть (в том числе исчерпавшая попытки), начинается заново.
+    """
+    now = timezone.now()
+    ImageVariantTask.objects.bulk_create(
+        [ImageVariantTask(note_id=note.uuid, next_attempt_at=now) for note in notes],
+        update_conflicts=True,
+        unique_fields=["note"],
+        update_fields=["attempts", "next_attempt_at", "last_error"],
+    )
+
+
+def generate_variants(note: Note) -> dict:
+    """Создать копии картинки заметки и сохранить их список в `note.image_variants`."""
+    config = get_config()
+    old_variants = note.image_variants
+    source_name = note.image.name
+    storage = note.image.storage
+
+    with storage.open(source_name, "rb") as file:
+        original = ImageOps.exif_transpose(Image.open(file))
+        original.load()
+
+    has_alpha = original.mode in ("RGBA", "LA", "P")
+    fallback_format, fallback_ext = ("PNG", "png") if has_alpha else ("JPEG", "jpg")
+    image = original.convert("RGBA" if has_alpha else "RGB")
+
+    stem = PurePosixPath(source_name)
+    widths = [width for width in config["WIDTHS"] if width < image.width] or [min(config["WIDTHS"])]
+
+    variants = []
+    for width in widths:
+        resized = image.copy()
+        resized.thumbnail((width, width * 10), Image.LANCZOS)
+        variant = {"width": resized.width}
+        for key, image_format, ext in (("fallback", fallback_format, fallback_ext), ("webp", "WEBP", "webp")):
+            buffer = io.BytesIO()
+            resized.save(buffer, image_format, quality=config["QUALITY"], optimize=True)
+            name = str(stem.with_name(f"{stem.stem}.w{width}.{ext}"))
+            variant[key] = storage.save(name, ContentFile(buffer.getvalue()))
+        variants.append(variant)
+
+    image_variants = {"source": source_name, "variants": variants}
+    # `update` без сигналов и только если картинку не успели заменить.
+    # `changed_at` - новая версия заметки: закэшированные страницы без `<picture>` устаревают.
+    updated = Note.objects.filter(uuid=note.uuid, image=source_name).update(
+        image_variants=image_variants, changed_at=timezone.now(),
+    )
+    if not updated:
+        delete_variant_files(image_variants)
+        return note.image_variants
+
+    # Хранилище считает ссылки на файлы, поэтому старые копии освобождаем всегда.
+    delete_variant_files(old_variants)
+    note.image_variants = image_variants
+    return image_variants
+
+
+def variant_file_names(image_variants: dict) -> list[str]:
+    return [
+        variant[key]
+        for variant in image_variants.get("variants", [])
+        for key in ("fallback", "webp")
+        if variant.get(key)
+    ]
+
+
+def delete_variant_files(image_variants: dict) -> None:
+    storage = Note._meta.get_field("image").storage
+    for name in variant_file_names(image_variants):
+        storage.delete(name)
+
+
+def get_variant_urls(note: Note, build_url=None) -> dict | None:
+    """
+    URL копий для `srcset`, если они созданы для текущей картинки.
+    `build_url` - функция для абсолютных URL (например `request.build_absolute_uri`).
+    """
+    if not note.image or not variants_are_current(note):
+        return None
+    variants = note.image_variants["variants"]
+    storage = note.image.storage
+
+    def url(name: str) -> str:
+        return build_url(storage.url(name)) if build_url else storage.url(name)
+
+    return {
+        "thumbnail": url(variants[0]["fallback"]),
+        "srcset": ", ".join(f"{url(v['fallback'])} {v['width']}w" for v in variants),
+        "webp_srcset": ", ".join(f"{url(v['webp'])} {v['width']}w" for v in variants),
+    }
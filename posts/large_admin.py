@@ -0,0 +1,73 @@
+"""
+Режим админки для больших таблиц (`ADMIN_LARGE_TABLES["ENABLED"]`).
+
+* Кол-во строк всей таблицы берется из статистики Postgres (`pg_class.reltuples`),
+  а не точным `COUNT(*)`. Если оценка меньше `ESTIMATE_THRESHOLD`, считается точно.
+* Отфильтрованный список (фильтры, поиск) считается точно, но не дальше `COUNT_LIMIT` строк
+  (`COUNT(*)` по подзапросу с `LIMIT`). Оценка `EXPLAIN` для фильтров и поиска ошибается в разы,
+  из-за нее админка показывала пустые или недостающие страницы. Если строк больше, показывается
+  `COUNT_LIMIT` и столько же строк по страницам - остальные видны после уточнения фильтра.
+* Второй `COUNT(*)` по всей таблице ("показать все") отключен.
+* Поиск заметок идет через полнотекстовый индекс (`posts/search.py`), а не `icontains` по всей таблице.
+"""
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import QuerySet
+from django.utils.functional import cached_property
+
+
+DEFAULTS = {
+    "ENABLED": False,
+    "ESTIMATE_THRESHOLD": 10000,
+    "COUNT_LIMIT": 10000,
+}
+
+
+def get_config() -> dict:
+    return {**DEFAULTS, **getattr(settings, "ADMIN_LARGE_TABLES", {})}
+
+
+def estimate_count(queryset: QuerySet) -> int | None:
+    """Оценка кол-ва строк всей таблицы по статистике Postgres (None - оценка недоступна)."""
+    connection = connections[queryset.db]
+    if connection.vendor != "postgresql":
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass", [queryset.model._meta.db_table])
+        row = cursor.fetchone()
+    # -1 - таблицу еще ни разу не анализировали.
+    if row is not None and row[0] >= 0:
+        return row[0]
+    return None
+
+
+def is_unfiltered(queryset: QuerySet) -> bool:
+    query = queryset.query
+    return not query.where and not query.distinct and not query.combinator
+
+
+class EstimatedCountPaginator(Paginator):
+    @cached_property
+    def count(self) -> int:
+        if not isinstance(self.object_list, QuerySet):
+            return super().count
+        config = get_config()
+        if is_unfiltered(self.object_list):
+            estimate = estimate_count(self.object_list)
+            if estimate is not None and estimate >= config["ESTIMATE_THRESHOLD"]:
+                return estimate
+            return super().count
+        # Срез превращает `count()` в `SELECT COUNT(*) FROM (... LIMIT n)`.
+        return self.object_list.order_by()[:config["COUNT_LIMIT"]].count()
+
+
+class LargeTableAdminMixin:
+    """Примесь для `ModelAdmin`: в режиме больших таблиц - оценка кол-ва строк вместо `COUNT(*)`."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if get_config()["ENABLED"]:
+            self.paginator = EstimatedCountPaginator
+            self.show_full_result_count = False
+            self.date_hierarchy = None
@@ -1,17 +1,35 @@
+import time
 
-from datetime import datetime
+from .activity_log import get_writer
 
 
 class SimpleMiddleware:
+    """
+    Журнал активности пользователей.
+    Запись в файл выполняет фоновый поток (`posts/activity_log.py`),
+    запрос только кладет строку JSON в очередь.
+    """
+
     def __init__(self, get_response):
         self.get_response = get_response
+        self.writer = get_writer()
 
     def __call__(self, request):
+        started = time.perf_counter()
         response = self.get_response(request)
-        log_string = datetime.now().strftime('%d:%m:%Y %H:%M') + " | " + str(
-            request.user) + " | " + "URL=" + request.get_full_path() + "\n"
+        latency_ms = (time.perf_counter() - started) * 1000
+
+        user = getattr(request, "user", None)
+        is_authenticated = user is not None and user.is_authenticated
 
-        with open("usersActivity.log", "a", encoding="utf-8") as file:
-            file.write(log_string)
+        self.writer.log({
+            "ts": time.time(),
+            "method": request.method,
+            "url": request.get_full_path(),
+            "status": response.status_code,
+            "latency_ms": round(latency_ms, 2),
+            "user_id": user.pk if is_authenticated else None,
+            "user": user.get_username() if is_authenticated else None,
+        })
 
         return response
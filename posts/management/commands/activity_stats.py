@@ -0,0 +1,360 @@
+"""
+Статистика по журналу активности (`usersActivity.log`) за один проход.
+
+    python manage.py activity_stats
+    python manage.py activity_stats --rotated --top 20
+    python manage.py activity_stats --state activity_stats.json   # дочитать новые записи, итоги накопительные
+    python manage.py activity_stats --url /api/ --user alice      # только записи alice по URL, начинающимся с /api/
+
+Память ограничена: топ URL, пользователей и пар (пользователь, URL) считаются приближенно (lossy counting),
+уникальные пользователи - через HyperLogLog, запросы в минуту - за последние `--minutes` минут.
+
+Состояние (`--state`) хранит смещение для каждого файла журнала и сами счетчики, поэтому
+каждый запуск читает только новые записи, а показывает итоги с первого запуска (`since`).
+Файл узнается по хэшу первой строки: он не меняется при ротации (`log` -> `log.1` -> `log.1.gz`),
+поэтому недочитанный хвост ротированного файла дочитывается, а прочитанное не считается повторно.
+Счетчики в состоянии посчитаны с фильтрами `--url` / `--user` первого запуска, с другими фильтрами
+нужен другой файл состояния.
+"""
+import base64
+import gzip
+import hashlib
+import json
+import math
+import mmap
+import os
+import re
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from posts.activity_log import get_config
+
+
+class HyperLogLog:
+    """Оценка количества уникальных значений. Погрешность ~1.04 / sqrt(2 ** precision)."""
+
+    def __init__(self, precision: int = 14):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+
+    def add(self, value: str) -> None:
+        hashed = int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+        index = hashed >> (64 - self.precision)
+        rest = (hashed << self.precision) & ((1 << 64) - 1)
+        # Позиция первой единицы в оставшихся битах.
+        rank = 64 - rest.bit_length() + 1 if rest else 64 - self.precision + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self) -> int:
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        estimate = alpha * self.size ** 2 / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.size and zeros:
+            # Поправка для маленьких значений (linear counting).
+            estimate = self.size * math.log(self.size / zeros)
+        return round(estimate)
+
+    def to_state(self) -> dict:
+        return {"precision": self.precision, "registers": base64.b64encode(self.registers).decode()}
+
+    @classmethod
+    def from_state(cls, state: dict) -> "HyperLogLog":
+        hll = cls(state["precision"])
+        hll.registers = bytearray(base64.b64decode(state["registers"]))
+        return hll
+
+
+class TopCounter:
+    """
+    Счетчик с ограниченным числом ключей.
+    Когда ключей становится больше `capacity`, редкие ключи отбрасываются.
+    Для частых значений (топ) результат точный или почти точный.
+    """
+
+    def __init__(self, capacity: int = 10000):
+        self.capacity = capacity
+        self.counter = Counter()
+
+    def add(self, key: str | tuple) -> None:
+        self.counter[key] += 1
+        if len(self.counter) > self.capacity * 2:
+            self.counter = Counter(dict(self.counter.most_common(self.capacity)))
+
+    def most_common(self, n: int) -> list[tuple[str | tuple, int]]:
+        return self.counter.most_common(n)
+
+    def to_state(self) -> list:
+        # Ключи-кортежи в JSON становятся списками.
+        return [[list(key) if isinstance(key, tuple) else key, count] for key, count in self.counter.items()]
+
+    @classmethod
+    def from_state(cls, state: list, capacity: int = 10000) -> "TopCounter":
+        counter = cls(capacity)
+        counter.counter = Counter({tuple(key) if isinstance(key, list) else key: count for key, count in state})
+        return counter
+
+
+class RecentCounter:
+    """Счетчик по минутам, хранит только последние `capacity` минут."""
+
+    def __init__(self, capacity: int = 24 * 60):
+        self.capacity = capacity
+        self.counter = Counter()
+
+    def add(self, minute: str) -> None:
+        self.counter[minute] += 1
+        if len(self.counter) > self.capacity * 2:
+            # Минуты в формате `YYYY-MM-DD HH:MM` сортируются как строки.
+            self.counter = Counter(dict(sorted(self.counter.items())[-self.capacity:]))
+
+    def items(self) -> list[tuple[str, int]]:
+        return sorted(self.counter.items())[-self.capacity:]
+
+    def to_state(self) -> dict:
+        return dict(self.items())
+
+    @classmethod
+    def from_state(cls, state: dict, capacity: int = 24 * 60) -> "RecentCounter":
+        counter = cls(capacity)
+        counter.counter = Counter(state)
+        return counter
+
+
+class Aggregates:
+    """Все счетчики отчета. Сохраняются в файл состояния, чтобы итоги были накопительными."""
+
+    def __init__(self, minutes: int, state: dict | None = None):
+        state = state or {}
+        self.total = state.get("total", 0)
+        self.skipped = state.get("skipped", 0)
+        self.urls = TopCounter.from_state(state.get("urls", []))
+        self.users = TopCounter.from_state(state.get("users", []))
+        self.user_urls = TopCounter.from_state(state.get("user_urls", []))
+        self.per_minute = RecentCounter.from_state(state.get("per_minute", {}), minutes)
+        self.unique_users = HyperLogLog.from_state(state["unique_users"]) if "unique_users" in state else HyperLogLog()
+
+    def add(self, minute: str, user: str | None, url: str) -> None:
+        self.total += 1
+        self.urls.add(url)
+        self.per_minute.add(minute)
+        if user:
+            self.users.add(user)
+            self.user_urls.add((user, url))
+            self.unique_users.add(user)
+
+    def to_state(self) -> dict:
+        return {
+            "total": self.total,
+            "skipped": self.skipped,
+            "urls": self.urls.to_state(),
+            "users": self.users.to_state(),
+            "user_urls": self.user_urls.to_state(),
+            "per_minute": self.per_minute.to_state(),
+            "unique_users": self.unique_users.to_state(),
+        }
+
+
+# Старый формат журнала: `03:02:2024 22:49 | username | URL=/create`
+LEGACY_LINE = re.compile(r"^(\d{2}:\d{2}:\d{4} \d{2}:\d{2}) \| (.*?) \| URL=(.*)$")
+
+
+def parse_line(line: bytes) -> tuple[str, str | None, str] | None:
+    """Вернуть (минута, пользователь, URL) или None, если строку не удалось разобрать."""
+    text = line.decode("utf-8", errors="replace").strip()
+    if not text:
+        return None
+
+    if text.startswith("{"):
+        try:
+            record = json.loads(text)
+        except ValueError:
+            return None
+        if "url" not in record:
+            return None  # Служебные записи, например `dropped`.
+        minute = datetime.fromtimestamp(record["ts"], tz=timezone.utc).strftime("%Y-%m-%d %H:%M")
+        user = record.get("user")
+        return minute, user, record["url"]
+
+    match = LEGACY_LINE.match(text)
+    if match is None:
+        return None
+    minute = datetime.strptime(match.group(1), "%d:%m:%Y %H:%M").strftime("%Y-%m-%d %H:%M")
+    user = match.group(2)
+    return minute, None if user == "AnonymousUser" else user, match.group(3)
+
+
+def iter_lines(path: Path, offset: int = 0):
+    """Построчное чтение файла. Возвращает (строка, смещение конца строки); для gzip - в распакованных данных."""
+    if path.suffix == ".gz":
+        with gzip.open(path, "rb") as file:
+            position = 0
+            for line in file:
+                position += len(line)
+                if position > offset and line.endswith(b"\n"):
+                    yield line, position
+        return
+
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if size <= offset:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            position = offset
+            while position < size:
+                end = mapped.find(b"\n", position)
+                if end == -1:
+                    # Незаконченная строка (ее еще дописывают) - прочитаем в следующий раз.
+                    return
+                yield mapped[position:end], end + 1
+                position = end + 1
+
+
+def rotated_segments(path: Path) -> list[Path]:
+    """Ротированные файлы от старых к новым: `log.3.gz`, `log.2.gz`, `log.1.gz`."""
+    segments = []
+    for candidate in path.parent.glob(path.name + ".*"):
+        match = re.fullmatch(re.escape(path.name) + r"\.(\d+)(\.gz)?", candidate.name)
+        if match:
+            segments.append((int(match.group(1)), candidate))
+    return [segment for _, segment in sorted(segments, reverse=True)]
+
+
+def segment_fingerprint(path: Path) -> str | None:
+    """Хэш первой строки файла. None, если первая строка еще не дописана."""
+    opener = gzip.open if path.suffix == ".gz" else open
+    with opener(path, "rb") as file:
+        line = file.readline()
+    if not line.endswith(b"\n"):
+        return None
+    return hashlib.blake2b(line, digest_size=16).hexdigest()
+
+
+class Command(BaseCommand):
+    help = "Статистика по журналу активности пользователей за один проход"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--path", help="Путь к журналу (по умолчанию из settings.ACTIVITY_LOG)")
+        parser.add_argument("--rotated", action="store_true", help="Также прочитать ротированные файлы")
+        parser.add_argument("--state", help="Файл для сохранения смещения и счетчиков между запусками")
+        parser.add_argument("--url", help="Только URL, начинающиеся с этой строки")
+        parser.add_argument("--user", help="Только записи этого пользователя")
+        parser.add_argument("--top", type=int, default=10)
+        parser.add_argument("--minutes", type=int, default=24 * 60, help="Сколько последних минут показывать")
+        parser.add_argument("--json", action="store_true", help="Вывести результат в JSON")
+
+    def handle(self, *args, **options):
+        path = Path(options["path"] or get_config()["PATH"])
+        state_path = Path(options["state"]) if options["state"] else None
+
+        state = self._load_state(state_path)
+        offsets: dict[str, int] = state.get("segments", {})
+        last_run = state.get("updated_at")
+        filters = {"url": options["url"], "user": options["user"]}
+        if state.get("filters", filters) != filters:
+            raise CommandError(
+                f"Счетчики в {state_path} посчитаны с фильтрами {state['filters']}: "
+                "укажите те же фильтры или другой --state"
+            )
+
+        aggregates = Aggregates(options["minutes"], state.get("aggregates"))
+
+        def consume(line: bytes):
+            parsed = parse_line(line)
+            if parsed is None:
+                aggregates.skipped += 1
+                return
+            minute, user, url = parsed
+            if options["url"] and not url.startswith(options["url"]):
+                return
+            if options["user"] and user != options["user"]:
+                return
+            aggregates.add(minute, user, url)
+
+        started_at = time.time()
+        new_offsets: dict[str, int] = {}
+        segments = rotated_segments(path) + ([path] if path.exists() else [])
+        for segment in segments:
+            fingerprint = segment_fingerprint(segment)
+            if fingerprint is None:
+                continue
+            if fingerprint in offsets:
+                # Файл уже читали (возможно, до ротации) - только новые строки.
+                offset = offsets[fingerprint]
+            elif segment == path or options["rotated"] or (last_run is not None and segment.stat().st_mtime > last_run):
+                # Активный файл, явно запрошенные ротированные файлы или файлы, ротированные после прошлого запуска.
+                offset = 0
+            else:
+                continue
+            if segment.suffix != ".gz" and offset > segment.stat().st_size:
+                offset = 0
+            for line, end in iter_lines(segment, offset):
+                consume(line)
+                offset = end
+            new_offsets[fingerprint] = offset
+
+        since = state.get("since", started_at)
+        if state_path is not None:
+            # Удаленные ротацией файлы из состояния выпадают.
+            self._save_state(state_path, {
+                "segments": new_offsets,
+                "updated_at": started_at,
+                "since": since,
+                "filters": filters,
+                "aggregates": aggregates.to_state(),
+            })
+
+        report = {
+            "since": datetime.fromtimestamp(since, tz=timezone.utc).isoformat() if state_path is not None else None,
+            "filters": filters,
+            "total": aggregates.total,
+            "skipped": aggregates.skipped,
+            "unique_users": aggregates.unique_users.count(),
+            "top_urls": aggregates.urls.most_common(options["top"]),
+            "top_users": aggregates.users.most_common(options["top"]),
+            "top_user_urls": [
+                (user, url, count) for (user, url), count in aggregates.user_urls.most_common(options["top"])
+            ],
+            "per_minute": dict(aggregates.per_minute.items()),
+        }
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report, ensure_ascii=False, indent=2))
+            return
+
+        if report["since"]:
+            self.stdout.write(f"С {report['since']} (накопительно по --state)")
+        active_filters = ", ".join(f"--{name} {value}" for name, value in filters.items() if value)
+        if active_filters:
+            self.stdout.write(f"Фильтры: {active_filters}")
+        self.stdout.write(f"Записей: {report['total']} (не разобрано: {report['skipped']})")
+        self.stdout.write(f"Уникальных пользователей (примерно): {report['unique_users']}")
+        self.stdout.write("\nТоп URL:")
+        for url, count in report["top_urls"]:
+            self.stdout.write(f"  {count:>8}  {url}")
+        self.stdout.write("\nТоп пользователей:")
+        for user, count in report["top_users"]:
+            self.stdout.write(f"  {count:>8}  {user}")
+        self.stdout.write("\nТоп пользователей по URL:")
+        for user, url, count in report["top_user_urls"]:
+            self.stdout.write(f"  {count:>8}  {user}  {url}")
+        self.stdout.write("\nЗапросов в минуту:")
+        for minute, count in report["per_minute"].items():
+            self.stdout.write(f"  {minute}  {count}")
+
+    @staticmethod
+    def _load_state(state_path: Path | None) -> dict:
+        if state_path is None or not state_path.exists():
+            return {}
+        return json.loads(state_path.read_text())
+
+    @staticmethod
+    def _save_state(state_path: Path, state: dict) -> None:
+        tmp_path = state_path.with_name(state_path.name + ".tmp")
+        tmp_path.write_text(json.dumps(state))
+        tmp_path.replace(state_path)
@@ -0,0 +1,80 @@
+"""
+Замеры задержки и пропускной способности основных адресов (см. `posts/benchmark.py`).
+
+    python manage.py seed_benchmark --size 100000
+    python manage.py benchmark                                   # в процессе, через test Client
+    python manage.py benchmark --server gunicorn --concurrency 8 # по HTTP к локальному gunicorn
+    python manage.py benchmark --save-baseline                   # сохранить результат как базовый
+    python manage.py benchmark --fail-on-regression              # ошибка, если стало хуже базового
+
+Регрессия - p95 / p99 выросли или пропускная способность упала больше чем на `--threshold`,
+либо адрес стал делать больше SQL запросов.
+"""
+import platform
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from posts import benchmark
+from posts.models import Note
+
+
+class Command(BaseCommand):
+    help = "Замеры производительности страниц и API заметок"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--server", choices=["in-process", "gunicorn"], default="in-process")
+        parser.add_argument("--requests", type=int, default=200, help="Запросов на каждый адрес")
+        parser.add_argument("--warmup", type=int, default=10)
+        parser.add_argument("--concurrency", type=int, default=4, help="Потоков клиента (gunicorn)")
+        parser.add_argument("--workers", type=int, default=2, help="Воркеров gunicorn")
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument("--only", nargs="*", help="Только эти адреса (home, filter, note, api-posts, api-token)")
+        parser.add_argument("--baseline", default=str(settings.BASE_DIR / "benchmark-baseline.json"))
+        parser.add_argument("--save-baseline", action="store_true")
+        parser.add_argument("--threshold", type=float, default=0.2, help="Допустимое ухудшение (0.2 = 20%%)")
+        parser.add_argument("--fail-on-regression", action="store_true")
+
+    def handle(self, *args, **options):
+        endpoints = benchmark.default_endpoints()
+        if options["only"]:
+            endpoints = [endpoint for endpoint in endpoints if endpoint.name in options["only"]]
+        if not endpoints:
+            raise CommandError("Нет адресов для замера")
+
+        if options["server"] == "gunicorn":
+            results = benchmark.run_gunicorn(
+                endpoints, options["requests"], options["warmup"],
+                options["concurrency"], options["workers"], options["port"],
+            )
+        else:
+            results = benchmark.run_in_process(endpoints, options["requests"], options["warmup"])
+
+        results = benchmark.compare(results, options["baseline"], options["threshold"])
+        self._print(results)
+
+        if options["save_baseline"]:
+            benchmark.save_baseline(options["baseline"], results, {
+                "server": options["server"],
+                "notes": Note.objects.count(),
+                "database": connection.vendor,
+                "python": platform.python_version(),
+            })
+            self.stdout.write(f"Базовый результат сохранен: {options['baseline']}")
+
+        regressions = [result for result in results if result.regressions]
+        if regressions and options["fail_on_regression"]:
+            raise CommandError("Регрессии: " + ", ".join(result.name for result in regressions))
+
+    def _print(self, results) -> None:
+        header = f"{'адрес':<12}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'SQL':>7}{'RSS MB':>9}{'ошибки':>8}"
+        self.stdout.write(header)
+        for result in results:
+            queries = "-" if result.queries is None else f"{result.queries:g}"
+            self.stdout.write(
+                f"{result.name:<12}{result.rps:>9}{result.p50_ms:>10}{result.p95_ms:>10}{result.p99_ms:>10}"
+                f"{queries:>7}{result.peak_rss_mb:>9}{result.errors:>8}"
+            )
+            for regression in result.regressions:
+                self.stdout.write(self.style.ERROR(f"  регрессия: {regression}"))
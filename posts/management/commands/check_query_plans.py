@@ -0,0 +1,53 @@
+"""
+Проверка планов горячих запросов через `EXPLAIN` (см. `posts/query_plans.py`).
+
+    python manage.py seed_benchmark --size 100000
+    python manage.py check_query_plans --analyze             # ошибка, если есть Seq Scan / Sort
+    python manage.py check_query_plans --only home --verbose # показать план
+
+Запускать после изменений моделей, индексов и запросов view - регрессия плана
+(например, удаленный индекс) видна до выкладки.
+"""
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from posts import query_plans
+
+
+class Command(BaseCommand):
+    help = "Проверка планов запросов: без полного просмотра больших таблиц и явных сортировок"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--only", nargs="*", choices=sorted(query_plans.QUERY_SHAPES), help="Только эти формы")
+        parser.add_argument("--min-rows", type=int, default=1000, help="Seq Scan по таблицам меньше этого не ошибка")
+        parser.add_argument("--analyze", action="store_true", help="Сначала обновить статистику (ANALYZE)")
+        parser.add_argument("--verbose", action="store_true", help="Печатать SQL и план")
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("Проверка планов работает только с PostgreSQL")
+        if options["analyze"]:
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE")
+
+        failed = []
+        for name in options["only"] or query_plans.QUERY_SHAPES:
+            try:
+                report = query_plans.explain(name, options["min_rows"])
+            except query_plans.NoSampleData as error:
+                raise CommandError(error)
+
+            if report.problems:
+                failed.append(name)
+                self.stdout.write(self.style.ERROR(f"{name}: {'; '.join(report.problems)}"))
+            else:
+                self.stdout.write(self.style.SUCCESS(f"{name}: OK"))
+            if options["verbose"] or report.problems:
+                self.stdout.write(f"  {report.sql}")
+            if options["verbose"]:
+                self.stdout.write(json.dumps(report.plan, indent=2))
+
+        if failed:
+            raise CommandError(f"Планы с проблемами: {', '.join(failed)}")
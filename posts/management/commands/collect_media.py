@@ -0,0 +1,302 @@
+"""
+Удаление ненужных медиа файлов.
+
+    python manage.py collect_media                  # очередь MediaDeletion + поиск потерянных файлов
+    python manage.py collect_media --dry-run        # только показать, что будет удалено
+    python manage.py collect_media --max-ops 50     # не больше 50 операций с диском в секунду
+    python manage.py collect_media --skip-sweep     # только очередь (можно запускать часто)
+
+Кроме очереди, которую заполняют сигналы `Note`, команда ищет в `MEDIA_ROOT`:
+
+* папки `<uuid>/` заметок, которых больше нет;
+* файлы CKEditor в `uploads/`, на которые не ссылается ни одна заметка;
+* загрузки через API (`MediaDeletion.Kind.UPLOAD`), на которые не ссылается текст ни одной заметки;
+* файлы хранилища по содержимому без строки `StoredFile` (транзакция `save` откатилась)
+  и брошенные временные файлы в `.incoming/`.
+
+Все потерянные файлы удаляются, только если они старше `--min-age` часов,
+чтобы не удалить картинку еще не сохраненной заметки.
+"""
+import os
+import re
+import shutil
+import time
+import uuid
+from datetime import timedelta
+from pathlib import Path
+from urllib.parse import unquote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils._os import safe_join
+
+from posts.models import MediaDeletion, Note, StoredFile
+from posts.storage import PREFIX as STORAGE_PREFIX
+
+
+class Throttle:
+    """Ограничение кол-ва операций с диском в секунду (0 - без ограничения)."""
+
+    def __init__(self, max_per_second: float):
+        self._interval = 1 / max_per_second if max_per_second > 0 else 0
+        self._next_at = 0.0
+
+    def wait(self) -> None:
+        if not self._interval:
+            return
+        now = time.monotonic()
+        if now < self._next_at:
+            time.sleep(self._next_at - now)
+            now = self._next_at
+        self._next_at = now + self._interval
+
+
+class Command(BaseCommand):
+    help = "Удаление медиа файлов из очереди MediaDeletion и потерянных файлов в MEDIA_ROOT"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Ничего не удалять, только показать")
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--lease", type=float, default=600, help="Время захвата пачки очереди в секундах")
+        parser.add_argument("--max-ops", type=float, default=0, help="Операций с диском в секунду (0 - без ограничения)")
+        parser.add_argument("--min-age", type=float, default=24, help="Минимальный возраст потерянных файлов в часах")
+        parser.add_argument("--skip-queue", action="store_true", help="Не обрабатывать очередь MediaDeletion")
+        parser.add_argument("--skip-sweep", action="store_true", help="Не искать потерянные файлы")
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.dry_run = options["dry_run"]
+        self.throttle = Throttle(options["max_ops"])
+        self.media_root = Path(settings.MEDIA_ROOT)
+        self.removed_files = 0
+        self.removed_bytes = 0
+
+        if not options["skip_queue"]:
+            self._process_queue()
+        if not options["skip_sweep"]:
+            self.min_mtime = (timezone.now() - timedelta(hours=options["min_age"])).timestamp()
+            self._referenced = None
+            self._sweep_note_folders()
+            self._sweep_uploads()
+            self._sweep_api_uploads()
+            self._sweep_storage()
+
+        prefix = "Будет удалено" if self.dry_run else "Удалено"
+        self.stdout.write(f"{prefix} файлов: {self.removed_files}, {self.removed_bytes / 1024 / 1024:.1f} МБ")
+
+    # Очередь.
+
+    def _process_queue(self) -> None:
+        # Загрузки через API - не удаление, их проверяет `_sweep_api_uploads`.
+        queue = MediaDeletion.objects.exclude(kind=MediaDeletion.Kind.UPLOAD)
+        if self.dry_run:
+            for entry in queue.order_by("pk").iterator(chunk_size=self.options["batch_size"]):
+                self._delete_entry(entry)
+            return
+
+        while True:
+            batch = self._claim_batch(queue)
+            if not batch:
+                return
+            # Файлы удаляются вне транзакции: с `--max-ops` это может занять много времени.
+            for entry in batch:
+                self._delete_entry(entry)
+            MediaDeletion.objects.filter(pk__in=[entry.pk for entry in batch]).delete()
+
+    def _claim_batch(self, queue) -> list[MediaDeletion]:
+        """Захватить пачку на `--lease` секунд; если запуск упадет, ее возьмет следующий."""
+        now = timezone.now()
+        with transaction.atomic():
+            batch = list(
+                queue.select_for_update(skip_locked=True)
+                .filter(Q(claimed_until=None) | Q(claimed_until__lte=now))
+                .order_by("pk")[:self.options["batch_size"]]
+            )
+            MediaDeletion.objects.filter(pk__in=[entry.pk for entry in batch]).update(
+                claimed_until=now + timedelta(seconds=self.options["lease"])
+            )
+        return batch
+
+    def _delete_entry(self, entry: MediaDeletion) -> None:
+        if entry.kind == MediaDeletion.Kind.DIRECTORY:
+            try:
+                path = Path(safe_join(self.media_root, entry.name))
+            except SuspiciousFileOperation:
+                self.stderr.write(f"Путь вне MEDIA_ROOT: {entry.name}")
+                return
+            self._remove_directory(path)
+            return
+
+        storage = Note._meta.get_field("image").storage
+        if self.dry_run:
+            # Файл хранилища по содержимому удаляется, только если это последняя ссылка.
+            stored = StoredFile.objects.filter(name=entry.name).values_list("ref_count", flat=True).first()
+            if stored is None or stored <= 1:
+                self._report(Path(storage.path(entry.name)))
+            return
+        path = Path(storage.path(entry.name))
+        size = path.stat().st_size if path.is_file() else 0
+        self.throttle.wait()
+        storage.delete(entry.name)
+        if size and not path.exists():
+            self.removed_files += 1
+            self.removed_bytes += size
+
+    # Поиск потерянных файлов.
+
+    def _sweep_note_folders(self) -> None:
+        folders = {}
+        with os.scandir(self.media_root) as entries:
+            for entry in entries:
+                if not entry.is_dir():
+                    continue
+                try:
+                    folders[uuid.UUID(entry.name)] = Path(entry.path)
+                except ValueError:
+                    continue
+
+        candidates = list(folders)
+        batch_size = self.options["batch_size"]
+        for start in range(0, len(candidates), batch_size):
+            chunk = candidates[start:start + batch_size]
+            existing = set(Note.objects.filter(uuid__in=chunk).values_list("uuid", flat=True))
+            for note_uuid in chunk:
+                # Файл картинки пишется до фиксации строки заметки: свежие папки не трогаем.
+                if note_uuid not in existing and not self._is_recent_tree(folders[note_uuid]):
+                    self._remove_directory(folders[note_uuid])
+
+    def _sweep_uploads(self) -> None:
+        upload_path = getattr(settings, "CKEDITOR_UPLOAD_PATH", "uploads/")
+        uploads_root = self.media_root / upload_path
+        if not uploads_root.is_dir():
+            return
+
+        referenced = self._referenced_media()
+        thumb_re = re.compile(r"^(?P<name>.+)_thumb(?P<ext>\.\w+)$")
+
+        for directory, _, files in os.walk(uploads_root):
+            for file_name in files:
+                path = Path(directory) / file_name
+                name = path.relative_to(self.media_root).as_posix()
+                thumb = thumb_re.match(name)
+                if name in referenced or (thumb and thumb["name"] + thumb["ext"] in referenced):
+                    continue
+                if self._is_recent(path):
+                    continue
+                self._remove_file(path)
+
+    def _sweep_api_uploads(self) -> None:
+        """Освободить ссылки загрузок через API, если файл не используется в тексте заметок."""
+        uploads = MediaDeletion.objects.filter(
+            kind=MediaDeletion.Kind.UPLOAD,
+            created_at__lt=timezone.now() - timedelta(hours=self.options["min_age"]),
+        )
+        referenced = self._referenced_media()
+        for entry in uploads.order_by("pk").iterator(chunk_size=self.options["batch_size"]):
+            if entry.name in referenced:
+                continue  # Проверим снова в следующий раз: заметку могут удалить.
+            if self.dry_run:
+                self._delete_entry(MediaDeletion(name=entry.name, kind=MediaDeletion.Kind.FILE))
+                continue
+            with transaction.atomic():
+                self._delete_entry(entry)
+                entry.delete()
+
+    def _sweep_storage(self) -> None:
+        """Файлы хранилища по содержимому без строки `StoredFile` и брошенные временные файлы."""
+        storage = Note._meta.get_field("image").storage
+        storage_root = Path(storage.location)
+
+        incoming = storage_root / ".incoming"
+        if incoming.is_dir():
+            for path in incoming.iterdir():
+                if path.is_file() and not self._is_recent(path):
+                    self._remove_file(path)
+
+        cas_root = storage_root / STORAGE_PREFIX
+        if not cas_root.is_dir():
+            return
+        for directory, _, files in os.walk(cas_root):
+            candidates = {}
+            for file_name in files:
+                path = Path(directory) / file_name
+                if not self._is_recent(path):
+                    candidates[path.relative_to(storage_root).as_posix()] = path
+            if not candidates:
+                continue
+            known = set(StoredFile.objects.filter(name__in=candidates).values_list("name", flat=True))
+            for name, path in candidates.items():
+                if name in known:
+                    continue
+                if self.dry_run:
+                    self._report(path)
+                    continue
+                self.throttle.wait()
+                size = path.stat().st_size
+                # Проверка и удаление под блокировкой строки `StoredFile` (см. `posts/storage.py`).
+                if storage.delete_if_unreferenced(name):
+                    self.removed_files += 1
+                    self.removed_bytes += size
+
+    def _referenced_media(self) -> set[str]:
+        """Пути файлов `uploads/...` и `cas/...`, на которые ссылается текст заметок (один проход)."""
+        if self._referenced is None:
+            prefixes = [getattr(settings, "CKEDITOR_UPLOAD_PATH", "uploads/"), STORAGE_PREFIX]
+            pattern = re.compile("(?:" + "|".join(map(re.escape, prefixes)) + r""")[^"'\s<>()?#]+""")
+            self._referenced = set()
+            contents = Note.objects.order_by().values_list("content", flat=True)
+            for content in contents.iterator(chunk_size=self.options["batch_size"]):
+                self._referenced.update(unquote(match) for match in pattern.findall(content or ""))
+        return self._referenced
+
+    def _is_recent(self, path: Path) -> bool:
+        try:
+            return path.stat().st_mtime > self.min_mtime
+        except FileNotFoundError:
+            return True
+
+    def _is_recent_tree(self, path: Path) -> bool:
+        """Папка или любой файл в ней новее `--min-age`."""
+        if self._is_recent(path):
+            return True
+        for directory, _, files in os.walk(path):
+            if any(self._is_recent(Path(directory) / file_name) for file_name in files):
+                return True
+        return False
+
+    # Удаление.
+
+    def _remove_directory(self, path: Path) -> None:
+        if not path.is_dir():
+            return
+        for directory, _, files in os.walk(path):
+            for file_name in files:
+                self._remove_file(Path(directory) / file_name)
+        if not self.dry_run:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def _remove_file(self, path: Path) -> None:
+        if self.dry_run:
+            self._report(path)
+            return
+        self.throttle.wait()
+        try:
+            size = path.stat().st_size
+            path.unlink()
+        except FileNotFoundError:
+            return
+        self.removed_files += 1
+        self.removed_bytes += size
+
+    def _report(self, path: Path) -> None:
+        try:
+            size = path.stat().st_size
+        except FileNotFoundError:
+            return
+        self.removed_files += 1
+        self.removed_bytes += size
+        self.stdout.write(str(path.relative_to(self.media_root)))
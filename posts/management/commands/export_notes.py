@@ -0,0 +1,44 @@
+"""
+Потоковая выгрузка заметок в NDJSON (см. `posts/notes_transfer.py`).
+
+    python manage.py export_notes notes.ndjson.zst           # сжатие по расширению: .gz, .zst
+    python manage.py export_notes - --compression gzip > notes.ndjson.gz
+    python manage.py export_notes notes.ndjson.gz --resume   # продолжить с контрольной точки
+
+В отличие от `dumpdata` память не растет с кол-вом заметок.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from posts import notes_transfer
+
+
+class Command(BaseCommand):
+    help = "Выгрузка заметок в NDJSON (gzip / zstd)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", help="Файл или `-` для stdout")
+        parser.add_argument("--compression", choices=["gzip", "zstd", "none"], help="По умолчанию - по расширению")
+        parser.add_argument("--batch-size", type=int, default=2000)
+        parser.add_argument("--checkpoint", help="Файл контрольной точки (по умолчанию `<output>.checkpoint`)")
+        parser.add_argument("--resume", action="store_true", help="Продолжить с контрольной точки")
+
+    def handle(self, *args, **options):
+        output = options["output"]
+        # В stdout идут данные, сообщения - в stderr.
+        log = self.stderr if output == "-" else self.stdout
+        if output == "-" and options["resume"]:
+            raise CommandError("--resume не работает с stdout")
+
+        try:
+            exported = notes_transfer.export_notes(
+                output,
+                compression=notes_transfer.compression_for(output, options["compression"]),
+                batch_size=options["batch_size"],
+                checkpoint_path=notes_transfer.checkpoint_path_for(output, options["checkpoint"]),
+                resume=options["resume"],
+                progress=lambda count: log.write(f"Выгружено заметок: {count}"),
+            )
+        except (ValueError, RuntimeError) as error:
+            raise CommandError(error)
+        log.write(f"Готово, заметок: {exported}")
+
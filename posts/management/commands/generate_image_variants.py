@@ -0,0 +1,119 @@
+"""
+Создание уменьшенных копий картинок заметок из очереди `ImageVariantTask` (см. `posts/images.py`).
+
+    python manage.py generate_image_variants                 # выполнить все задачи и выйти
+    python manage.py generate_image_variants --loop          # воркер: ждать новые задачи
+    python manage.py generate_image_variants --missing       # поставить в очередь заметки без актуальных копий
+    python manage.py generate_image_variants --all --workers 4   # пересоздать все
+
+Задачи пачки выполняются в `--workers` потоках этого процесса (Pillow отпускает GIL
+при сжатии и масштабировании). Пачка захватывается через `SELECT ... FOR UPDATE SKIP LOCKED`
+и аренду `--lease`, поэтому воркеров можно запустить несколько.
+Неудачная задача повторяется с экспоненциальной задержкой, после `--max-attempts`
+попыток остается в очереди для разбора (повтор - действием в админке).
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from posts.images import generate_variants, get_config, schedule_variants, variants_are_current
+from posts.models import ImageVariantTask, Note
+
+
+class Command(BaseCommand):
+    help = "Создание уменьшенных копий (и WebP) для картинок заметок из очереди"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--missing", action="store_true", help="Поставить в очередь заметки без актуальных копий")
+        parser.add_argument("--all", action="store_true", help="Поставить в очередь все картинки")
+        parser.add_argument("--loop", action="store_true", help="Не завершаться, ждать новые задачи")
+        parser.add_argument("--poll-interval", type=float, default=2.0, help="Секунды между проверками очереди")
+        parser.add_argument("--workers", type=int, default=get_config()["WORKERS"])
+        parser.add_argument("--batch-size", type=int, default=20)
+        parser.add_argument("--chunk-size", type=int, default=500)
+        parser.add_argument("--max-attempts", type=int, default=5)
+        parser.add_argument("--retry-delay", type=float, default=60.0, help="Задержка первого повтора в секундах")
+        parser.add_argument("--lease", type=float, default=600.0, help="Время захвата пачки в секундах")
+
+    def handle(self, *args, **options):
+        self.options = options
+        if options["missing"] or options["all"]:
+            self.stdout.write(f"Поставлено в очередь: {self._enqueue(only_missing=not options['all'])}")
+
+        done = failed = 0
+        with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+            while True:
+                batch, claimed_until = self._claim_batch()
+                if batch:
+                    for task, error in executor.map(self._process, batch):
+                        if error is None:
+                            done += 1
+                            # Если картинку заменили во время работы, задачу уже поставили заново.
+                            ImageVariantTask.objects.filter(pk=task.pk, next_attempt_at=claimed_until).delete()
+                        else:
+                            failed += 1
+                            self.stderr.write(f"{task.note_id}: {error}")
+                            self._schedule_retry(task, error, claimed_until)
+                    continue
+                if not options["loop"]:
+                    break
+                time.sleep(options["poll_interval"])
+
+        self.stdout.write(f"Готово: {done}, ошибок: {failed}")
+
+    def _enqueue(self, only_missing: bool) -> int:
+        notes = (
+            Note.objects.exclude(image="").exclude(image__isnull=True)
+            .only("uuid", "image", "image_variants").order_by()
+            .iterator(chunk_size=self.options["chunk_size"])
+        )
+        notes = (note for note in notes if not only_missing or not variants_are_current(note))
+        count = 0
+        chunk = []
+        for note in notes:
+            chunk.append(note)
+            if len(chunk) == self.options["chunk_size"]:
+                schedule_variants(chunk)
+                count += len(chunk)
+                chunk = []
+        schedule_variants(chunk)
+        return count + len(chunk)
+
+    def _claim_batch(self) -> tuple[list[ImageVariantTask], object]:
+        now = timezone.now()
+        claimed_until = now + timedelta(seconds=self.options["lease"])
+        with transaction.atomic():
+            batch = list(
+                ImageVariantTask.objects
+                .select_for_update(skip_locked=True)
+                .filter(next_attempt_at__lte=now, attempts__lt=self.options["max_attempts"])
+                .order_by("next_attempt_at")[:self.options["batch_size"]]
+            )
+            ImageVariantTask.objects.filter(pk__in=[task.pk for task in batch]).update(next_attempt_at=claimed_until)
+        return batch, claimed_until
+
+    @staticmethod
+    def _process(task: ImageVariantTask) -> tuple[ImageVariantTask, Exception | None]:
+        try:
+            note = Note.objects.filter(uuid=task.note_id).only("uuid", "image", "image_variants").first()
+            # Картинку могли удалить после постановки задачи.
+            if note is not None and note.image:
+                generate_variants(note)
+        except Exception as error:
+            return task, error
+        finally:
+            close_old_connections()
+        return task, None
+
+    def _schedule_retry(self, task: ImageVariantTask, error: Exception, claimed_until) -> None:
+        attempts = task.attempts + 1
+        delay = self.options["retry_delay"] * 2 ** (attempts - 1)
+        ImageVariantTask.objects.filter(pk=task.pk, next_attempt_at=claimed_until).update(
+            attempts=attempts,
+            last_error=f"{type(error).__name__}: {error}",
+            next_attempt_at=timezone.now() + timedelta(seconds=delay),
+        )
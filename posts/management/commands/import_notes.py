@@ -0,0 +1,49 @@
+"""
+Потоковая загрузка заметок из NDJSON (см. `posts/notes_transfer.py`).
+
+    python manage.py import_notes notes.ndjson.zst           # gzip / zstd определяются по содержимому
+    python manage.py import_notes notes.ndjson.gz --resume   # продолжить с контрольной точки
+    zcat notes.ndjson.gz | python manage.py import_notes -
+
+Заметки, которые уже есть в базе, пропускаются, поэтому повторная загрузка того же файла безопасна.
+"""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from posts import notes_transfer
+
+
+class Command(BaseCommand):
+    help = "Загрузка заметок из NDJSON (gzip / zstd)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("input", help="Файл или `-` для stdin")
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--checkpoint", help="Файл контрольной точки (по умолчанию `<input>.checkpoint`)")
+        parser.add_argument("--resume", action="store_true", help="Продолжить с контрольной точки")
+
+    def handle(self, *args, **options):
+        if options["input"] == "-" and options["resume"]:
+            raise CommandError("--resume не работает с stdin")
+        started = time.perf_counter()
+
+        try:
+            stats = notes_transfer.import_notes(
+                options["input"],
+                batch_size=options["batch_size"],
+                checkpoint_path=notes_transfer.checkpoint_path_for(options["input"], options["checkpoint"]),
+                resume=options["resume"],
+                progress=lambda stats: self.stdout.write(
+                    f"Загружено заметок: {stats.imported}, пропущено: {stats.skipped}"
+                ),
+            )
+        except (ValueError, RuntimeError) as error:
+            raise CommandError(error)
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"Готово: загружено {stats.imported}, уже были в базе {stats.skipped}, "
+            f"создано пользователей {stats.created_users}, без файла картинки {stats.missing_images}, "
+            f"{stats.imported / elapsed:.0f} заметок/с"
+        )
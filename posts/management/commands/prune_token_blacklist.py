@@ -0,0 +1,51 @@
+"""
+Удаление истекших refresh токенов из `OutstandingToken` / `BlacklistedToken`.
+
+    python manage.py prune_token_blacklist                      # один проход и выйти
+    python manage.py prune_token_blacklist --loop --interval 3600
+
+Строки удаляются пачками по `--batch-size` с паузой `--pause` секунд между ними,
+чтобы не держать долгие блокировки на таблицах, в которые пишет каждый refresh.
+Фильтр Блума процессов (`posts/api/token_blacklist.py`) освобождается от удаленных токенов
+при следующей полной пересборке.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+
+
+class Command(BaseCommand):
+    help = "Удаление истекших токенов из черного списка JWT"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--pause", type=float, default=0.1, help="Пауза между пачками в секундах")
+        parser.add_argument("--loop", action="store_true", help="Не завершаться, повторять проходы")
+        parser.add_argument("--interval", type=float, default=3600, help="Секунды между проходами в режиме --loop")
+
+    def handle(self, *args, **options):
+        while True:
+            deleted = self._prune(options["batch_size"], options["pause"])
+            self.stdout.write(f"Удалено токенов: {deleted}")
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
+
+    @staticmethod
+    def _prune(batch_size: int, pause: float) -> int:
+        deleted = 0
+        now = timezone.now()
+        while True:
+            ids = list(
+                OutstandingToken.objects.filter(expires_at__lte=now)
+                .order_by("id").values_list("id", flat=True)[:batch_size]
+            )
+            if not ids:
+                return deleted
+            # Явно, а не каскадом: CASCADE в Django сначала загружает связанные строки.
+            BlacklistedToken.objects.filter(token_id__in=ids).delete()
+            OutstandingToken.objects.filter(id__in=ids).delete()
+            deleted += len(ids)
+            time.sleep(pause)
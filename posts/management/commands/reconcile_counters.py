@@ -0,0 +1,96 @@
+"""
+Пересчет денормализованных счетчиков заметок (см. `posts/counters.py`).
+
+    python manage.py reconcile_counters             # исправить расхождения
+    python manage.py reconcile_counters --dry-run   # только показать кол-во расхождений
+
+Нужна после изменений в обход сигналов (`QuerySet.update`, сырой SQL, загрузка дампа)
+и для заполнения счетчиков у существующих данных.
+
+Счетчики пересчитываются пачками по `--batch-size` пользователей (тегов для `TagNoteCounter`):
+в памяти и под блокировкой только строки одной пачки, каждая пачка - своя короткая транзакция.
+"""
+from functools import reduce
+from operator import or_
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Q
+
+from posts.models import Note, Tag, TagNoteCounter, User, UserNoteCounter, UserTagCounter
+
+
+class Command(BaseCommand):
+    help = "Пересчет счетчиков заметок пользователей и тегов"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Ничего не менять, только показать")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        self.options = options
+        through = Note.tags.through.objects.order_by()
+
+        self._reconcile(
+            UserNoteCounter, ("user_id",), User,
+            lambda ids: Note.objects.order_by().filter(user_id__in=ids)
+            .values_list("user_id").annotate(count=Count("pk")),
+        )
+        self._reconcile(
+            TagNoteCounter, ("tag_id",), Tag,
+            lambda ids: through.filter(tag_id__in=ids).values_list("tag_id").annotate(count=Count("pk")),
+        )
+        self._reconcile(
+            UserTagCounter, ("user_id", "tag_id"), User,
+            lambda ids: through.filter(note__user_id__in=ids)
+            .values_list("note__user_id", "tag_id").annotate(count=Count("pk")),
+        )
+
+    def _reconcile(self, model, fields: tuple[str, ...], owner_model, actual_rows) -> None:
+        """Пересчитать счетчики пачками владельцев (первое поле ключа - id `owner_model`)."""
+        owner_ids = owner_model.objects.order_by("pk").values_list("pk", flat=True)
+        mismatches = 0
+        last_id = None
+        while True:
+            batch = owner_ids if last_id is None else owner_ids.filter(pk__gt=last_id)
+            ids = list(batch[:self.options["batch_size"]])
+            if not ids:
+                break
+            last_id = ids[-1]
+            with transaction.atomic():
+                mismatches += self._reconcile_batch(model, fields, ids, actual_rows(ids))
+        self.stdout.write(f"{model.__name__}: расхождений {mismatches}")
+
+    def _reconcile_batch(self, model, fields: tuple[str, ...], ids: list, actual_rows) -> int:
+        actual = {tuple(row[:-1]): row[-1] for row in actual_rows}
+        stored = {
+            tuple(row[:-1]): row[-1]
+            for row in model.objects.select_for_update().filter(**{f"{fields[0]}__in": ids})
+            .values_list(*fields, "note_count")
+        }
+
+        changed = [key for key, count in actual.items() if stored.get(key) != count]
+        # Строки без заметок: лишние для UserTagCounter, у остальных счетчик должен стать 0.
+        stale = [
+            key for key, count in stored.items()
+            if key not in actual and (count != 0 or model is UserTagCounter)
+        ]
+        if self.options["dry_run"]:
+            return len(changed) + len(stale)
+
+        batch_size = self.options["batch_size"]
+        model.objects.bulk_create(
+            [model(**dict(zip(fields, key)), note_count=actual[key]) for key in changed],
+            update_conflicts=True,
+            unique_fields=[field.removesuffix("_id") for field in fields],
+            update_fields=["note_count"],
+            batch_size=batch_size,
+        )
+        for start in range(0, len(stale), batch_size):
+            keys = stale[start:start + batch_size]
+            rows = model.objects.filter(reduce(or_, (Q(**dict(zip(fields, key))) for key in keys)))
+            if model is UserTagCounter:
+                rows.delete()
+            else:
+                rows.update(note_count=0)
+        return len(changed) + len(stale)
@@ -0,0 +1,36 @@
+"""
+Детерминированный набор данных для команды `benchmark` (см. `posts/benchmark.py`).
+
+    python manage.py seed_benchmark --size 10000          # 10k / 100k / 1M заметок
+    python manage.py seed_benchmark --clear               # удалить данные набора
+
+Набор с тем же `--size` и `--seed` всегда одинаковый. Лучше использовать отдельную базу.
+"""
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from posts import benchmark
+
+
+class Command(BaseCommand):
+    help = "Создание детерминированного набора заметок для замеров производительности"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--size", type=int, default=10000, help="Кол-во заметок")
+        parser.add_argument("--seed", type=int, default=42)
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--clear", action="store_true", help="Удалить данные набора и выйти")
+
+    def handle(self, *args, **options):
+        deleted = benchmark.clear()
+        if deleted:
+            self.stdout.write(f"Удалено заметок прошлого набора: {deleted}")
+        if options["clear"]:
+            return
+
+        benchmark.seed(
+            options["size"], options["seed"], options["batch_size"],
+            progress=lambda created: self.stdout.write(f"Создано заметок: {created}"),
+        )
+        # Сигналы при `bulk_create` не срабатывают - счетчики пересчитываем командой.
+        call_command("reconcile_counters", stdout=self.stdout)
@@ -0,0 +1,115 @@
+"""
+Отправка писем из очереди `OutboxEmail`.
+
+    python manage.py send_outbox            # отправить все, что накопилось, и выйти
+    python manage.py send_outbox --loop     # воркер: ждать новые письма
+
+Все письма пачки уходят через одно SMTP соединение, в режиме `--loop`
+соединение переиспользуется между пачками.
+Неудачная отправка повторяется с экспоненциальной задержкой,
+после `--max-attempts` попыток письмо помечается как `dead`.
+"""
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from posts.models import OutboxEmail
+
+
+class Command(BaseCommand):
+    help = "Отправка писем из очереди OutboxEmail"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=50)
+        parser.add_argument("--loop", action="store_true", help="Не завершаться, ждать новые письма")
+        parser.add_argument("--poll-interval", type=float, default=2.0, help="Секунды между проверками очереди")
+        parser.add_argument("--max-attempts", type=int, default=8)
+        parser.add_argument("--retry-delay", type=float, default=30.0, help="Задержка первого повтора в секундах")
+        # Пока письма пачки отправляются, другие воркеры их не берут.
+        parser.add_argument("--lease", type=float, default=300.0, help="Время захвата пачки в секундах")
+
+    def handle(self, *args, **options):
+        self.options = options
+        connection = get_connection(fail_silently=False)
+
+        try:
+            while True:
+                batch = self._claim_batch()
+                if batch:
+                    connection = self._send_batch(connection, batch)
+                    continue
+                if not options["loop"]:
+                    break
+                # Пока очередь пустая, не держим SMTP соединение открытым.
+                connection.close()
+                time.sleep(options["poll_interval"])
+        finally:
+            connection.close()
+
+    def _claim_batch(self) -> list[OutboxEmail]:
+        now = timezone.now()
+        with transaction.atomic():
+            batch = list(
+                OutboxEmail.objects
+                .select_for_update(skip_locked=True)
+                .filter(status=OutboxEmail.Status.PENDING, next_attempt_at__lte=now)
+                .order_by("next_attempt_at")[:self.options["batch_size"]]
+            )
+            OutboxEmail.objects.filter(pk__in=[email.pk for email in batch]).update(
+                next_attempt_at=now + timedelta(seconds=self.options["lease"])
+            )
+        return batch
+
+    def _send_batch(self, connection, batch: list[OutboxEmail]):
+        sent = dead = retried = 0
+        for email in batch:
+            try:
+                connection.open()
+                connection.send_messages([self._build_message(email, connection)])
+            except Exception as error:
+                # Соединение после ошибки может быть в плохом состоянии - откроем заново.
+                connection.close()
+                if self._schedule_retry(email, error):
+                    retried += 1
+                else:
+                    dead += 1
+                continue
+
+            email.status = OutboxEmail.Status.SENT
+            email.sent_at = timezone.now()
+            email.attempts += 1
+            email.last_error = ""
+            email.save(update_fields=["status", "sent_at", "attempts", "last_error"])
+            sent += 1
+
+        self.stdout.write(f"Отправлено: {sent}, повтор: {retried}, не доставлено: {dead}")
+        return connection
+
+    def _schedule_retry(self, email: OutboxEmail, error: Exception) -> bool:
+        email.attempts += 1
+        email.last_error = f"{type(error).__name__}: {error}"
+        if email.attempts >= self.options["max_attempts"]:
+            email.status = OutboxEmail.Status.DEAD
+        else:
+            delay = self.options["retry_delay"] * 2 ** (email.attempts - 1)
+            email.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+        email.save(update_fields=["attempts", "last_error", "status", "next_attempt_at"])
+        return email.status == OutboxEmail.Status.PENDING
+
+    @staticmethod
+    def _build_message(email: OutboxEmail, connection) -> EmailMultiAlternatives:
+        message = EmailMultiAlternatives(
+            subject=email.subject,
+            body=email.body,
+            from_email=email.from_email or settings.DEFAULT_FROM_EMAIL,
+            to=email.to,
+            connection=connection,
+        )
+        if email.html_body:
+            message.attach_alternative(email.html_body, "text/html")
+        return message
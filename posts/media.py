@@ -0,0 +1,162 @@
+"""
+Раздача медиа файлов (`/media/...`).
+
+Режим выбирается настройкой `MEDIA_SERVING["MODE"]`:
+
+* `"x-accel-redirect"` - Django только проверяет путь и ставит заголовки, файл отдает nginx
+  из `internal` location с префиксом `MEDIA_SERVING["INTERNAL_PREFIX"]`:
+
+      location /protected-media/ {
+          internal;
+          alias /path/to/media/;
+      }
+
+* `"x-sendfile"` - то же для Apache (mod_xsendfile) / lighttpd, в заголовке полный путь к файлу;
+* `"python"` - файл отдает сам Django: `FileResponse` (сервер может использовать `sendfile`
+  через `wsgi.file_wrapper`), с поддержкой `Range` и условных запросов.
+
+Файлы хранилища по содержимому (`cas/...`, см. `posts/storage.py`) никогда не меняются
+под тем же именем, поэтому кэшируются браузерами и прокси на год (`immutable`).
+"""
+import mimetypes
+import os
+import re
+from pathlib import Path
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.decorators.http import require_safe
+
+from .storage import PREFIX as CONTENT_ADDRESSED_PREFIX
+
+
+DEFAULTS = {
+    "MODE": "python",
+    "INTERNAL_PREFIX": "/protected-media/",
+    "IMMUTABLE_MAX_AGE": 60 * 60 * 24 * 365,
+    "MAX_AGE": 60 * 60,
+}
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+CHUNK_SIZE = 64 * 1024
+
+
+def get_config() -> dict:
+    return {**DEFAULTS, **getattr(settings, "MEDIA_SERVING", {})}
+
+
+def get_cache_control(path: str) -> str:
+    config = get_config()
+    if path.startswith(CONTENT_ADDRESSED_PREFIX):
+        return f"public, max-age={config['IMMUTABLE_MAX_AGE']}, immutable"
+    return f"public, max-age={config['MAX_AGE']}"
+
+
+def parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """
+    Диапазон `bytes=start-end` -> (start, end) включительно.
+    None - заголовок не поддерживается (несколько диапазонов и т.п.), отдаем файл целиком.
+    ValueError - диапазон за пределами файла (ответ 416).
+    """
+    match = RANGE_RE.match(header.strip())
+    if match is None:
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        # `bytes=-500` - последние 500 байт.
+        length = int(end)
+        if length == 0:
+            raise ValueError("Пустой диапазон")
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError("Диапазон за пределами файла")
+    return start, end
+
+
+def _read_range(file, start: int, length: int):
+    with file:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def _if_range_matches(request, etag: str, last_modified: int) -> bool:
+    if_range = request.headers.get("If-Range")
+    if not if_range:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
+
+
+@require_safe
+def serve_media(request, path: str):
+    try:
+        full_path = Path(safe_join(settings.MEDIA_ROOT, path))
+    except SuspiciousFileOperation:  # Путь выходит за пределы MEDIA_ROOT.
+        raise Http404
+    if not full_path.is_file():
+        raise Http404
+
+    config = get_config()
+    stat = full_path.stat()
+    last_modified = int(stat.st_mtime)
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = _build_response(request, config, path, full_path, stat.st_size, etag, last_modified)
+        content_type, encoding = mimetypes.guess_type(full_path.name)
+        response.headers["Content-Type"] = content_type or "application/octet-stream"
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+    response.headers["ETag"] = etag
+    response.headers["Last-Modified"] = http_date(last_modified)
+    response.headers["Cache-Control"] = get_cache_control(path)
+    return response
+
+
+def _build_response(request, config: dict, path: str, full_path: Path, size: int, etag: str, last_modified: int):
+    mode = config["MODE"]
+    if mode == "x-accel-redirect":
+        response = HttpResponse()
+        response.headers["X-Accel-Redirect"] = config["INTERNAL_PREFIX"].rstrip("/") + "/" + quote(path.lstrip("/"))
+        return response
+    if mode == "x-sendfile":
+        response = HttpResponse()
+        response.headers["X-Sendfile"] = os.fspath(full_path)
+        return response
+
+    range_header = request.headers.get("Range")
+    if range_header and _if_range_matches(request, etag, last_modified):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response.headers["Content-Range"] = f"bytes */{size}"
+            return response
+        if byte_range is not None:
+            start, end = byte_range
+            length = end - start + 1
+            response = StreamingHttpResponse(_read_range(full_path.open("rb"), start, length), status=206)
+            response.headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            response.headers["Content-Length"] = str(length)
+            response.headers["Accept-Ranges"] = "bytes"
+            return response
+
+    response = FileResponse(full_path.open("rb"))
+    response.headers["Accept-Ranges"] = "bytes"
+    return response
@@ -0,0 +1,403 @@
+"""
+Метрики запросов: `Server-Timing` для персонала и `/metrics` в формате Prometheus.
+
+`MetricsMiddleware` для каждого запроса считает:
+
+* общее время обработки (до возврата ответа из view, без отдачи потокового тела);
+* кол-во и время SQL запросов ко всем базам (`execute_wrapper`);
+* попадания и промахи кэша (сообщают бэкенды из `posts/cache_backend.py`);
+* время рендеринга шаблонов (внешний `Template.render`, вложенные `include` не суммируются).
+
+Сотрудникам (`is_staff`) эти значения уходят в заголовке `Server-Timing` (видны в DevTools браузера).
+
+Значения складываются в гистограммы и счетчики по имени view. Чтобы `/metrics` отдавал сумму
+по всем воркерам gunicorn, каждый процесс пишет свои значения в свой файл в `METRICS["DIR"]`
+через mmap (запись - сложение числа по известному смещению, без блокировок между процессами),
+а `/metrics` читает и складывает все файлы. Без `DIR` значения хранятся в памяти процесса.
+
+Файлы завершившихся процессов (перезапуск воркера gunicorn по `max_requests`, падение)
+новый процесс при старте складывает в `metrics-merged.db` и удаляет, поэтому файлов не больше,
+чем живых воркеров, а счетчики не уменьшаются. Процессы проверяются по pid, поэтому `DIR`
+должна быть своя у каждого сервера. Чтобы обнулить значения, очистите папку при перезапуске.
+"""
+import contextvars
+import fcntl
+import glob
+import hmac
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.template import base as template_base
+from django.views.decorators.cache import never_cache
+
+from .query_budget import execute_wrapper_all
+
+
+DEFAULTS = {
+    "ENABLED": True,
+    "DIR": None,
+    # Доступ к `/metrics`: с `Authorization: Bearer <TOKEN>`, для персонала или с адресов `ALLOWED_IPS`.
+    # `ALLOWED_IPS` сверяется с `REMOTE_ADDR`: за nginx это адрес самого nginx (обычно 127.0.0.1),
+    # то есть любой клиент из интернета. Список имеет смысл, только если Prometheus ходит
+    # в gunicorn напрямую, минуя прокси.
+    "TOKEN": None,
+    "ALLOWED_IPS": [],
+    "SERVER_TIMING": True,
+}
+
+# Границы корзин гистограмм.
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+HISTOGRAMS = {
+    "http_request_duration_seconds": ("Время обработки запроса", SECONDS_BUCKETS),
+    "db_query_duration_seconds": ("Суммарное время SQL запросов за запрос", SECONDS_BUCKETS),
+    "db_queries_per_request": ("Кол-во SQL запросов за запрос", COUNT_BUCKETS),
+    "template_render_duration_seconds": ("Время рендеринга шаблонов за запрос", SECONDS_BUCKETS),
+}
+COUNTERS = {
+    "http_requests_total": "Кол-во запросов",
+    "cache_requests_total": "Обращения к кэшу",
+}
+
+
+# Сумма значений завершившихся процессов.
+MERGED_FILE = "metrics-merged.db"
+PROCESS_FILE = re.compile(r"metrics-(\d+)\.db")
+
+
+def get_config() -> dict:
+    return {**DEFAULTS, **getattr(settings, "METRICS", {})}
+
+
+# Значения одного запроса.
+
+@dataclass
+class RequestMetrics:
+    sql_count: int = 0
+    sql_seconds: float = 0.0
+    cache_hits: int = 0
+    cache_misses: int = 0
+    template_seconds: float = 0.0
+    template_depth: int = 0
+
+
+_current: contextvars.ContextVar[RequestMetrics | None] = contextvars.ContextVar("request_metrics", default=None)
+
+
+def record_cache(hits: int = 0, misses: int = 0) -> None:
+    """Учесть обращения к кэшу в текущем запросе (вызывают бэкенды кэша)."""
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.cache_hits += hits
+        metrics.cache_misses += misses
+
+
+class _SQLTimer:
+    def __init__(self, metrics: RequestMetrics):
+        self.metrics = metrics
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.metrics.sql_count += 1
+            self.metrics.sql_seconds += time.perf_counter() - started
+
+
+_original_template_render = template_base.Template.render
+
+
+def _timed_template_render(self, context):
+    metrics = _current.get()
+    if metrics is None:
+        return _original_template_render(self, context)
+    metrics.template_depth += 1
+    started = time.perf_counter()
+    try:
+        return _original_template_render(self, context)
+    finally:
+        metrics.template_depth -= 1
+        if metrics.template_depth == 0:
+            metrics.template_seconds += time.perf_counter() - started
+
+
+def install_template_timer() -> None:
+    """Подменить `Template.render` на версию с замером времени (из `PostsConfig.ready`)."""
+    template_base.Template.render = _timed_template_render
+
+
+# Хранилище значений.
+
+class MemoryValues:
+    def __init__(self):
+        self._values: dict[str, float] = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def add(self, key: str, amount: float) -> None:
+        with self._lock:
+            self._values[key] += amount
+
+    def collect(self) -> dict[str, float]:
+        with self._lock:
+            return dict(self._values)
+
+
+class MmapValues:
+    """
+    Значения процесса в файле `<dir>/metrics-<pid>.db`.
+    Формат: 8 байт - занятый размер, затем записи `[длина ключа: 4 байта][ключ, до кратного 8][double]`.
+    Пишет только процесс-владелец, читать файл может любой процесс.
+    """
+
+    INITIAL_SIZE = 1024 * 1024
+
+    def __init__(self, directory: str, name: str | None = None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.path = os.path.join(directory, name or f"metrics-{os.getpid()}.db")
+        self._lock = threading.Lock()
+        self._positions: dict[str, int] = {}
+        self._file = open(self.path, "a+b")
+        if os.path.getsize(self.path) == 0:
+            self._file.truncate(self.INITIAL_SIZE)
+        self._capacity = os.path.getsize(self.path)
+        self._mmap = mmap.mmap(self._file.fileno(), self._capacity)
+        self._used = struct.unpack_from("q", self._mmap, 0)[0] or 8
+        # Файл мог остаться от процесса с тем же pid - продолжаем его.
+        for key, position, _ in _read_entries(self._mmap, self._used):
+            self._positions[key] = position
+        if name is None:
+            self._merge_finished_processes()
+
+    def close(self) -> None:
+        self._mmap.close()
+        self._file.close()
+
+    def _merge_finished_processes(self) -> None:
+        """Сложить значения завершившихся процессов в `MERGED_FILE` и удалить их файлы."""
+        # Под блокировкой: два новых воркера не должны сложить один файл дважды.
+        with open(os.path.join(self.directory, "merge.lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            finished = []
+            for path in glob.glob(os.path.join(self.directory, "metrics-*.db")):
+                match = PROCESS_FILE.fullmatch(os.path.basename(path))
+                if match and int(match.group(1)) != os.getpid() and not _is_running(int(match.group(1))):
+                    finished.append(path)
+            if not finished:
+                return
+            merged = MmapValues(self.directory, MERGED_FILE)
+            try:
+                for path in finished:
+                    with open(path, "rb") as file:
+                        data = file.read()
+                    if len(data) >= 8:
+                        for key, _, value in _read_entries(data, struct.unpack_from("q", data, 0)[0]):
+                            merged.add(key, value)
+                    # Если процесс упадет между сложением и удалением, значения файла посчитаются дважды.
+                    os.unlink(path)
+            finally:
+                merged.close()
+
+    def add(self, key: str, amount: float) -> None:
+        with self._lock:
+            position = self._positions.get(key)
+            if position is None:
+                position = self._append(key)
+            value = struct.unpack_from("d", self._mmap, position)[0]
+            struct.pack_into("d", self._mmap, position, value + amount)
+
+    def _append(self, key: str) -> int:
+        encoded = key.encode()
+        padded_length = 4 + len(encoded) + (-(4 + len(encoded)) % 8)
+        entry_size = padded_length + 8
+        if self._used + entry_size > self._capacity:
+            self._grow(self._used + entry_size)
+        struct.pack_into(f"i{padded_length - 4}sd", self._mmap, self._used, len(encoded), encoded, 0.0)
+        position = self._used + padded_length
+        self._used += entry_size
+        # Размер пишется последним: читатель видит только полностью записанные записи.
+        struct.pack_into("q", self._mmap, 0, self._used)
+        self._positions[key] = position
+        return position
+
+    def _grow(self, required: int) -> None:
+        capacity = self._capacity
+        while capacity < required:
+            capacity *= 2
+        self._mmap.close()
+        self._file.truncate(capacity)
+        self._capacity = capacity
+        self._mmap = mmap.mmap(self._file.fileno(), capacity)
+
+    def collect(self) -> dict[str, float]:
+        """Сумма значений всех процессов."""
+        totals: dict[str, float] = defaultdict(float)
+        for path in glob.glob(os.path.join(self.directory, "metrics-*.db")):
+            try:
+                with open(path, "rb") as file:
+                    data = file.read()
+            except OSError:
+                continue
+            if len(data) < 8:
+                continue
+            for key, _, value in _read_entries(data, struct.unpack_from("q", data, 0)[0]):
+                totals[key] += value
+        return dict(totals)
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Процесс есть, но принадлежит другому пользователю.
+        return True
+    return True
+
+
+def _read_entries(data, used: int):
+    position = 8
+    while position + 4 <= used:
+        length = struct.unpack_from("i", data, position)[0]
+        padded_length = 4 + length + (-(4 + length) % 8)
+        key = bytes(data[position + 4:position + 4 + length]).decode()
+        value_position = position + padded_length
+        yield key, value_position, struct.unpack_from("d", data, value_position)[0]
+        position = value_position + 8
+
+
+_values = None
+_values_pid = None
+_values_lock = threading.Lock()
+
+
+def get_values():
+    global _values, _values_pid
+    # После fork (gunicorn --preload) у воркера должен быть свой файл.
+    if _values is None or _values_pid != os.getpid():
+        with _values_lock:
+            if _values is None or _values_pid != os.getpid():
+                directory = get_config()["DIR"]
+                _values = MmapValues(str(directory)) if directory else MemoryValues()
+                _values_pid = os.getpid()
+    return _values
+
+
+# Ключ значения: `имя|view|метка`, у гистограмм метка - граница корзины, `sum` или `count`.
+
+def _observe(values, name: str, view: str, value: float) -> None:
+    for bound in HISTOGRAMS[name][1]:
+        if value <= bound:
+            values.add(f"{name}|{view}|{bound}", 1)
+    values.add(f"{name}|{view}|sum", value)
+    values.add(f"{name}|{view}|count", 1)
+
+
+def observe_request(view: str, status: int, duration: float, metrics: RequestMetrics) -> None:
+    values = get_values()
+    _observe(values, "http_request_duration_seconds", view, duration)
+    _observe(values, "db_query_duration_seconds", view, metrics.sql_seconds)
+    _observe(values, "db_queries_per_request", view, metrics.sql_count)
+    if metrics.template_seconds:
+        _observe(values, "template_render_duration_seconds", view, metrics.template_seconds)
+    values.add(f"http_requests_total|{view}|{status // 100}xx", 1)
+    if metrics.cache_hits:
+        values.add(f"cache_requests_total|{view}|hit", metrics.cache_hits)
+    if metrics.cache_misses:
+        values.add(f"cache_requests_total|{view}|miss", metrics.cache_misses)
+
+
+def render_prometheus(values: dict[str, float]) -> str:
+    grouped: dict[str, list[tuple[str, str, float]]] = defaultdict(list)
+    for key, value in values.items():
+        name, view, label = key.split("|", 2)
+        grouped[name].append((view, label, value))
+
+    lines = []
+    for name, (description, buckets) in HISTOGRAMS.items():
+        lines += [f"# HELP {name} {description}", f"# TYPE {name} histogram"]
+        by_view: dict[str, dict[str, float]] = defaultdict(dict)
+        for view, label, value in grouped.get(name, []):
+            by_view[view][label] = value
+        for view, series in sorted(by_view.items()):
+            view_label = _escape(view)
+            for bound in buckets:
+                lines.append(f'{name}_bucket{{view="{view_label}",le="{bound}"}} {series.get(str(bound), 0):g}')
+            lines.append(f'{name}_bucket{{view="{view_label}",le="+Inf"}} {series.get("count", 0):g}')
+            lines.append(f'{name}_sum{{view="{view_label}"}} {series.get("sum", 0)}')
+            lines.append(f'{name}_count{{view="{view_label}"}} {series.get("count", 0):g}')
+
+    labels = {"http_requests_total": "status", "cache_requests_total": "result"}
+    for name, description in COUNTERS.items():
+        lines += [f"# HELP {name} {description}", f"# TYPE {name} counter"]
+        for view, label, value in sorted(grouped.get(name, [])):
+            lines.append(f'{name}{{view="{_escape(view)}",{labels[name]}="{label}"}} {value:g}')
+    return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return re.sub(r'(["\\])', r"\\\1", value).replace("\n", "\\n")
+
+
+# Middleware и view.
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        config = get_config()
+        if not config["ENABLED"]:
+            return self.get_response(request)
+
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        started = time.perf_counter()
+        try:
+            with execute_wrapper_all(_SQLTimer(metrics)):
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        duration = time.perf_counter() - started
+
+        match = getattr(request, "resolver_match", None)
+        view = match.view_name if match is not None else "<unresolved>"
+        observe_request(view, response.status_code, duration, metrics)
+
+        user = getattr(request, "user", None)
+        if config["SERVER_TIMING"] and user is not None and user.is_staff:
+            response["Server-Timing"] = ", ".join([
+                f"total;dur={duration * 1000:.1f}",
+                f'db;dur={metrics.sql_seconds * 1000:.1f};desc="{metrics.sql_count} SQL"',
+                f'cache;desc="hit {metrics.cache_hits} / miss {metrics.cache_misses}"',
+                f"tpl;dur={metrics.template_seconds * 1000:.1f}",
+            ])
+        return response
+
+
+@never_cache
+def metrics_view(request):
+    config = get_config()
+    token = config["TOKEN"]
+    user = getattr(request, "user", None)
+    allowed = (
+        request.META.get("REMOTE_ADDR") in config["ALLOWED_IPS"]
+        or (token and hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"))
+        or (user is not None and user.is_staff)
+    )
+    if not allowed:
+        return HttpResponseForbidden()
+    return HttpResponse(
+        render_prometheus(get_values().collect()), content_type="text/plain; version=0.0.4; charset=utf-8",
+    )
@@ -0,0 +1,58 @@
+# Generated by Django 5.0 on 2026-10-18 20:05
+
+import django.contrib.postgres.search
+from django.conf import settings
+from django.db import migrations
+
+
+SEARCH_CONFIG = getattr(settings, "NOTES_SEARCH_CONFIG", "russian")
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "postgresql":
+        schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        schema_editor.execute(
+            "CREATE INDEX IF NOT EXISTS posts_note_search_vector_gin ON posts_note USING gin (search_vector)"
+        )
+        schema_editor.execute(
+            "CREATE INDEX IF NOT EXISTS posts_note_title_trgm ON posts_note USING gin (title gin_trgm_ops)"
+        )
+        schema_editor.execute(
+            "UPDATE posts_note SET search_vector = "
+            "setweight(to_tsvector(%s::regconfig, coalesce(title, '')), 'A') || "
+            "setweight(to_tsvector(%s::regconfig, coalesce(content, '')), 'B')",
+            [SEARCH_CONFIG, SEARCH_CONFIG],
+        )
+    elif vendor == "sqlite":
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS posts_note_fts USING fts5(uuid UNINDEXED, title, content)"
+        )
+        schema_editor.execute(
+            "INSERT INTO posts_note_fts (uuid, title, content) SELECT uuid, title, content FROM posts_note"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "postgresql":
+        schema_editor.execute("DROP INDEX IF EXISTS posts_note_title_trgm")
+        schema_editor.execute("DROP INDEX IF EXISTS posts_note_search_vector_gin")
+    elif vendor == "sqlite":
+        schema_editor.execute("DROP TABLE IF EXISTS posts_note_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='note',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.0 on 2026-10-18 20:15
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0002_note_search_vector'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HistoryEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('viewed_at', models.DateTimeField()),
+                ('note', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='history_entries', to='posts.note')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='history', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', '-viewed_at'], name='history_entry_user_viewed_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='historyentry',
+            constraint=models.UniqueConstraint(fields=('user', 'note'), name='history_entry_user_note_unique'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0 on 2026-10-18 20:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0004_outbox_email'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='note',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.0 on 2026-10-18 20:30
+
+import posts.models
+import posts.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0005_note_image_variants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('size', models.BigIntegerField()),
+                ('ref_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='note',
+            name='image',
+            field=models.ImageField(blank=True, null=True, storage=posts.storage.get_content_addressed_storage, upload_to=posts.models.upload_to, verbose_name='Превью'),
+        ),
+    ]
@@ -0,0 +1,80 @@
+# Generated by Django 5.0 on 2026-10-18 22:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class AddIndexConcurrentlyOnPostgres(AddIndexConcurrently):
+    """На Postgres - `CREATE INDEX CONCURRENTLY` (без блокировки записи в таблицу), на остальных базах - `AddIndex`."""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == "postgresql":
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+        else:
+            migrations.AddIndex.database_forwards(self, app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == "postgresql":
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+        else:
+            migrations.AddIndex.database_backwards(self, app_label, schema_editor, from_state, to_state)
+
+
+def create_note_tags_index(apps, schema_editor):
+    # Таблица связей `Note.tags` создается Django, индекс `(tag_id, note_id)` добавляем сами:
+    # заметки тега читаются только из индекса.
+    concurrently = "CONCURRENTLY " if schema_editor.connection.vendor == "postgresql" else ""
+    schema_editor.execute(
+        f"CREATE INDEX {concurrently}IF NOT EXISTS posts_note_tags_tag_note_idx ON posts_note_tags (tag_id, note_id)"
+    )
+
+
+def drop_note_tags_index(apps, schema_editor):
+    concurrently = "CONCURRENTLY " if schema_editor.connection.vendor == "postgresql" else ""
+    schema_editor.execute(f"DROP INDEX {concurrently}IF EXISTS posts_note_tags_tag_note_idx")
+
+
+class Migration(migrations.Migration):
+    # `CREATE INDEX CONCURRENTLY` нельзя выполнять в транзакции.
+    atomic = False
+
+    dependencies = [
+        ('posts', '0008_counters'),
+    ]
+
+    operations = [
+        AddIndexConcurrentlyOnPostgres(
+            model_name='note',
+            index=models.Index(fields=['-mod_time', '-uuid'], name='note_mod_time_uuid_idx'),
+        ),
+        AddIndexConcurrentlyOnPostgres(
+            model_name='note',
+            index=models.Index(fields=['-created_at', '-uuid'], name='note_created_at_uuid_idx'),
+        ),
+        AddIndexConcurrentlyOnPostgres(
+            model_name='note',
+            index=models.Index(fields=['user', '-mod_time', '-uuid'], name='note_user_mod_time_uuid_idx'),
+        ),
+        AddIndexConcurrentlyOnPostgres(
+            model_name='user',
+            index=models.Index(fields=['email'], name='users_email_idx'),
+        ),
+        AddIndexConcurrentlyOnPostgres(
+            model_name='usertagcounter',
+            index=models.Index(condition=models.Q(('note_count__gt', 0)), fields=['user', '-note_count'], name='user_tag_counter_count_idx'),
+        ),
+        migrations.RunPython(create_note_tags_index, drop_note_tags_index),
+        # Одиночные индексы заменены составными выше.
+        migrations.AlterField(
+            model_name='note',
+            name='mod_time',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AlterField(
+            model_name='note',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='Владелец'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.0 on 2026-10-18 23:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0009_hot_query_indexes'),
+    ]
+
+    operations = [
+        # Колонка без значения по умолчанию: на Postgres добавляется без перезаписи таблицы.
+        # У существующих заметок версия берется из `mod_time` / `created_at` (см. `Note.version`).
+        migrations.AddField(
+            model_name='note',
+            name='changed_at',
+            field=models.DateTimeField(auto_now=True, null=True),
+        ),
+    ]
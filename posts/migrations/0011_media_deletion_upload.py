@@ -0,0 +1,18 @@
+# Generated by Django 5.0 on 2026-10-18 23:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0010_note_changed_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mediadeletion',
+            name='kind',
+            field=models.CharField(choices=[('file', 'Файл хранилища'), ('directory', 'Папка'), ('upload', 'Загрузка через API')], default='file', max_length=10),
+        ),
+    ]
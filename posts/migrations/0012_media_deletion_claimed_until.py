@@ -0,0 +1,18 @@
+# Generated by Django 5.0 on 2026-10-18 23:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0011_media_deletion_upload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mediadeletion',
+            name='claimed_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.0 on 2026-10-19 00:40
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0012_media_deletion_claimed_until'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageVariantTask',
+            fields=[
+                ('note', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='image_variant_task', serialize=False, to='posts.note')),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['next_attempt_at'], name='image_variant_task_next_idx')],
+            },
+        ),
+    ]
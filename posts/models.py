@@ -1,12 +1,14 @@
-import pathlib
 import uuid
 
-from django.conf import settings
-from django.db.models.signals import post_delete
+from django.contrib.postgres.search import SearchVectorField
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 from django.dispatch import receiver
 from django.contrib.auth.models import AbstractUser
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
+
+from .storage import get_content_addressed_storage
 
 
 class User(AbstractUser):
@@ -18,11 +20,32 @@ class User(AbstractUser):
 
     class Meta:
         db_table = "users"
+        indexes = [
+            # Поиск по email при регистрации и сбросе пароля.
+            models.Index(fields=["email"], name="users_email_idx"),
+        ]
+
+
+class TagManager(models.Manager):
+    def get_or_create_many(self, names) -> list["Tag"]:
+        """
+        Получить теги по именам, создав недостающие.
+        Всегда два запроса, независимо от кол-ва тегов:
+        вставка с `ON CONFLICT DO NOTHING` и выборка.
+        """
+        names = list(dict.fromkeys(names))  # Убираем повторы, сохраняя порядок.
+        if not names:
+            return []
+        self.bulk_create([Tag(name=name) for name in names], ignore_conflicts=True)
+        tags = {tag.name: tag for tag in self.filter(name__in=names)}
+        return [tags[name] for name in names]
 
 
 class Tag(models.Model):
     name = models.CharField(max_length=50, unique=True)
 
+    objects = TagManager()
+
     def __str__(self):
         return self.name
 
@@ -39,25 +62,346 @@ class Note(models.Model):
     title = models.CharField(max_length=255)
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
-    image = models.ImageField(upload_to=upload_to, null=True, blank=True, verbose_name="Превью")
+    # Файлы хранятся по хэшу содержимого, одинаковые картинки не дублируются (см. `posts/storage.py`).
+    image = models.ImageField(
+        upload_to=upload_to, storage=get_content_addressed_storage, null=True, blank=True, verbose_name="Превью",
+    )
+    # Уменьшенные копии `image` (в том числе WebP), см. `posts/images.py`.
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     objects = models.Manager()  # Он подключается к базе.
-    mod_time = models.DateTimeField(null=True, blank=True, db_index=True, default=None)
+    mod_time = models.DateTimeField(null=True, blank=True, default=None)
+    # Любое изменение заметки, в том числе копий картинки и тегов (`mod_time` - только правка автором).
+    # По нему строятся ETag / Last-Modified и версия кэша карточки. NULL у заметок до миграции 0010.
+    changed_at = models.DateTimeField(auto_now=True, null=True, editable=False)
     tags = models.ManyToManyField(Tag, related_name="notes", verbose_name="Теги")
+    # Поисковый вектор (заголовок с весом A, содержимое с весом B), см. `posts/search.py`.
+    search_vector = SearchVectorField(null=True, editable=False)
 
-    user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, verbose_name="Владелец")
+    # Отдельный индекс по `user_id` не нужен: это первая колонка `note_user_mod_time_uuid_idx`.
+    user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, db_index=False, verbose_name="Владелец")
     # `on_delete=models.CASCADE`
     # При удалении пользователя, удалятся все его записи.
 
     class Meta:
         # db_table = 'notes'  # Название таблицы в базе.
         ordering = ['-mod_time']  # Дефис это означает DESC сортировку (обратную).
+        # Индексы под сортировку `KeysetPaginator` (`-<поле>`, `-uuid`, NULL первыми),
+        # поэтому страницы читаются по индексу без сортировки. См. `posts/query_plans.py`.
+        indexes = [
+            models.Index(fields=["-mod_time", "-uuid"], name="note_mod_time_uuid_idx"),
+            models.Index(fields=["-created_at", "-uuid"], name="note_created_at_uuid_idx"),
+            models.Index(fields=["user", "-mod_time", "-uuid"], name="note_user_mod_time_uuid_idx"),
+        ]
+
+    def save(self, *args, **kwargs):
+        # `post_save` (счетчики заметок, `posts/counters.py`) выполняется после INSERT / UPDATE
+        # вне транзакции `save`: объединяем их, чтобы ошибка счетчика откатила и запись.
+        # Удаление и `tags.add/remove` Django и так выполняет с сигналами в одной транзакции.
+        with transaction.atomic(savepoint=False):
+            super().save(*args, **kwargs)
+
+    @property
+    def version(self):
+        """Время последнего изменения заметки."""
+        return self.changed_at or self.mod_time or self.created_at
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Запоминаем картинку из базы, чтобы после замены освободить старый файл.
+        instance._loaded_image_name = instance.__dict__.get("image")
+        # И владельца - для счетчиков заметок (см. `posts/counters.py`).
+        instance._loaded_user_id = instance.__dict__.get("user_id")
+        return instance
+
+
+class StoredFile(models.Model):
+    """Файл в хранилище по содержимому и кол-во ссылок на него (см. `posts/storage.py`)."""
+
+    name = models.CharField(max_length=255, unique=True)
+    size = models.BigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class UserNoteCounter(models.Model):
+    """Кол-во заметок пользователя (см. `posts/counters.py`)."""
+
+    user = models.OneToOneField(
+        get_user_model(), on_delete=models.CASCADE, primary_key=True, related_name="note_counter",
+    )
+    note_count = models.IntegerField(default=0)
+
+
+class TagNoteCounter(models.Model):
+    """Кол-во заметок с тегом (см. `posts/counters.py`)."""
+
+    tag = models.OneToOneField(Tag, on_delete=models.CASCADE, primary_key=True, related_name="note_counter")
+    note_count = models.IntegerField(default=0)
+
+
+class UserTagCounter(models.Model):
+    """Кол-во заметок пользователя с тегом (см. `posts/counters.py`)."""
+
+    user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, related_name="tag_counters")
+    tag = models.ForeignKey(Tag, on_delete=models.CASCADE, related_name="user_counters")
+    note_count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "tag"], name="user_tag_counter_unique"),
+        ]
+        indexes = [
+            # Теги в профиле: теги пользователя с заметками, по убыванию кол-ва.
+            models.Index(
+                fields=["user", "-note_count"], condition=models.Q(note_count__gt=0), name="user_tag_counter_count_idx",
+            ),
+        ]
+
+
+class MediaDeletionManager(models.Manager):
+    def enqueue(self, files=(), directories=(), uploads=()) -> None:
+        """Поставить файлы хранилища и папки в `MEDIA_ROOT` в очередь на удаление."""
+        self.bulk_create(
+            [self.model(name=name, kind=self.model.Kind.FILE) for name in files if name]
+            + [self.model(name=name, kind=self.model.Kind.DIRECTORY) for name in directories if name]
+            + [self.model(name=name, kind=self.model.Kind.UPLOAD) for name in uploads if name]
+        )
+
+
+class MediaDeletion(models.Model):
+    """
+    Очередь удаления медиа файлов.
+    Сигналы только добавляют сюда записи, удаляет файлы команда `collect_media`.
+
+    `UPLOAD` - ссылка на файл, загруженный через API (`UploadImageAPIView`) для вставки в текст
+    заметки. Она освобождается, когда ни одна заметка не ссылается на файл (и не раньше `--min-age`).
+    """
+
+    class Kind(models.TextChoices):
+        FILE = "file", "Файл хранилища"
+        DIRECTORY = "directory", "Папка"
+        UPLOAD = "upload", "Загрузка через API"
+
+    name = models.CharField(max_length=255)
+    kind = models.CharField(max_length=10, choices=Kind, default=Kind.FILE)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # До этого времени запись обрабатывает другой запуск `collect_media` (захват без блокировки строк).
+    claimed_until = models.DateTimeField(null=True, blank=True)
+
+    objects = MediaDeletionManager()
+
+
+class HistoryEntry(models.Model):
+    """История просмотров заметок пользователем (см. `posts/history_service.py`)."""
+
+    user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, related_name="history")
+    note = models.ForeignKey(Note, on_delete=models.CASCADE, related_name="history_entries")
+    viewed_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "note"], name="history_entry_user_note_unique"),
+        ]
+        indexes = [
+            models.Index(fields=["user", "-viewed_at"], name="history_entry_user_viewed_idx"),
+        ]
+
+
+class OutboxEmail(models.Model):
+    """
+    Очередь исходящих писем.
+    `BaseEmailSender.send_mail` только сохраняет письмо, отправляет его команда `send_outbox`.
+    """
+
+    class Status(models.TextChoices):
+        PENDING = "pending", "Ожидает отправки"
+        SENT = "sent", "Отправлено"
+        DEAD = "dead", "Не удалось отправить"
+
+    subject = models.CharField(max_length=998)
+    from_email = models.CharField(max_length=254)
+    to = models.JSONField()
+    body = models.TextField(blank=True)
+    html_body = models.TextField(blank=True)
+    status = models.CharField(max_length=10, choices=Status, default=Status.PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Воркер выбирает только письма, которые ждут отправки.
+            models.Index(
+                fields=["next_attempt_at"], condition=models.Q(status="pending"), name="outbox_pending_idx",
+            ),
+        ]
+
+
+class ImageVariantTask(models.Model):
+    """
+    Очередь создания уменьшенных копий картинок (см. `posts/images.py`).
+    Сигнал `Note` только добавляет сюда запись в транзакции сохранения заметки,
+    копии создает команда `generate_image_variants`, а не процесс веб-сервера.
+    """
+
+    note = models.OneToOneField(Note, on_delete=models.CASCADE, primary_key=True, related_name="image_variant_task")
+    # После `--max-attempts` неудачных попыток задача остается в таблице, но не выполняется (видна в админке).
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["next_attempt_at"], name="image_variant_task_next_idx"),
+        ]
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_api_auth_cache(sender, instance: User, **kwargs):
+    # Смена пароля или деактивация должна сразу действовать и для закэшированных токенов.
+    from .api.authentication import invalidate_user
+
+    invalidate_user(instance.pk)
+
+
+@receiver(post_save, sender=Note)
+def update_note_search_index(sender, instance: Note, raw=False, **kwargs):
+    if raw:
+        return
+    from .search import get_search_backend
+
+    get_search_backend().update_note(instance)
+
+
+@receiver(post_delete, sender=Note)
+def remove_note_from_search_index(sender, instance: Note, **kwargs):
+    from .search import get_search_backend
+
+    get_search_backend().remove_note(instance)
+
+
+@receiver(post_save, sender=Note)
+def update_note_image_variants(sender, instance: Note, raw=False, **kwargs):
+    if raw:
+        return
+    from .images import schedule_variants, variant_file_names, variants_are_current
+
+    if variants_are_current(instance):
+        return
+    if instance.image:
+        # Копии создает воркер `generate_image_variants`, до этого шаблоны показывают оригинал.
+        schedule_variants([instance])
+    else:
+        # Файлы копий удаляет `collect_media`, а не запрос.
+        MediaDeletion.objects.enqueue(files=variant_file_names(instance.image_variants))
+        Note.objects.filter(pk=instance.pk).update(image_variants={})
+        instance.image_variants = {}
+
+
+@receiver(post_save, sender=Note)
+def release_replaced_note_image(sender, instance: Note, raw=False, **kwargs):
+    if raw or "image" not in instance.__dict__:
+        return
+    loaded_name = getattr(instance, "_loaded_image_name", None)
+    current_name = instance.image.name if instance.image else None
+    if loaded_name and loaded_name != current_name:
+        MediaDeletion.objects.enqueue(files=[loaded_name])
+    instance._loaded_image_name = current_name
+
+
+@receiver(post_save, sender=Note)
+@receiver(post_delete, sender=Note)
+def invalidate_note_card(sender, instance: Note, **kwargs):
+    from .fragment_cache import invalidate_note_cards
+
+    invalidate_note_cards([instance.uuid])
+
+
+def _tags_changed_note_uuids(instance, action: str, reverse: bool, pk_set) -> list:
+    """Заметки, у которых изменились теги (сигнал `m2m_changed`)."""
+    if not reverse:
+        # `note.tags.add(...)` - изменилась одна заметка.
+        changed = action == "post_clear" or (action in ("post_add", "post_remove") and pk_set)
+        return [instance.uuid] if changed else []
+    if action == "pre_clear":
+        # `tag.notes.clear()` - `pk_set` не передается, берем заметки до очистки.
+        return list(instance.notes.values_list("uuid", flat=True))
+    if action in ("post_add", "post_remove"):
+        return list(pk_set)
+    return []
+
+
+@receiver(m2m_changed, sender=Note.tags.through)
+def note_tags_changed(sender, instance, action: str, reverse: bool, pk_set, **kwargs):
+    from .fragment_cache import invalidate_note_cards
+
+    note_uuids = _tags_changed_note_uuids(instance, action, reverse, pk_set)
+    if not note_uuids:
+        return
+    # `m2m_changed` не сохраняет заметку - новая версия для ETag / Last-Modified.
+    changed_at = timezone.now()
+    Note.objects.filter(uuid__in=note_uuids).update(changed_at=changed_at)
+    if not reverse:
+        instance.changed_at = changed_at
+    invalidate_note_cards(note_uuids)
+
+
+@receiver(post_save, sender=Note)
+def update_note_counters(sender, instance: Note, created: bool, raw=False, **kwargs):
+    if raw:
+        return
+    from . import counters
+
+    loaded_user_id = instance.__dict__.get("_loaded_user_id")
+    if created:
+        counters.change_user_notes(instance.user_id, 1)
+    elif loaded_user_id is not None and loaded_user_id != instance.user_id:
+        counters.move_note(instance, loaded_user_id)
+    instance._loaded_user_id = instance.user_id
+
+
+@receiver(pre_delete, sender=Note)
+def remember_note_tags(sender, instance: Note, **kwargs):
+    # Связи с тегами удаляются каскадом без сигнала `m2m_changed`.
+    instance._deleted_tag_ids = list(instance.tags.values_list("pk", flat=True))
+
+
+@receiver(post_delete, sender=Note)
+def update_counters_on_note_delete(sender, instance: Note, **kwargs):
+    from . import counters
+
+    counters.change_user_notes(instance.user_id, -1)
+    counters.change_tag_notes([(instance.user_id, tag_id) for tag_id in instance._deleted_tag_ids], -1)
+
+
+@receiver(m2m_changed, sender=Note.tags.through)
+def update_counters_on_tags_change(sender, instance, action: str, reverse: bool, pk_set, **kwargs):
+    from . import counters
+
+    if action in ("pre_remove", "pre_clear"):
+        # Запоминаем связи, которые действительно будут удалены.
+        instance._removed_tag_pairs = counters.get_tag_pairs(instance, reverse, pk_set)
+    elif action in ("post_remove", "post_clear"):
+        counters.change_tag_notes(instance.__dict__.pop("_removed_tag_pairs", []), -1)
+    elif action == "post_add":
+        # Django передает только новые связи.
+        counters.change_tag_notes(counters.get_tag_pairs(instance, reverse, pk_set, through=False), 1)
 
 
 @receiver(post_delete, sender=Note)
 def after_delete_note(sender, instance: Note, **kwargs):
     if instance.image:
-        note_media_folder: pathlib.Path = (settings.MEDIA_ROOT / str(instance.uuid))
+        from .images import variant_file_names
 
-        for file in note_media_folder.glob("*"):
-            file.unlink(missing_ok=True)
-        note_media_folder.rmdir()
+        # Файлы удалит команда `collect_media`. Картинка может использоваться другими заметками,
+        # хранилище удалит ее по счетчику ссылок.
+        # Папка заметки - картинки, загруженные до хранения по содержимому.
+        MediaDeletion.objects.enqueue(
+            files=[instance.image.name, *variant_file_names(instance.image_variants)],
+            directories=[str(instance.uuid)],
+        )
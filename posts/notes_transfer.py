@@ -0,0 +1,397 @@
+"""
+Потоковая выгрузка и загрузка заметок в NDJSON (команды `export_notes` и `import_notes`).
+
+Одна строка - одна заметка:
+
+    {"uuid": "...", "title": "...", "content": "...", "created_at": "2024-01-01T00:00:00+00:00",
+     "mod_time": null, "user": "username", "tags": ["python"], "image": "cas/ab/cd/...jpg", "image_variants": {}}
+
+* Файл может быть сжат gzip (`.gz`) или zstd (`.zst`, нужен пакет `zstandard`: `poetry install -E zstd`).
+  При загрузке сжатие определяется по первым байтам файла.
+* Выгрузка идет по первичному ключу через `iterator(chunk_size=...)` (на Postgres - серверный курсор),
+  в памяти всегда одна пачка заметок, сколько бы их ни было в базе.
+* Загрузка идет пачками. Пользователи и теги ищутся по именам одним запросом на пачку,
+  заметки и связи с тегами вставляются через `COPY` на Postgres и `bulk_create` на остальных базах.
+  Заметки, которые уже есть в базе (по `uuid`), пропускаются. Пользователи переносятся только по имени:
+  недостающие создаются без пароля. Картинки ссылаются на файлы хранилища - сами файлы переносятся
+  отдельно, у заметок с отсутствующими файлами картинка убирается.
+  Сигналы при вставке не работают, поэтому счетчики (`posts/counters.py`), поисковый индекс
+  и ссылки на файлы (`StoredFile`) обновляются для каждой пачки явно, в ее транзакции.
+* После каждой пачки пишется контрольная точка (`<файл>.checkpoint`), с нее продолжается прерванная работа.
+  При выгрузке со сжатием каждая пачка - отдельный gzip member / zstd frame, поэтому файл,
+  обрезанный по контрольной точке, остается корректным.
+"""
+import gzip
+import io
+import json
+import os
+import sys
+import uuid
+from dataclasses import asdict, dataclass
+from itertools import islice
+
+from django.contrib.auth.hashers import make_password
+from django.db import connection, models, transaction
+from django.db.models.sql import InsertQuery
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import counters
+from .models import Note, Tag, User
+from .search import get_search_backend
+from .storage import content_addressed_storage
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+EXPORT_FIELDS = (
+    "uuid", "title", "content", "created_at", "mod_time", "user__username", "image", "image_variants",
+)
+
+
+@dataclass
+class ImportStats:
+    imported: int = 0
+    skipped: int = 0  # Уже были в базе.
+    created_users: int = 0
+    missing_images: int = 0
+
+
+def compression_for(path: str, compression: str | None = None) -> str | None:
+    """Сжатие файла: явно заданное или по расширению (`.gz`, `.zst`)."""
+    if compression:
+        return None if compression == "none" else compression
+    if path.endswith(".gz"):
+        return "gzip"
+    if path.endswith(".zst"):
+        return "zstd"
+    return None
+
+
+def _require_zstd() -> None:
+    if zstandard is None:
+        raise RuntimeError("Для zstd нужен пакет `zstandard`")
+
+
+def _batches(iterable, size: int):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+# Контрольные точки.
+
+def checkpoint_path_for(path: str, checkpoint: str | None = None) -> str | None:
+    """Файл контрольной точки для `path` (у stdin / stdout ее нет)."""
+    if path == "-":
+        return None
+    return checkpoint or f"{path}.checkpoint"
+
+
+def _load_checkpoint(path: str | None, resume: bool) -> dict | None:
+    checkpoint = read_checkpoint(path)
+    if checkpoint is not None and not resume:
+        # Чтобы случайный повторный запуск не начал работу заново.
+        raise ValueError(f"Есть контрольная точка {path}: запустите с --resume или удалите ее")
+    return checkpoint
+
+
+def read_checkpoint(path: str | None) -> dict | None:
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def write_checkpoint(path: str, data: dict) -> None:
+    # Через временный файл: при сбое остается прошлая контрольная точка, а не половина новой.
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(data, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+def remove_checkpoint(path: str | None) -> None:
+    if path is not None and os.path.exists(path):
+        os.unlink(path)
+
+
+# Выгрузка.
+
+def export_notes(path: str, compression: str | None = None, batch_size: int = 2000,
+                 checkpoint_path: str | None = None, resume: bool = False, progress=None) -> int:
+    """Выгрузить все заметки в `path` (`-` - stdout). Возвращает кол-во выгруженных заметок."""
+    if compression == "zstd":
+        _require_zstd()
+    checkpoint = _load_checkpoint(checkpoint_path, resume)
+
+    if path == "-":
+        output = sys.stdout.buffer
+    elif checkpoint is not None:
+        # Все, что записано после контрольной точки, выгрузится заново.
+        output = open(path, "r+b")
+        output.truncate(checkpoint["offset"])
+        output.seek(checkpoint["offset"])
+    else:
+        output = open(path, "wb")
+
+    notes = Note.objects.all()
+    exported = 0
+    if checkpoint is not None:
+        notes = notes.filter(uuid__gt=checkpoint["last_uuid"])
+        exported = checkpoint["exported"]
+
+    try:
+        for records in iter_record_batches(notes, batch_size):
+            output.write(_encode_records(records, compression))
+            exported += len(records)
+            if checkpoint_path is not None:
+                output.flush()
+                os.fsync(output.fileno())
+                write_checkpoint(checkpoint_path, {
+                    "last_uuid": records[-1]["uuid"], "exported": exported, "offset": output.tell(),
+                })
+            if progress is not None:
+                progress(exported)
+    finally:
+        if output is sys.stdout.buffer:
+            output.flush()
+        else:
+            output.close()
+
+    remove_checkpoint(checkpoint_path)
+    return exported
+
+
+def iter_record_batches(queryset, batch_size: int = 2000):
+    """
+    Заметки `queryset` в формате выгрузки, списками по `batch_size` (по возрастанию `uuid`).
+    Строки читаются через `iterator` (на Postgres - серверный курсор), теги - одним запросом на пачку.
+    """
+    rows = queryset.order_by("uuid").values_list(*EXPORT_FIELDS)
+    for batch in _batches(rows.iterator(chunk_size=batch_size), batch_size):
+        yield _records(batch)
+
+
+def _records(rows: list[tuple]) -> list[dict]:
+    tags: dict[uuid.UUID, list[str]] = {}
+    links = (
+        Note.tags.through.objects.filter(note_id__in=[row[0] for row in rows])
+        .order_by("tag__name").values_list("note_id", "tag__name")
+    )
+    for note_id, name in links:
+        tags.setdefault(note_id, []).append(name)
+
+    return [
+        {
+            "uuid": str(note_uuid),
+            "title": title,
+            "content": content,
+            "created_at": created_at.isoformat(),
+            "mod_time": mod_time.isoformat() if mod_time else None,
+            "user": username,
+            "tags": tags.get(note_uuid, []),
+            "image": image or None,
+            "image_variants": image_variants or {},
+        }
+        for note_uuid, title, content, created_at, mod_time, username, image, image_variants in rows
+    ]
+
+
+def encode_record(record: dict) -> str:
+    """Строка NDJSON (с переводом строки)."""
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+
+def _encode_records(records: list[dict], compression: str | None) -> bytes:
+    data = "".join(encode_record(record) for record in records).encode()
+    if compression == "gzip":
+        return gzip.compress(data, compresslevel=6)
+    if compression == "zstd":
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+# Загрузка.
+
+def open_ndjson(path: str) -> io.TextIOWrapper:
+    """Открыть NDJSON на чтение (`-` - stdin), сжатие определяется по первым байтам."""
+    raw = sys.stdin.buffer if path == "-" else open(path, "rb")
+    magic = raw.peek(4)[:4]
+    if magic.startswith(GZIP_MAGIC):
+        stream = gzip.GzipFile(fileobj=raw)
+    elif magic == ZSTD_MAGIC:
+        _require_zstd()
+        stream = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True))
+    else:
+        stream = raw
+    return io.TextIOWrapper(stream, encoding="utf-8")
+
+
+def import_notes(path: str, batch_size: int = 5000, checkpoint_path: str | None = None,
+                 resume: bool = False, progress=None) -> ImportStats:
+    """Загрузить заметки из NDJSON файла `path` (`-` - stdin)."""
+    checkpoint = _load_checkpoint(checkpoint_path, resume)
+    stats = ImportStats(**checkpoint["stats"]) if checkpoint is not None else ImportStats()
+    done_lines = checkpoint["line"] if checkpoint is not None else 0
+
+    with open_ndjson(path) as lines:
+        numbered = enumerate(lines, start=1)
+        # Пропускаем строки, загруженные до контрольной точки.
+        next(islice(numbered, done_lines, done_lines), None)
+        for batch in _batches(numbered, batch_size):
+            records = [_parse_line(number, line) for number, line in batch if line.strip()]
+            _import_batch(records, stats)
+            if checkpoint_path is not None:
+                write_checkpoint(checkpoint_path, {"line": batch[-1][0], "stats": asdict(stats)})
+            if progress is not None:
+                progress(stats)
+
+    remove_checkpoint(checkpoint_path)
+    return stats
+
+
+def _parse_line(number: int, line: str) -> dict:
+    try:
+        record = json.loads(line)
+        record["uuid"] = uuid.UUID(record["uuid"])
+        for key in ("title", "content", "user"):
+            if not isinstance(record.get(key), str):
+                raise ValueError(f"нет поля `{key}`")
+    except (ValueError, KeyError, TypeError, AttributeError) as error:
+        raise ValueError(f"Строка {number}: {error}") from error
+    return record
+
+
+def _import_batch(records: list[dict], stats: ImportStats) -> None:
+    by_uuid = {}
+    for record in records:
+        by_uuid.setdefault(record["uuid"], record)
+    existing = set(Note.objects.filter(uuid__in=list(by_uuid)).values_list("uuid", flat=True))
+    records = [record for note_uuid, record in by_uuid.items() if note_uuid not in existing]
+    stats.skipped += len(by_uuid) - len(records)
+    if not records:
+        return
+
+    user_ids = _resolve_users({record["user"] for record in records}, stats)
+    tag_ids = {
+        tag.name: tag.pk
+        for tag in Tag.objects.get_or_create_many(name for record in records for name in record.get("tags") or ())
+    }
+
+    notes = []
+    links = []
+    through = Note.tags.through
+    for record in records:
+        note = Note(
+            uuid=record["uuid"],
+            title=record["title"],
+            content=record["content"],
+            created_at=_parse_datetime(record.get("created_at")) or timezone.now(),
+            mod_time=_parse_datetime(record.get("mod_time")),
+            user_id=user_ids[record["user"]],
+            image=record.get("image") or "",
+            image_variants=record.get("image_variants") or {},
+        )
+        notes.append(note)
+        links.extend(
+            through(note_id=note.uuid, tag_id=tag_ids[name]) for name in dict.fromkeys(record.get("tags") or ())
+        )
+
+    with transaction.atomic():
+        missing = content_addressed_storage.add_references([note.image.name for note in notes if note.image])
+        for note in notes:
+            if note.image and note.image.name in missing:
+                note.image = ""
+                note.image_variants = {}
+                stats.missing_images += 1
+
+        _insert(Note, notes, [field for field in Note._meta.concrete_fields if field.name != "search_vector"])
+        _insert(through, links, [field for field in through._meta.concrete_fields if not field.primary_key])
+
+        user_by_note = {note.uuid: note.user_id for note in notes}
+        counters.add_notes(
+            [note.user_id for note in notes], [(user_by_note[link.note_id], link.tag_id) for link in links],
+        )
+        get_search_backend().reindex(Note.objects.filter(uuid__in=list(user_by_note)))
+
+    stats.imported += len(notes)
+
+
+def _parse_datetime(value: str | None):
+    return parse_datetime(value) if value else None
+
+
+def _resolve_users(usernames: set[str], stats: ImportStats) -> dict[str, int]:
+    user_ids = dict(User.objects.filter(username__in=usernames).values_list("username", "pk"))
+    missing = usernames - user_ids.keys()
+    if missing:
+        password = make_password(None)  # Войти по паролю нельзя, только после сброса.
+        User.objects.bulk_create([User(username=name, password=password) for name in missing], ignore_conflicts=True)
+        user_ids.update(User.objects.filter(username__in=missing).values_list("username", "pk"))
+        stats.created_users += len(missing)
+    return user_ids
+
+
+def _insert(model: type[models.Model], objects: list[models.Model], fields: list[models.Field]) -> None:
+    if not objects:
+        return
+    if connection.vendor != "postgresql":
+        insert_as_is(model, objects, fields)
+        return
+
+    # COPY в текстовом формате: колонки через табуляцию, NULL - `\N`.
+    data = "".join(
+        "\t".join(_copy_value(field, obj) for field in fields) + "\n"
+        for obj in objects
+    )
+    table = connection.ops.quote_name(model._meta.db_table)
+    columns = ", ".join(connection.ops.quote_name(field.column) for field in fields)
+    sql = f"COPY {table} ({columns}) FROM STDIN"
+    with connection.cursor() as cursor:
+        raw_cursor = cursor.cursor
+        if hasattr(raw_cursor, "copy_expert"):  # psycopg2
+            raw_cursor.copy_expert(sql, io.StringIO(data))
+        else:  # psycopg 3
+            with raw_cursor.copy(sql) as copy:
+                copy.write(data)
+
+
+def insert_as_is(model: type[models.Model], objects: list[models.Model], fields: list[models.Field] | None = None,
+                 batch_size: int = 1000) -> None:
+    """
+    `bulk_create` со значениями полей как есть (как `loaddata`): `pre_save` не вызывается,
+    поэтому `auto_now_add` / `auto_now` не подменяют заданные `created_at` и другие даты.
+    Сигналы не отправляются, первичные ключи должны быть заданы.
+    """
+    if fields is None:
+        fields = list(model._meta.concrete_fields)
+    batch_size = min(batch_size, connection.ops.bulk_batch_size(fields, objects) or batch_size)
+    with transaction.atomic(savepoint=False):
+        for start in range(0, len(objects), batch_size):
+            query = InsertQuery(model)
+            query.insert_values(fields, objects[start:start + batch_size], raw=True)
+            query.get_compiler(connection=connection).execute_sql()
+
+
+def _copy_value(field: models.Field, obj: models.Model) -> str:
+    value = getattr(obj, field.attname)
+    if isinstance(field, models.FileField):
+        value = value.name or ""
+    if value is None:
+        return r"\N"
+    if isinstance(field, models.JSONField):
+        value = json.dumps(value, ensure_ascii=False)
+    elif hasattr(value, "isoformat"):
+        value = value.isoformat()
+    return (
+        str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+    )
@@ -0,0 +1,200 @@
+import base64
+import binascii
+import json
+import uuid
+from datetime import datetime
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIRequest
+from django.db.models import F, Q, QuerySet
+from django.utils.dateparse import parse_datetime
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+class KeysetPage:
+    """Одна страница ленты заметок и курсоры на соседние страницы."""
+
+    def __init__(self, object_list: list, request: WSGIRequest, cursor_param: str,
+                 next_cursor: str | None, previous_cursor: str | None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self._request = request
+        self._cursor_param = cursor_param
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def has_next(self) -> bool:
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self) -> bool:
+        return self.previous_cursor is not None
+
+    @property
+    def next_url(self) -> str | None:
+        return self._build_url(self.next_cursor)
+
+    @property
+    def previous_url(self) -> str | None:
+        return self._build_url(self.previous_cursor)
+
+    def _build_url(self, cursor: str | None) -> str | None:
+        if cursor is None:
+            return None
+        # Сохраняем остальные параметры запроса (например `search`).
+        query = self._request.GET.copy()
+        query[self._cursor_param] = cursor
+        return "?" + query.urlencode()
+
+
+class KeysetPaginator:
+    """
+    Пагинация по ключу (cursor pagination) вместо OFFSET.
+
+    Записи упорядочены по `-<order_field>` с `uuid` в качестве второго ключа,
+    поэтому порядок всегда однозначный. NULL значения `order_field` идут первыми,
+    как и в сортировке Postgres по `-mod_time` по умолчанию.
+
+    Курсор хранит значения ключа последней (или первой) записи страницы,
+    поэтому новые заметки не сдвигают уже открытые страницы.
+    """
+
+    cursor_param = "cursor"
+
+    def __init__(self, queryset: QuerySet, order_field: str = "mod_time", page_size: int | None = None):
+        self.queryset = queryset
+        self.order_field = order_field
+        self.page_size = page_size or getattr(settings, "NOTES_PAGE_SIZE", 20)
+
+    def get_page(self, request: WSGIRequest) -> KeysetPage:
+        try:
+            position = self.decode_cursor(request.GET.get(self.cursor_param, ""))
+        except InvalidCursor:
+            position = None
+
+        if position is None:
+            rows = list(self._ordering(self.queryset, reverse=False)[:self.page_size + 1])
+            has_more = len(rows) > self.page_size
+            rows = rows[:self.page_size]
+            previous_cursor = None
+            next_cursor = self.encode_cursor(rows[-1], "next") if has_more else None
+
+        elif position["direction"] == "next":
+            queryset = self.queryset.filter(self._after(position["value"], position["uuid"]))
+            rows = list(self._ordering(queryset, reverse=False)[:self.page_size + 1])
+            has_more = len(rows) > self.page_size
+            rows = rows[:self.page_size]
+            next_cursor = self.encode_cursor(rows[-1], "next") if has_more else None
+            previous_cursor = self.encode_cursor(rows[0], "prev") if rows else None
+
+        else:
+            queryset = self.queryset.filter(self._before(position["value"], position["uuid"]))
+            rows = list(self._ordering(queryset, reverse=True)[:self.page_size + 1])
+            has_more = len(rows) > self.page_size
+            rows = rows[:self.page_size][::-1]
+            previous_cursor = self.encode_cursor(rows[0], "prev") if has_more else None
+            next_cursor = self.encode_cursor(rows[-1], "next") if rows else None
+
+        return KeysetPage(rows, request, self.cursor_param, next_cursor, previous_cursor)
+
+    def _ordering(self, queryset: QuerySet, reverse: bool) -> QuerySet:
+        if reverse:
+            return queryset.order_by(F(self.order_field).asc(nulls_last=True), "uuid")
+        return queryset.order_by(F(self.order_field).desc(nulls_first=True), "-uuid")
+
+    def _after(self, value, note_uuid: uuid.UUID) -> Q:
+        """Записи, которые идут после курсора в прямом порядке."""
+        field = self.order_field
+        if value is None:
+            return Q(**{f"{field}__isnull": True, "uuid__lt": note_uuid}) | Q(**{f"{field}__isnull": False})
+        # Первое условие дублирует второе, но без OR: по нему Postgres начинает чтение индекса
+        # с позиции курсора, а не с начала ленты.
+        return Q(**{f"{field}__lte": value}) & (
+            Q(**{f"{field}__lt": value}) | Q(**{field: value, "uuid__lt": note_uuid})
+        )
+
+    def _before(self, value, note_uuid: uuid.UUID) -> Q:
+        """Записи, которые идут перед курсором в прямом порядке."""
+        field = self.order_field
+        if value is None:
+            return Q(**{f"{field}__isnull": True, "uuid__gt": note_uuid})
+        return (
+            Q(**{f"{field}__gt": value})
+            | Q(**{field: value, "uuid__gt": note_uuid})
+            | Q(**{f"{field}__isnull": True})
+        )
+
+    def encode_cursor(self, note, direction: str) -> str:
+        value = getattr(note, self.order_field)
+        payload = {
+            "d": direction,
+            "v": value.isoformat() if isinstance(value, datetime) else value,
+            "t": isinstance(value, datetime),
+            "u": str(note.uuid),
+        }
+        raw = json.dumps(payload, separators=(",", ":")).encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> dict | None:
+        if not cursor:
+            return None
+        try:
+            raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+            payload = json.loads(raw)
+            direction = payload["d"]
+            value = payload["v"]
+            if value is not None and payload["t"]:
+                # Значения даты хранятся в курсоре в ISO формате.
+                value = parse_datetime(value)
+                if value is None:
+                    raise InvalidCursor(cursor)
+            elif value is not None and not isinstance(value, (int, float)):
+                raise InvalidCursor(cursor)
+            note_uuid = uuid.UUID(payload["u"])
+        except (binascii.Error, ValueError, TypeError, KeyError):
+            raise InvalidCursor(cursor)
+
+        if direction not in ("next", "prev"):
+            raise InvalidCursor(cursor)
+
+        return {"direction": direction, "value": value, "uuid": note_uuid}
+
+
+class OffsetPaginator:
+    """
+    Пагинация по номеру страницы (OFFSET / LIMIT) для результатов поиска.
+
+    `rank` вычисляется в запросе (в Postgres - `real`) и не годится для курсора: значение
+    из курсора (JSON число) не равно исходному при сравнении, поэтому записи с одинаковым рангом
+    дублировались бы или пропадали между страницами. Порядок однозначный благодаря `uuid`,
+    а поиск обычно не листают дальше первых страниц.
+    """
+
+    page_param = "page"
+
+    def __init__(self, queryset: QuerySet, ordering: tuple[str, ...], page_size: int | None = None):
+        self.queryset = queryset
+        self.ordering = ordering
+        self.page_size = page_size or getattr(settings, "NOTES_PAGE_SIZE", 20)
+
+    def get_page(self, request: WSGIRequest) -> KeysetPage:
+        try:
+            number = max(1, int(request.GET.get(self.page_param, 1)))
+        except ValueError:
+            number = 1
+
+        offset = (number - 1) * self.page_size
+        rows = list(self.queryset.order_by(*self.ordering)[offset:offset + self.page_size + 1])
+        next_page = str(number + 1) if len(rows) > self.page_size else None
+        previous_page = str(number - 1) if number > 1 else None
+        return KeysetPage(rows[:self.page_size], request, self.page_param, next_page, previous_page)
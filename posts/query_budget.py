@@ -0,0 +1,97 @@
+"""
+Бюджет SQL запросов для view.
+
+Для функции:
+
+    @query_budget(4)
+    def home_page_view(request): ...
+
+Для класса (в том числе DRF):
+
+    class NoteListCreateAPIView(ListCreateAPIView):
+        query_budget = 4
+
+`QueryBudgetMiddleware` считает все запросы к базе за время обработки запроса
+(включая сессию и пользователя) и, если бюджет превышен, в зависимости от
+`settings.QUERY_BUDGET["MODE"]`:
+
+* "raise" - выбрасывает `QueryBudgetExceeded` (для тестов);
+* "log" - пишет предупреждение в логгер `posts.query_budget`;
+* "off" - ничего не делает.
+"""
+import logging
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def query_budget(max_queries: int):
+    def decorator(view_func):
+        view_func.query_budget = max_queries
+        return view_func
+    return decorator
+
+
+def get_view_budget(view_func) -> int | None:
+    budget = getattr(view_func, "query_budget", None)
+    if budget is None:
+        view_class = getattr(view_func, "view_class", None)
+        budget = getattr(view_class, "query_budget", None)
+    return budget
+
+
+class QueryCounter:
+    """Счетчик запросов через `connection.execute_wrapper`."""
+
+    def __init__(self):
+        self.count = 0
+        self.queries: list[str] = []
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        self.queries.append(sql)
+        return execute(sql, params, many, context)
+
+
+@contextmanager
+def execute_wrapper_all(wrapper):
+    """`execute_wrapper` на всех подключениях из `DATABASES` (основная база и реплики)."""
+    with ExitStack() as stack:
+        for db_connection in connections.all():
+            stack.enter_context(db_connection.execute_wrapper(wrapper))
+        yield
+
+
+class QueryBudgetMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        mode = getattr(settings, "QUERY_BUDGET", {}).get("MODE", "off")
+        if mode == "off":
+            return self.get_response(request)
+
+        counter = QueryCounter()
+        with execute_wrapper_all(counter):
+            response = self.get_response(request)
+
+        match = getattr(request, "resolver_match", None)
+        budget = get_view_budget(match.func) if match is not None else None
+        if budget is None or counter.count <= budget:
+            return response
+
+        message = (
+            f"{match.view_name or match._func_path}: {counter.count} SQL queries, budget is {budget}"
+        )
+        if mode == "raise":
+            raise QueryBudgetExceeded(message + "\n" + "\n".join(counter.queries))
+        logger.warning(message)
+        return response
@@ -0,0 +1,167 @@
+"""
+Проверка планов горячих запросов (команда `check_query_plans`).
+
+Каждая форма запроса регистрируется декоратором `query_shape` и строит queryset так же, как view.
+Для каждой формы выполняется `EXPLAIN (FORMAT JSON)` (только Postgres), проблемой считаются:
+
+* `Seq Scan` по таблице, в которой по статистике (`pg_class.reltuples`) не меньше `min_rows` строк;
+* `Sort` - явная сортировка результата. `Incremental Sort` (досортировка уже упорядоченных
+  по индексу строк) допустим.
+
+Планы зависят от объема данных и статистики, поэтому проверять нужно на наполненной базе
+(`seed_benchmark --size 100000`) после `ANALYZE`.
+"""
+import json
+from collections.abc import Callable
+from dataclasses import dataclass, field
+
+from django.db import connection
+from django.db.models import Q, QuerySet
+
+from .models import Note, Tag, User
+from .pagination import KeysetPaginator
+
+
+QUERY_SHAPES: dict[str, Callable[[], QuerySet]] = {}
+
+
+def query_shape(name: str):
+    def decorator(build: Callable[[], QuerySet]):
+        QUERY_SHAPES[name] = build
+        return build
+    return decorator
+
+
+@dataclass
+class PlanReport:
+    name: str
+    sql: str
+    plan: dict
+    problems: list[str] = field(default_factory=list)
+
+
+class NoSampleData(Exception):
+    pass
+
+
+# Формы запросов.
+
+def _sample_user() -> User:
+    # Пользователь с наибольшим кол-вом заметок - самый тяжелый случай.
+    user = User.objects.filter(note_counter__note_count__gt=0).order_by("-note_counter__note_count").first()
+    if user is None:
+        raise NoSampleData("Нет пользователей с заметками: наполните базу (`seed_benchmark`)")
+    return user
+
+
+def _first_page(queryset: QuerySet, order_field: str = "mod_time") -> QuerySet:
+    paginator = KeysetPaginator(queryset, order_field=order_field)
+    return paginator._ordering(queryset, reverse=False)[:paginator.page_size + 1]
+
+
+@query_shape("home")
+def home_shape() -> QuerySet:
+    return _first_page(Note.objects.defer("content", "search_vector"))
+
+
+@query_shape("home-next-page")
+def home_next_page_shape() -> QuerySet:
+    queryset = Note.objects.defer("content", "search_vector")
+    # Курсор из середины ленты.
+    modified = queryset.exclude(mod_time=None).order_by("mod_time")
+    middle = modified.values("mod_time", "uuid")[modified.count() // 2:].first()
+    if middle is None:
+        raise NoSampleData("Нет измененных заметок: наполните базу (`seed_benchmark`)")
+    paginator = KeysetPaginator(queryset)
+    queryset = queryset.filter(paginator._after(middle["mod_time"], middle["uuid"]))
+    return paginator._ordering(queryset, reverse=False)[:paginator.page_size + 1]
+
+
+@query_shape("filter-latest")
+def filter_latest_shape() -> QuerySet:
+    return _first_page(Note.objects.defer("content", "search_vector"), order_field="created_at")
+
+
+@query_shape("notes-by-user")
+def notes_by_user_shape() -> QuerySet:
+    return _first_page(Note.objects.filter(user=_sample_user()).defer("content", "search_vector"))
+
+
+@query_shape("profile-tags")
+def profile_tags_shape() -> QuerySet:
+    user = _sample_user()
+    return (
+        Tag.objects.filter(user_counters__user=user, user_counters__note_count__gt=0)
+        .order_by("-user_counters__note_count", "name")
+    )
+
+
+@query_shape("note-tags")
+def note_tags_shape() -> QuerySet:
+    # `prefetch_related("tags")` для страницы заметок.
+    uuids = list(_first_page(Note.objects.all()).values_list("uuid", flat=True))
+    return Note.tags.through.objects.filter(note_id__in=uuids).values_list("note_id", "tag__name")
+
+
+@query_shape("tag-notes")
+def tag_notes_shape() -> QuerySet:
+    tag = Tag.objects.filter(note_counter__note_count__gt=0).order_by("-note_counter__note_count").first()
+    if tag is None:
+        raise NoSampleData("Нет тегов с заметками: наполните базу (`seed_benchmark`)")
+    return Note.tags.through.objects.filter(tag=tag).values_list("note_id", flat=True)
+
+
+@query_shape("user-by-email")
+def user_by_email_shape() -> QuerySet:
+    # `ResetForm` / `RegisterForm`.
+    return User.objects.filter(email=_sample_user().email)
+
+
+@query_shape("register-check")
+def register_check_shape() -> QuerySet:
+    user = _sample_user()
+    return User.objects.filter(Q(username=user.username) | Q(email=user.email))
+
+
+# Проверка.
+
+def explain(name: str, min_rows: int) -> PlanReport:
+    queryset = QUERY_SHAPES[name]()
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        report = PlanReport(name, sql, plan[0]["Plan"])
+        report.problems = find_problems(report.plan, _table_sizes(cursor, report.plan), min_rows)
+    return report
+
+
+def find_problems(plan: dict, table_sizes: dict[str, int], min_rows: int) -> list[str]:
+    problems = []
+    for node in _walk(plan):
+        node_type = node["Node Type"]
+        if node_type == "Seq Scan":
+            relation = node["Relation Name"]
+            rows = table_sizes.get(relation, 0)
+            if rows >= min_rows:
+                problems.append(f"Seq Scan по {relation} (~{rows} строк)")
+        elif node_type == "Sort":
+            keys = ", ".join(node.get("Sort Key", []))
+            problems.append(f"Sort ({keys})")
+    return problems
+
+
+def _walk(plan: dict):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from _walk(child)
+
+
+def _table_sizes(cursor, plan: dict) -> dict[str, int]:
+    relations = sorted({node["Relation Name"] for node in _walk(plan) if node["Node Type"] == "Seq Scan"})
+    if not relations:
+        return {}
+    cursor.execute("SELECT relname, reltuples::bigint FROM pg_class WHERE relname = ANY(%s)", [relations])
+    return dict(cursor.fetchall())
@@ -0,0 +1,180 @@
+"""
+Полнотекстовый поиск по заметкам.
+
+Общий движок для `filter_notes_view` и API (`NoteSearchFilter`).
+Бэкенд выбирается по базе данных:
+
+* Postgres - колонка `Note.search_vector` с GIN индексом,
+  взвешенный ранг (заголовок важнее содержимого), подсветка через `ts_headline`
+  и поиск по триграммам заголовка для опечаток;
+* SQLite - виртуальная таблица FTS5 `posts_note_fts` (для локальной разработки и тестов).
+
+Фрагмент с подсветкой строится по тексту заметки без HTML тегов, найденные слова обрамлены
+символами `HIGHLIGHT_START` / `HIGHLIGHT_STOP`. В HTML его переводит `render_headline`:
+текст экранируется, безопасны только теги `<mark>`.
+"""
+import html
+import re
+
+from django.conf import settings
+from django.contrib.postgres.search import (
+    SearchHeadline, SearchQuery, SearchRank, SearchVector, TrigramSimilarity,
+)
+from django.db import connection
+from django.db.models import F, Func, Q, QuerySet, TextField, Value
+from django.db.models.expressions import RawSQL
+from django.utils.html import escape, strip_tags
+from django.utils.module_loading import import_string
+from django.utils.safestring import SafeString, mark_safe
+
+from .models import Note
+
+
+SEARCH_CONFIG = getattr(settings, "NOTES_SEARCH_CONFIG", "russian")
+
+# Символы из области для частного использования Unicode: в тексте заметок их нет.
+HIGHLIGHT_START = "\ue000"
+HIGHLIGHT_STOP = "\ue001"
+
+
+class BaseSearchBackend:
+    """
+    Бэкенд добавляет к queryset аннотации:
+    `rank` - релевантность (чем больше, тем лучше) и `headline` - фрагмент с подсветкой.
+    С `annotate=False` - только фильтр, без вычисления ранга и фрагментов для каждой строки (админка).
+    """
+
+    highlight_start = HIGHLIGHT_START
+    highlight_stop = HIGHLIGHT_STOP
+
+    def search(self, queryset: QuerySet, text: str, annotate: bool = True) -> QuerySet:
+        raise NotImplementedError
+
+    def update_note(self, note: Note) -> None:
+        """Обновить поисковый индекс одной заметки."""
+        self.reindex(Note.objects.filter(pk=note.pk))
+
+    def reindex(self, queryset: QuerySet) -> None:
+        """Обновить поисковый индекс заметок из queryset."""
+        raise NotImplementedError
+
+    def remove_note(self, note: Note) -> None:
+        pass
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    def search(self, queryset: QuerySet, text: str, annotate: bool = True) -> QuerySet:
+        query = SearchQuery(text, config=SEARCH_CONFIG, search_type="websearch")
+        # `title__trigram_similar` использует GIN индекс по триграммам и находит заметки с опечатками.
+        queryset = queryset.filter(Q(search_vector=query) | Q(title__trigram_similar=text))
+        if not annotate:
+            return queryset
+        return queryset.annotate(
+            similarity=TrigramSimilarity("title", text),
+            rank=SearchRank(F("search_vector"), query) + F("similarity"),
+            headline=SearchHeadline(
+                # Без тегов CKEditor: обрезанный фрагмент не должен содержать половину тега.
+                Func(F("content"), Value("<[^>]*>"), Value(" "), Value("g"), function="regexp_replace",
+                     output_field=TextField()),
+                query, config=SEARCH_CONFIG,
+                start_sel=self.highlight_start, stop_sel=self.highlight_stop, max_fragments=2,
+            ),
+        )
+
+    def reindex(self, queryset: QuerySet) -> None:
+        queryset.update(search_vector=self.vector())
+
+    @staticmethod
+    def vector():
+        return (
+            SearchVector("title", weight="A", config=SEARCH_CONFIG)
+            + SearchVector("content", weight="B", config=SEARCH_CONFIG)
+        )
+
+
+class SqliteSearchBackend(BaseSearchBackend):
+    """
+    Бэкенд на SQLite FTS5.
+    Таблица `posts_note_fts` создается миграцией `0002_note_search_vector`.
+    """
+
+    table = "posts_note_fts"
+    delete_batch_size = 500  # Лимит параметров запроса SQLite.
+
+    def search(self, queryset: QuerySet, text: str, annotate: bool = True) -> QuerySet:
+        match = self._match_expression(text)
+        if not match:
+            return queryset.none()
+
+        if not annotate:
+            return queryset.filter(
+                uuid__in=RawSQL(f"SELECT uuid FROM {self.table} WHERE {self.table} MATCH %s", [match]),
+            )
+        # Соединение с FTS таблицей: `MATCH` выполняется один раз, `bm25` и `snippet` считаются
+        # для найденной строки в том же проходе. Подзапрос на каждую заметку (`WHERE uuid = ...`)
+        # заново выполнял бы `MATCH` и перебирал неиндексированную колонку `uuid`.
+        # `extra`, а не `RawSQL`: в ORM нет соединения с таблицей без модели.
+        note_table = Note._meta.db_table
+        return queryset.extra(
+            tables=[self.table],
+            where=[f"{self.table} MATCH %s", f"{self.table}.uuid = {note_table}.uuid"],
+            params=[match],
+            select={
+                # bm25 возвращает отрицательные значения: чем меньше, тем релевантнее.
+                # Заголовок весит в 10 раз больше содержимого.
+                "rank": f"-bm25({self.table}, 0, 10.0, 1.0)",
+                "headline": f"snippet({self.table}, 2, %s, %s, '…', 16)",
+            },
+            select_params=[self.highlight_start, self.highlight_stop],
+        )
+
+    def reindex(self, queryset: QuerySet) -> None:
+        # Содержимое индексируется без HTML: теги не находятся поиском и не попадают в `snippet`.
+        rows = [
+            (self._db_uuid(uuid), title, strip_tags(content))
+            for uuid, title, content in queryset.values_list("uuid", "title", "content")
+        ]
+        with connection.cursor() as cursor:
+            # `uuid` в FTS таблице не индексирован: один проход по таблице на пачку, а не на каждую заметку.
+            for start in range(0, len(rows), self.delete_batch_size):
+                uuids = [row[0] for row in rows[start:start + self.delete_batch_size]]
+                cursor.execute(f"DELETE FROM {self.table} WHERE uuid IN ({', '.join(['%s'] * len(uuids))})", uuids)
+            cursor.executemany(f"INSERT INTO {self.table} (uuid, title, content) VALUES (%s, %s, %s)", rows)
+
+    def remove_note(self, note: Note) -> None:
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table} WHERE uuid = %s", [self._db_uuid(note.uuid)])
+
+    @staticmethod
+    def _db_uuid(value) -> str:
+        return Note._meta.pk.get_db_prep_value(value, connection)
+
+    @staticmethod
+    def _match_expression(text: str) -> str:
+        # Каждое слово ищем как префикс. Берем только буквы и цифры, чтобы пользователь не ломал синтаксис FTS5.
+        return " ".join(f'"{word}"*' for word in re.findall(r"\w+", text))
+
+
+_BACKENDS = {
+    "postgresql": PostgresSearchBackend,
+    "sqlite": SqliteSearchBackend,
+}
+
+
+def get_search_backend() -> BaseSearchBackend:
+    backend_path = getattr(settings, "NOTES_SEARCH_BACKEND", None)
+    if backend_path:
+        return import_string(backend_path)()
+    return _BACKENDS[connection.vendor]()
+
+
+def search_notes(queryset: QuerySet, text: str, annotate: bool = True) -> QuerySet:
+    """Заметки из queryset, которые соответствуют строке поиска, с аннотациями `rank` и `headline`."""
+    return get_search_backend().search(queryset, text, annotate=annotate)
+
+
+def render_headline(headline: str) -> SafeString:
+    """HTML фрагмента с подсветкой: текст экранируется, безопасны только теги `<mark>`."""
+    # Теги уже убраны из текста до построения фрагмента, `strip_tags` - для старых записей индекса.
+    text = escape(html.unescape(strip_tags(headline)))
+    return mark_safe(text.replace(HIGHLIGHT_START, "<mark>").replace(HIGHLIGHT_STOP, "</mark>"))
@@ -0,0 +1,163 @@
+"""
+Хранилище файлов по содержимому (content-addressed storage).
+
+Файл пишется на диск частями (без чтения целиком в память), одновременно считается SHA-256.
+Итоговое имя - хэш содержимого: `cas/ab/cd/abcd...ef.jpg`, поэтому одинаковые картинки
+хранятся один раз, а файлы с одинаковыми именами больше не перезаписывают друг друга.
+
+Сколько раз файл сохранен, хранится в `StoredFile.ref_count`.
+`delete` уменьшает счетчик и удаляет файл только когда ссылок не осталось.
+
+Строка `StoredFile` служит блокировкой имени: проверка файла на диске и перенос в `save`,
+удаление последней ссылки и файла в `delete` идут под `SELECT ... FOR UPDATE` этой строки,
+поэтому новая загрузка не может сослаться на файл, который в этот момент удаляется.
+Если транзакция `save` откатилась после переноса, на диске остается файл без строки -
+его, как и брошенные временные файлы в `.incoming/`, удаляет `collect_media`.
+"""
+import hashlib
+import os
+import tempfile
+from collections import Counter
+from pathlib import Path
+
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.db.models import F
+from django.utils.deconstruct import deconstructible
+
+
+PREFIX = "cas/"
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+
+    def _save(self, name: str, content) -> str:
+        from .models import StoredFile
+
+        incoming_dir = Path(self.location) / ".incoming"
+        incoming_dir.mkdir(parents=True, exist_ok=True)
+
+        hasher = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=incoming_dir)
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                if hasattr(content, "seek"):
+                    content.seek(0)
+                for chunk in content.chunks():
+                    hasher.update(chunk)
+                    tmp_file.write(chunk)
+                    size += len(chunk)
+
+            digest = hasher.hexdigest()
+            extension = os.path.splitext(name)[1].lower()
+            final_name = f"{PREFIX}{digest[:2]}/{digest[2:4]}/{digest}{extension}"
+            final_path = Path(self.path(final_name))
+
+            with transaction.atomic():
+                self._lock_stored_file(final_name, size)
+                if final_path.exists():
+                    # Такой файл уже есть - второй раз на диск не пишем.
+                    os.unlink(tmp_path)
+                else:
+                    final_path.parent.mkdir(parents=True, exist_ok=True)
+                    if self.file_permissions_mode is not None:
+                        os.chmod(tmp_path, self.file_permissions_mode)
+                    os.replace(tmp_path, final_path)
+                StoredFile.objects.filter(name=final_name).update(ref_count=F("ref_count") + 1)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+        return final_name
+
+    def get_available_name(self, name: str, max_length=None) -> str:
+        # Итоговое имя определяется содержимым в `_save`.
+        return name
+
+    def delete(self, name: str) -> None:
+        if not name:
+            return
+        if not name.startswith(PREFIX):
+            # Файлы, сохраненные до перехода на хранение по содержимому.
+            super().delete(name)
+            return
+        from .models import StoredFile
+
+        with transaction.atomic():
+            stored = StoredFile.objects.select_for_update().filter(name=name).first()
+            if stored is None:
+                return
+            if stored.ref_count > 1:
+                StoredFile.objects.filter(pk=stored.pk).update(ref_count=F("ref_count") - 1)
+                return
+            # Файл удаляется под блокировкой строки: параллельный `save` того же содержимого
+            # дождется удаления и запишет файл заново.
+            stored.delete()
+            super().delete(name)
+
+    def delete_if_unreferenced(self, name: str) -> bool:
+        """Удалить файл, на который нет ни одной ссылки (например после отката транзакции `save`)."""
+        from .models import StoredFile
+
+        with transaction.atomic():
+            stored = self._lock_stored_file(name, 0)
+            if stored.ref_count > 0:
+                return False
+            stored.delete()
+            super().delete(name)
+            return True
+
+    def add_references(self, names: list[str]) -> set[str]:
+        """
+        Учесть ссылки на файлы, которые уже лежат в хранилище (загрузка заметок в обход `save`).
+        По ссылке на каждое вхождение имени. Возвращает имена файлов, которых в хранилище нет.
+        """
+        from .models import StoredFile
+
+        counts = Counter(names)
+        missing = {name for name in counts if not name.startswith(PREFIX) and not self.exists(name)}
+        sizes = {name: self.size(name) for name in counts if name.startswith(PREFIX) and self.exists(name)}
+        missing |= {name for name in counts if name.startswith(PREFIX) and name not in sizes}
+        if not sizes:
+            return missing
+
+        with transaction.atomic():
+            StoredFile.objects.bulk_create(
+                [StoredFile(name=name, size=size, ref_count=0) for name, size in sizes.items()],
+                ignore_conflicts=True,
+            )
+            # Блокируем в одном порядке, чтобы параллельные загрузки не ждали друг друга по кругу.
+            locked = StoredFile.objects.select_for_update().filter(name__in=sizes).order_by("name")
+            present = {stored.name for stored in locked if self.exists(stored.name)}
+            # Файл удалили, пока мы не держали блокировку.
+            missing |= set(sizes) - present
+            StoredFile.objects.filter(name__in=set(sizes) - present, ref_count=0).delete()
+
+            groups: dict[int, list[str]] = {}
+            for name in present:
+                groups.setdefault(counts[name], []).append(name)
+            for count, group in groups.items():
+                StoredFile.objects.filter(name__in=group).update(ref_count=F("ref_count") + count)
+        return missing
+
+    @staticmethod
+    def _lock_stored_file(name: str, size: int):
+        """Заблокировать строку `StoredFile` до конца транзакции (создать с `ref_count=0`, если ее нет)."""
+        from .models import StoredFile
+
+        while True:
+            StoredFile.objects.bulk_create([StoredFile(name=name, size=size, ref_count=0)], ignore_conflicts=True)
+            stored = StoredFile.objects.select_for_update().filter(name=name).first()
+            if stored is not None:
+                return stored
+            # Строку удалили между INSERT и SELECT (удаление последней ссылки) - создаем заново.
+
+
+content_addressed_storage = ContentAddressedStorage()
+
+
+def get_content_addressed_storage() -> ContentAddressedStorage:
+    return content_addressed_storage
@@ -0,0 +1,26 @@
+from django import template
+
+from posts.fragment_cache import render_note_cards
+from posts.images import get_variant_urls
+from posts.search import render_headline
+
+
+register = template.Library()
+
+
+@register.simple_tag
+def note_cards(notes) -> str:
+    """Все карточки заметок списка, HTML берется из кэша."""
+    return render_note_cards(notes)
+
+
+@register.inclusion_tag("note-picture.html")
+def note_picture(note, sizes: str = "100vw", height: int | None = None) -> dict:
+    """Картинка заметки со `srcset` из уменьшенных копий (WebP для браузеров, которые его понимают)."""
+    return {"note": note, "variants": get_variant_urls(note), "sizes": sizes, "height": height}
+
+
+@register.filter
+def headline(value: str) -> str:
+    """Фрагмент результата поиска с подсветкой найденных слов."""
+    return render_headline(value)
@@ -1,3 +1,994 @@
-from django.test import TestCase
+import base64
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+from collections import Counter
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.admin import site
+from django.contrib.sessions.models import Session
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection, transaction
+from django.http import HttpResponse
+from django.test.utils import CaptureQueriesContext
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from . import db_router, images, metrics, notes_transfer, query_plans, views
+from .admin import UserAdmin
+from .api import authentication
+from .api.authentication import auth_cache
+from .api.token_blacklist import FilteredRefreshToken, RevocationFilter
+from .cache_backend import TwoTierRedisCache
+from .email import ConfirmUserRegisterEmailSender
+from .management.commands import generate_image_variants, send_outbox
+from .models import (
+    ImageVariantTask, Note, OutboxEmail, StoredFile, Tag, TagNoteCounter, User, UserNoteCounter, UserTagCounter,
+)
+from .large_admin import EstimatedCountPaginator
+from .notes_transfer import insert_as_is
+from .pagination import KeysetPaginator
+from .query_budget import QueryBudgetExceeded
+from .storage import ContentAddressedStorage
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+@override_settings(QUERY_BUDGET={"MODE": "raise"})
+class QueryBudgetTests(TestCase):
+    """Каждая view с бюджетом укладывается в него (иначе `QueryBudgetExceeded`)."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("author", email="author@example.com", password="password")
+        other = User.objects.create_user("other", email="other@example.com", password="password")
+        tags = Tag.objects.get_or_create_many(["python", "django", "cache"])
+        cls.notes = []
+        for index in range(6):
+            note = Note.objects.create(
+                title=f"Заметка {index} django", content=f"<p>Текст {index} python</p>",
+                user=cls.user if index % 2 else other,
+            )
+            note.tags.add(*tags[:index % 3 + 1])
+            cls.notes.append(note)
+
+    def setUp(self):
+        # Бюджет должен выдерживаться и с пустым кэшем.
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def test_exceeded_budget_raises(self):
+        with mock.patch.object(views.home_page_view, "query_budget", 0), self.assertRaises(QueryBudgetExceeded):
+            self.client.get(reverse("home"))
+
+    def test_html_views(self):
+        note = self.notes[1]
+        urls = [
+            reverse("home"),
+            reverse("filter-notes"),
+            reverse("filter-notes") + "?search=django",
+            reverse("show-note", args=[note.uuid]),
+            reverse("notes_by_user", args=[self.user.username]),
+            reverse("profile-view", args=[self.user.username]),
+            reverse("history"),
+        ]
+        for url in urls:
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_create_note(self):
+        response = self.client.post(reverse("create-note"), {"title": "Новая", "content": "<p>Текст</p>"})
+        self.assertEqual(response.status_code, 302)
+
+    def test_create_note_with_image(self):
+        buffer = io.BytesIO()
+        Image.new("RGB", (50, 50)).save(buffer, "JPEG")
+        image = SimpleUploadedFile("picture.jpg", buffer.getvalue(), content_type="image/jpeg")
+        with tempfile.TemporaryDirectory() as media_root, self.settings(MEDIA_ROOT=media_root):
+            response = self.client.post(reverse("create-note"), {"title": "Новая", "content": "", "noteImage": image})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(ImageVariantTask.objects.filter(note__title="Новая").exists())
+
+    def test_api_views(self):
+        note = self.notes[1]
+        urls = [
+            # `app_name` API содержит двоеточие, `reverse` по нему не работает.
+            "/api/posts/",
+            "/api/posts/?search=django",
+            f"/api/posts/{note.uuid}",
+            "/api/tags/",
+            "/api/posts/export.ndjson",
+        ]
+        for url in urls:
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                if response.streaming:
+                    b"".join(response.streaming_content)
+
+
+class HistoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("reader", password="password")
+        cls.notes = [Note.objects.create(title=f"Заметка {index}", content="", user=cls.user) for index in range(3)]
+
+    @override_settings(HISTORY={"BACKEND": "posts.history_service.DatabaseHistoryBackend", "LIMIT": 2})
+    def test_anonymous_user_with_database_backend(self):
+        for note in self.notes:
+            self.assertEqual(self.client.get(reverse("show-note", args=[note.uuid])).status_code, 200)
+        self.assertEqual(self.client.session["history"], [str(self.notes[2].uuid), str(self.notes[1].uuid)])
+
+    @override_settings(HISTORY={"BACKEND": "auto", "LIMIT": 2})
+    def test_database_history_is_trimmed(self):
+        self.client.force_login(self.user)
+        for note in self.notes * 2:
+            self.client.get(reverse("show-note", args=[note.uuid]))
+        response = self.client.get(reverse("history"))
+        self.assertEqual([note.uuid for note in response.context["notes"]], [self.notes[2].uuid, self.notes[1].uuid])
+
+
+class NoteVersionTests(TestCase):
+    """ETag заметки меняется и без правки автором: копии картинки, теги."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("owner", password="password")
+        cls.note = Note.objects.create(title="Заметка", content="<p>Текст</p>", user=cls.user)
+
+    def etag(self) -> str:
+        return self.client.get(reverse("show-note", args=[self.note.uuid]))["ETag"]
+
+    def test_tags_change_etag(self):
+        etag = self.etag()
+        self.note.tags.add(*Tag.objects.get_or_create_many(["новый"]))
+        self.assertNotEqual(self.etag(), etag)
+
+    def test_image_variants_change_etag(self):
+        buffer = io.BytesIO()
+        Image.new("RGB", (800, 600)).save(buffer, "JPEG")
+        with tempfile.TemporaryDirectory() as media_root, self.settings(MEDIA_ROOT=media_root):
+            self.note.image = ContentFile(buffer.getvalue(), name="picture.jpg")
+            self.note.save()
+            etag = self.etag()
+            images.generate_variants(self.note)
+            self.assertNotEqual(self.etag(), etag)
+
+
+class ApiAuthTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("jwt", email="jwt@example.com", password="password")
+
+    def setUp(self):
+        auth_cache.clear()
+        cache.clear()
+        token = RefreshToken.for_user(self.user).access_token
+        self.client.defaults["HTTP_AUTHORIZATION"] = f"Bearer {token}"
+
+    @override_settings(API_AUTH_CACHE={"STATELESS": True})
+    def test_stateless_user_is_not_saved(self):
+        response = self.client.patch("/api/auth/users/me/", {"first_name": "Имя"}, content_type="application/json")
+        self.assertEqual(response.status_code, 403)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.email, "jwt@example.com")
+        self.assertTrue(self.user.has_usable_password())
+
+    @override_settings(API_AUTH_CACHE={"STATELESS": True}, QUERY_BUDGET={"MODE": "off"})
+    def test_stateless_user_creates_and_edits_notes(self):
+        response = self.client.post(
+            "/api/posts/", {"title": "Заметка", "content": "Текст", "tags": []}, content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 201)
+        note = Note.objects.get(user=self.user)
+        response = self.client.patch(f"/api/posts/{note.uuid}", {"title": "Новая"}, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+
+    def test_deactivation_in_other_process(self):
+        self.assertEqual(self.client.get("/api/auth/users/me/").status_code, 200)
+        # Другой процесс: свой `auth_cache`, общий кэш Django.
+        with mock.patch.object(authentication, "auth_cache", authentication.AuthCache()):
+            self.user.is_active = False
+            self.user.save()
+        self.assertEqual(self.client.get("/api/auth/users/me/").status_code, 401)
+
+    def test_admin_activation_invalidates_cache(self):
+        self.assertEqual(self.client.get("/api/auth/users/me/").status_code, 200)
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertEqual(self.client.get("/api/auth/users/me/").status_code, 200)
+
+        UserAdmin(User, site).is_active_switch(None, User.objects.filter(pk=self.user.pk))
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertEqual(self.client.get("/api/auth/users/me/").status_code, 401)
+
+
+class RevocationFilterTests(TransactionTestCase):
+    """Полная пересборка фильтра идет в фоне, запросы тем временем проверяются старым фильтром."""
+
+    def revoke(self, user) -> str:
+        token = FilteredRefreshToken.for_user(user)
+        BlacklistedToken.objects.create(token=OutstandingToken.objects.get(jti=token["jti"]))
+        return token["jti"]
+
+    def test_rebuild_does_not_block_requests(self):
+        user = User.objects.create_user("revoked", password="password")
+        revocation_filter = RevocationFilter()
+        first = self.revoke(user)
+        self.assertTrue(revocation_filter.might_contain(first))
+
+        release = threading.Event()
+        rebuild = revocation_filter._rebuild
+
+        def slow_rebuild(config):
+            release.wait(5)
+            rebuild(config)
+
+        stale = revocation_filter._bloom
+        revocation_filter._built_at -= 24 * 60 * 60
+        second = self.revoke(user)
+        with mock.patch.object(revocation_filter, "_rebuild", slow_rebuild):
+            revocation_filter.sync(force=True)
+            # Пока идет пересборка, новые строки и отзывы процесса попадают в старый фильтр.
+            self.assertIs(revocation_filter._bloom, stale)
+            self.assertTrue(revocation_filter.might_contain(second))
+            revocation_filter.add("local-jti")
+            release.set()
+            for thread in threading.enumerate():
+                if thread.name == "token-blacklist-rebuild":
+                    thread.join(5)
+
+        self.assertIsNot(revocation_filter._bloom, stale)
+        for jti in (first, second, "local-jti"):
+            self.assertTrue(revocation_filter.might_contain(jti))
+
+    def test_late_commit_with_smaller_id(self):
+        user = User.objects.create_user("revoked", password="password")
+        expires_at = timezone.now() + timedelta(days=1)
+
+        def revoke_with_id(row_id: int) -> str:
+            token = OutstandingToken.objects.create(
+                user=user, jti=uuid.uuid4().hex, token="token", expires_at=expires_at,
+            )
+            BlacklistedToken.objects.create(id=row_id, token=token)
+            return token.jti
+
+        for row_id in range(1, 11):
+            revoke_with_id(row_id)
+        BlacklistedToken.objects.update(blacklisted_at=timezone.now() - timedelta(hours=1))
+        # Много свежих строк: строка с id 15 отстает от наибольшего id на сотни.
+        for row_id in range(20, 321):
+            revoke_with_id(row_id)
+
+        revocation_filter = RevocationFilter()
+        revocation_filter.sync(force=True)
+        revocation_filter.sync(force=True)
+        # Транзакция с id 15 началась раньше, а зафиксировалась после обновлений фильтра.
+        late = revoke_with_id(15)
+        revocation_filter.sync(force=True)
+        self.assertTrue(revocation_filter.might_contain(late))
+
+
+@unittest.skipIf(fakeredis is None, "нужен пакет fakeredis")
+class TwoTierRedisCacheTests(SimpleTestCase):
+    """Процессы - экземпляры кэша с общим Redis в памяти (fakeredis)."""
+
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+
+    def make_cache(self, **options) -> TwoTierRedisCache:
+        cache = TwoTierRedisCache("redis://fake", {"OPTIONS": {"LOCAL_TIMEOUT": 30, **options}})
+        client = fakeredis.FakeRedis(server=self.server)
+        patcher = mock.patch.object(cache._cache, "get_client", lambda *args, **kwargs: client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return cache
+
+    def local_ttl(self, cache: TwoTierRedisCache, key: str) -> float:
+        return cache._local._entries[cache.make_key(key)][1] - time.monotonic()
+
+    def test_lru_eviction(self):
+        cache = self.make_cache(LOCAL_MAX_ENTRIES=2)
+        for key in ("note:1", "note:2", "note:3"):
+            cache.set(key, key)
+        # Самый старый ключ вытеснен из LRU, но остался в Redis.
+        self.assertEqual(cache.get("note:1"), "note:1")
+        self.assertEqual(cache.get("note:3"), "note:3")
+        self.assertEqual(cache.stats()["note"], {"evictions": 2, "remote_hits": 1, "local_hits": 1})
+
+    def test_ttl_promotion(self):
+        writer, reader = self.make_cache(), self.make_cache()
+        writer.set("short:1", "value", timeout=5)
+        writer.set("long:1", "value", timeout=300)
+        writer.set("forever:1", "value", timeout=None)
+
+        for key in ("short:1", "long:1", "forever:1"):
+            self.assertEqual(reader.get(key), "value")
+        # В LRU - на оставшийся TTL из Redis, но не дольше `LOCAL_TIMEOUT`.
+        self.assertAlmostEqual(self.local_ttl(reader, "short:1"), 5, delta=1)
+        self.assertAlmostEqual(self.local_ttl(reader, "long:1"), 30, delta=1)
+        self.assertAlmostEqual(self.local_ttl(reader, "forever:1"), 30, delta=1)
+        self.assertEqual(reader.get("short:1"), "value")
+        self.assertEqual(reader.stats()["short"], {"remote_hits": 1, "local_hits": 1})
+
+    def test_pubsub_invalidation(self):
+        writer, reader = self.make_cache(), self.make_cache()
+        writer.set("note:1", "old")
+        self.assertEqual(reader.get("note:1"), "old")
+
+        writer.set("note:1", "new")
+        deadline = time.monotonic() + 5
+        while reader._local.get(reader.make_key("note:1"))[0] and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(reader.get("note:1"), "new")
+
+        writer.delete("note:1")
+        deadline = time.monotonic() + 5
+        while reader._local.get(reader.make_key("note:1"))[0] and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertIsNone(reader.get("note:1"))
+
+    def test_stats(self):
+        cache = self.make_cache()
+        cache.set("note-card:1", "card")
+        cache.get("note-card:1")
+        cache.get("note-card:2")
+        cache.get_many(["note-card:1", "history:1"])
+        self.assertEqual(cache.stats(), {
+            "note-card": {"local_hits": 2, "misses": 1},
+            "history": {"misses": 1},
+        })
+
+    def test_publish_after_write(self):
+        cache = self.make_cache()
+        published = []
+
+        def publish(full_keys):
+            # К моменту сообщения значение уже есть и в Redis, и в своем LRU.
+            for full_key in full_keys:
+                published.append((full_key, cache._cache.get_client().get(full_key) is not None,
+                                  cache._local.get(full_key)[0]))
+
+        with mock.patch.object(cache, "_publish", publish):
+            cache.set("note:1", "value")
+            cache.set_many({"note:2": "value", "note:3": "value"})
+        self.assertEqual(published, [(cache.make_key(f"note:{index}"), True, True) for index in (1, 2, 3)])
+
+
+class InsertAsIsTests(TestCase):
+    def test_created_at_is_kept_without_touching_the_field(self):
+        user = User.objects.create_user("importer", password="password")
+        moment = timezone.now() - timedelta(days=365)
+        note = Note(uuid=uuid.uuid4(), title="Старая", content="", user=user, created_at=moment)
+
+        insert_as_is(Note, [note])
+        # `auto_now_add` у поля не выключался: обычные заметки получают текущее время.
+        fresh = Note.objects.create(title="Новая", content="", user=user)
+
+        self.assertEqual(Note.objects.get(uuid=note.uuid).created_at, moment)
+        self.assertGreater(fresh.created_at, moment + timedelta(days=364))
+
+
+@unittest.skipUnless(connection.vendor == "postgresql", "EXPLAIN (FORMAT JSON) есть только в PostgreSQL")
+class QueryPlanTests(TestCase):
+    """Горячие запросы идут по индексам (как `check_query_plans` на большой базе)."""
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command("seed_benchmark", size=500, stdout=io.StringIO())
+
+    def test_registered_shapes_use_indexes(self):
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+            # На маленьких таблицах полный просмотр и сортировка дешевле индекса: запрещаем их,
+            # и если они остались в плане, подходящего индекса нет.
+            cursor.execute("SET LOCAL enable_seqscan = off")
+            cursor.execute("SET LOCAL enable_sort = off")
+        for name in query_plans.QUERY_SHAPES:
+            with self.subTest(shape=name):
+                report = query_plans.explain(name, min_rows=0)
+                self.assertEqual(report.problems, [], report.sql)
+
+
+class MetricsAccessTests(TestCase):
+    def test_localhost_is_not_trusted_by_default(self):
+        # За nginx у всех запросов `REMOTE_ADDR` 127.0.0.1.
+        self.assertEqual(self.client.get(reverse("metrics"), REMOTE_ADDR="127.0.0.1").status_code, 403)
+
+    @override_settings(METRICS={"TOKEN": "secret"})
+    def test_token_and_staff(self):
+        self.assertEqual(self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer secret").status_code, 200)
+        self.client.force_login(User.objects.create_user("admin", password="password", is_staff=True))
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 200)
+
+
+class MetricsFilesTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="metrics-")
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def finished_process_values(self, pid: int, amount: float) -> None:
+        with mock.patch("os.getpid", return_value=pid):
+            values = metrics.MmapValues(self.directory)
+        values.add("http_requests_total|home|2xx", amount)
+        values.close()
+
+    def test_files_of_finished_processes_are_merged(self):
+        # pid больше `pid_max` (2 ** 22) ни у одного процесса быть не может.
+        self.finished_process_values(2 ** 22 + 1, 2)
+        current = metrics.MmapValues(self.directory)
+        self.addCleanup(current.close)
+        current.add("http_requests_total|home|2xx", 1)
+        self.assertCountEqual(
+            os.listdir(self.directory), ["merge.lock", metrics.MERGED_FILE, f"metrics-{os.getpid()}.db"],
+        )
+
+        # Следующий воркер добавляет к уже сложенным значениям.
+        self.finished_process_values(2 ** 22 + 2, 3)
+        metrics.MmapValues(self.directory).close()
+        self.assertEqual(current.collect(), {"http_requests_total|home|2xx": 6})
+        self.assertEqual(len(os.listdir(self.directory)), 3)
+
+
+@override_settings(DATABASE_REPLICATION={"REPLICAS": ["replica_1"], "HEALTH_CHECK_INTERVAL": 60})
+class ReplicaRoutingTests(SimpleTestCase):
+    """
+    Основная база `default` и реплика `replica_1` (в тестах - зеркало основной).
+    Без транзакции `TestCase`: внутри `atomic` роутер всегда выбирает основную базу.
+    """
+
+    databases = {"default", "replica_1"}
+
+    def setUp(self):
+        cache.clear()
+        db_router.monitor.reset()
+        db_router.monitor.check("replica_1", db_router.get_config())
+        self.addCleanup(db_router.monitor.reset)
+        self.router = db_router.PrimaryReplicaRouter()
+        self.factory = RequestFactory()
+
+    def route(self, request, write: bool = False):
+        """Пройти middleware; возвращает ответ и базы для чтения до и после записи."""
+        aliases = []
+
+        def view(request):
+            aliases.append(self.router.db_for_read(Note))
+            if write:
+                self.router.db_for_write(Note)
+                aliases.append(self.router.db_for_read(Note))
+            return HttpResponse()
+
+        return db_router.ReplicaRoutingMiddleware(view)(request), aliases
+
+    def bearer(self, user_id: int) -> str:
+        return f"Bearer {AccessToken.for_user(User(pk=user_id))}"
+
+    def test_reads_go_to_replica(self):
+        self.assertEqual(self.route(self.factory.get("/"))[1], ["replica_1"])
+
+    def test_outside_request_reads_primary(self):
+        self.assertEqual(self.router.db_for_read(Note), "default")
+
+    def test_write_pins_rest_of_request(self):
+        self.assertEqual(self.route(self.factory.get("/"), write=True)[1], ["replica_1", "default"])
+
+    def test_primary_apps_and_transactions(self):
+        def view(request):
+            aliases = [self.router.db_for_read(Session)]
+            with transaction.atomic():
+                aliases.append(self.router.db_for_read(Note))
+            return HttpResponse(",".join(aliases))
+
+        response = db_router.ReplicaRoutingMiddleware(view)(self.factory.get("/"))
+        self.assertEqual(response.content, b"default,default")
+
+    def test_cookie_stickiness(self):
+        response, _ = self.route(self.factory.post("/"), write=True)
+        cookie = response.cookies["primary_until"].value
+
+        request = self.factory.get("/")
+        request.COOKIES["primary_until"] = cookie
+        self.assertEqual(self.route(request)[1], ["default"])
+
+        request.COOKIES["primary_until"] = str(time.time() - 1)
+        self.assertEqual(self.route(request)[1], ["replica_1"])
+
+    def test_jwt_user_stickiness(self):
+        request = self.factory.post("/")
+        request.user = User(pk=1)
+        self.route(request, write=True)
+
+        # Клиент без cookie: закрепление по id пользователя из токена.
+        request = self.factory.get("/", HTTP_AUTHORIZATION=self.bearer(1))
+        self.assertEqual(self.route(request)[1], ["default"])
+        request = self.factory.get("/", HTTP_AUTHORIZATION=self.bearer(2))
+        self.assertEqual(self.route(request)[1], ["replica_1"])
+
+    def test_unhealthy_replica_is_skipped(self):
+        config = db_router.get_config()
+        with mock.patch.object(db_router, "replica_lag", side_effect=DatabaseError("down")):
+            self.assertFalse(db_router.monitor.check("replica_1", config).healthy)
+        self.assertEqual(self.route(self.factory.get("/"))[1], ["default"])
+
+        with mock.patch.object(db_router, "replica_lag", return_value=config["MAX_LAG"] + 1):
+            self.assertFalse(db_router.monitor.check("replica_1", config).healthy)
+        self.assertEqual(self.route(self.factory.get("/"))[1], ["default"])
+
+    @override_settings(DATABASE_REPLICATION={"REPLICAS": ["replica_1"], "HEALTH_CHECK_INTERVAL": 0})
+    def test_health_check_does_not_block_request(self):
+        checked = threading.Event()
+        release = threading.Event()
+
+        def slow_lag(alias):
+            checked.set()
+            release.wait(5)
+            return 0.0
+
+        with mock.patch.object(db_router, "replica_lag", slow_lag):
+            # Проверка идет в фоне, запрос сразу получает прошлый результат.
+            self.assertEqual(self.route(self.factory.get("/"))[1], ["replica_1"])
+            self.assertTrue(checked.wait(5))
+            self.assertEqual(self.route(self.factory.get("/"))[1], ["replica_1"])
+            release.set()
+            for thread in threading.enumerate():
+                if thread.name == "replica-monitor":
+                    thread.join(5)
+
+
+class OutboxTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("newcomer", email="newcomer@example.com", password="password")
+
+    def enqueue(self, count: int) -> list[OutboxEmail]:
+        return [
+            OutboxEmail.objects.create(subject=f"Письмо {index}", from_email="", to=["reader@example.com"], body="")
+            for index in range(count)
+        ]
+
+    def drain(self, **options):
+        call_command("send_outbox", stdout=io.StringIO(), **options)
+
+    def test_send_mail_only_enqueues(self):
+        email = ConfirmUserRegisterEmailSender(RequestFactory().get("/"), self.user).send_mail()
+
+        self.assertEqual(mail.outbox, [])
+        self.assertEqual(email.status, OutboxEmail.Status.PENDING)
+        self.assertEqual(email.to, ["newcomer@example.com"])
+        self.assertIn("Подтвердите регистрацию", email.subject)
+
+    def test_batch_is_sent_over_one_connection(self):
+        self.enqueue(3)
+        with mock.patch.object(send_outbox, "get_connection", wraps=send_outbox.get_connection) as get_connection:
+            self.drain(batch_size=2)
+
+        get_connection.assert_called_once()
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(len({id(message.connection) for message in mail.outbox}), 1)
+        self.assertFalse(OutboxEmail.objects.exclude(status=OutboxEmail.Status.SENT).exists())
+
+    def test_failed_send_backs_off_then_dead(self):
+        [email] = self.enqueue(1)
+        with mock.patch("django.core.mail.backends.locmem.EmailBackend.send_messages", side_effect=OSError("down")):
+            self.drain(max_attempts=2, retry_delay=30)
+            email.refresh_from_db()
+            self.assertEqual((email.status, email.attempts, email.last_error), ("pending", 1, "OSError: down"))
+            self.assertAlmostEqual((email.next_attempt_at - timezone.now()).total_seconds(), 30, delta=5)
+
+            # До `next_attempt_at` письмо не берется.
+            self.drain(max_attempts=2, retry_delay=30)
+            email.refresh_from_db()
+            self.assertEqual(email.attempts, 1)
+
+            OutboxEmail.objects.update(next_attempt_at=timezone.now())
+            self.drain(max_attempts=2, retry_delay=30)
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (OutboxEmail.Status.DEAD, 2))
+        self.assertEqual(mail.outbox, [])
+
+    def test_claimed_batch_is_leased(self):
+        self.enqueue(3)
+        worker, other = send_outbox.Command(), send_outbox.Command()
+        worker.options = other.options = {"batch_size": 2, "lease": 300}
+
+        first = worker._claim_batch()
+        # Захваченные письма не достаются второму воркеру, пока не истечет аренда.
+        second = other._claim_batch()
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertEqual(other._claim_batch(), [])
+        self.assertFalse({email.pk for email in first} & {email.pk for email in second})
+
+
+@unittest.skipUnless(connection.vendor == "postgresql", "SKIP LOCKED есть только в PostgreSQL")
+class OutboxSkipLockedTests(TransactionTestCase):
+    def test_locked_rows_are_skipped(self):
+        locked, free = (
+            OutboxEmail.objects.create(subject=subject, from_email="", to=["reader@example.com"])
+            for subject in ("locked", "free")
+        )
+        row_locked, release = threading.Event(), threading.Event()
+
+        def hold_lock():
+            # Другой воркер захватил строку и еще не обновил `next_attempt_at`.
+            try:
+                with transaction.atomic():
+                    list(OutboxEmail.objects.select_for_update().filter(pk=locked.pk))
+                    row_locked.set()
+                    release.wait(5)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        try:
+            self.assertTrue(row_locked.wait(5))
+            command = send_outbox.Command()
+            command.options = {"batch_size": 10, "lease": 300}
+            self.assertEqual([email.pk for email in command._claim_batch()], [free.pk])
+        finally:
+            release.set()
+            thread.join(5)
+
+
+class KeysetPaginatorTests(TestCase):
+    """Лента: NULL `mod_time` первыми, затем `-mod_time`, при равенстве - `-uuid`."""
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user("author", password="password")
+        moment = timezone.now()
+        times = [None] * 3 + [moment] + [moment - timedelta(hours=1)] * 3 + [moment - timedelta(hours=2)] * 2
+        notes = [Note.objects.create(title=f"Заметка {index}", content="", user=user) for index in range(len(times))]
+        for note, mod_time in zip(notes, times):
+            note.mod_time = mod_time
+        Note.objects.bulk_update(notes, ["mod_time"])
+        notes.sort(key=lambda note: (note.mod_time is None, note.mod_time or moment, note.uuid), reverse=True)
+        cls.expected = [note.uuid for note in notes]
+
+    def get_page(self, cursor: str | None = None):
+        request = RequestFactory().get("/", {"cursor": cursor} if cursor else {})
+        return KeysetPaginator(Note.objects.all(), page_size=2).get_page(request)
+
+    def test_pages_forward_and_back(self):
+        # Страницы по 2: [NULL, NULL], [NULL, t3], [t2, t2], [t2, t1], [t1] - граница NULL и равные
+        # значения внутри страниц и на их стыке.
+        pages = [self.get_page()]
+        while pages[-1].has_next:
+            pages.append(self.get_page(pages[-1].next_cursor))
+        self.assertEqual([note.uuid for page in pages for note in page], self.expected)
+        self.assertEqual([len(page) for page in pages], [2, 2, 2, 2, 1])
+
+        backward = [pages[-1]]
+        while backward[-1].has_previous:
+            backward.append(self.get_page(backward[-1].previous_cursor))
+        self.assertEqual(
+            [[note.uuid for note in page] for page in backward[::-1]],
+            [[note.uuid for note in page] for page in pages],
+        )
+
+    def test_null_cursor_branches(self):
+        paginator = KeysetPaginator(Note.objects.all())
+        middle = self.expected[1]
+        after = Note.objects.filter(paginator._after(None, middle)).values_list("uuid", flat=True)
+        before = Note.objects.filter(paginator._before(None, middle)).values_list("uuid", flat=True)
+        self.assertEqual(set(after), set(self.expected[2:]))
+        self.assertEqual(set(before), set(self.expected[:1]))
+
+    def test_invalid_cursor_falls_back_to_first_page(self):
+        first = [note.uuid for note in self.get_page()]
+        broken = base64.urlsafe_b64encode(b'{"d":"next","v":"yesterday","t":true,"u":"x"}').decode()
+        for cursor in ("not a cursor!", broken):
+            with self.subTest(cursor=cursor):
+                page = self.get_page(cursor)
+                self.assertEqual([note.uuid for note in page], first)
+                self.assertFalse(page.has_previous)
+
+
+class ContentAddressedStorageTests(TestCase):
+    def setUp(self):
+        location = tempfile.mkdtemp(prefix="cas-")
+        self.addCleanup(shutil.rmtree, location, ignore_errors=True)
+        self.storage = ContentAddressedStorage(location=location)
+
+    def test_same_bytes_are_stored_once(self):
+        first = self.storage.save("a/cat.JPG", ContentFile(b"cat"))
+        second = self.storage.save("b/other.jpg", ContentFile(b"cat"))
+        other = self.storage.save("a/cat.jpg", ContentFile(b"dog"))
+
+        self.assertEqual(first, second)
+        self.assertTrue(first.startswith("cas/") and first.endswith(".jpg"))
+        self.assertNotEqual(first, other)
+        self.assertEqual(StoredFile.objects.get(name=first).ref_count, 2)
+        stored = [path for path in Path(self.storage.location).rglob("*") if path.is_file()]
+        self.assertEqual(len(stored), 2)
+
+    def test_file_is_removed_with_last_reference(self):
+        name = self.storage.save("cat.jpg", ContentFile(b"cat"))
+        self.storage.save("cat.jpg", ContentFile(b"cat"))
+
+        self.storage.delete(name)
+        self.assertTrue(self.storage.exists(name))
+        self.assertEqual(StoredFile.objects.get(name=name).ref_count, 1)
+
+        self.storage.delete(name)
+        self.assertFalse(self.storage.exists(name))
+        self.assertFalse(StoredFile.objects.filter(name=name).exists())
+        # После удаления то же содержимое сохраняется заново.
+        self.assertEqual(self.storage.save("cat.jpg", ContentFile(b"cat")), name)
+        self.assertTrue(self.storage.exists(name))
+
+
+class CounterTests(TestCase):
+    """Счетчики совпадают с `COUNT` по заметкам после каждого изменения через сигналы."""
+
+    def assertCountersMatch(self):
+        links = Note.tags.through.objects.values_list("note__user_id", "tag_id")
+        expected = (
+            Counter(Note.objects.values_list("user_id", flat=True)),
+            Counter(tag_id for _, tag_id in links),
+            Counter(links),
+        )
+        actual = (
+            Counter(dict(UserNoteCounter.objects.values_list("user_id", "note_count"))),
+            Counter(dict(TagNoteCounter.objects.values_list("tag_id", "note_count"))),
+            Counter({(user_id, tag_id): count for user_id, tag_id, count in
+                     UserTagCounter.objects.values_list("user_id", "tag_id", "note_count")}),
+        )
+        # Нулевые строки счетчиков остаются, `+Counter` их отбрасывает.
+        self.assertEqual(tuple(+counter for counter in actual), expected)
+
+    def test_counters_follow_notes_and_tags(self):
+        alice = User.objects.create_user("alice", password="password")
+        bob = User.objects.create_user("bob", password="password")
+        python, django = Tag.objects.create(name="python"), Tag.objects.create(name="django")
+
+        first = Note.objects.create(title="Первая", content="", user=alice)
+        second = Note.objects.create(title="Вторая", content="", user=alice)
+        third = Note.objects.create(title="Третья", content="", user=bob)
+        first.tags.add(python, django)
+        second.tags.add(python)
+        django.notes.add(third, first)
+        self.assertCountersMatch()
+        self.assertEqual(TagNoteCounter.objects.get(tag=python).note_count, 2)
+
+        first.tags.remove(django)
+        python.notes.remove(second)
+        self.assertCountersMatch()
+
+        third.user = alice
+        third.save()
+        self.assertCountersMatch()
+
+        first.tags.clear()
+        second.delete()
+        third.delete()
+        self.assertCountersMatch()
+        self.assertEqual(UserNoteCounter.objects.get(user=alice).note_count, 1)
+
+
+class NotesTransferTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        users = [User.objects.create_user(name, password="password") for name in ("alice", "bob")]
+        python = Tag.objects.create(name="python")
+        for index in range(5):
+            note = Note.objects.create(title=f"Заметка {index}", content=f"Текст\t{index}\n", user=users[index % 2])
+            if index % 2:
+                note.tags.add(python)
+
+    def setUp(self):
+        directory = tempfile.mkdtemp(prefix="notes-transfer-")
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.path = str(Path(directory) / "notes.ndjson.gz")
+        self.checkpoint = f"{self.path}.checkpoint"
+
+    def records(self) -> list[dict]:
+        return [record for batch in notes_transfer.iter_record_batches(Note.objects.all()) for record in batch]
+
+    def interrupt_after_first_batch(self, *args):
+        raise KeyboardInterrupt
+
+    def test_gzip_round_trip(self):
+        expected = self.records()
+        self.assertEqual(notes_transfer.export_notes(self.path, compression="gzip", batch_size=2), 5)
+        with open(self.path, "rb") as file:
+            self.assertEqual(file.read(2), notes_transfer.GZIP_MAGIC)
+
+        Note.objects.all().delete()
+        stats = notes_transfer.import_notes(self.path, batch_size=2)
+        self.assertEqual((stats.imported, stats.skipped, stats.created_users), (5, 0, 0))
+        self.assertEqual(self.records(), expected)
+        self.assertEqual(TagNoteCounter.objects.get(tag__name="python").note_count, 2)
+
+    def test_resume_from_checkpoint(self):
+        expected = self.records()
+        with self.assertRaises(KeyboardInterrupt):
+            notes_transfer.export_notes(self.path, "gzip", batch_size=2, checkpoint_path=self.checkpoint,
+                                        progress=self.interrupt_after_first_batch)
+        with self.assertRaises(ValueError):
+            notes_transfer.export_notes(self.path, "gzip", batch_size=2, checkpoint_path=self.checkpoint)
+        # Файл обрезается по контрольной точке, оставшиеся пачки дописываются.
+        self.assertEqual(
+            notes_transfer.export_notes(self.path, "gzip", batch_size=2, checkpoint_path=self.checkpoint, resume=True),
+            5,
+        )
+        self.assertFalse(Path(self.checkpoint).exists())
+
+        Note.objects.all().delete()
+        with self.assertRaises(KeyboardInterrupt):
+            notes_transfer.import_notes(self.path, batch_size=2, checkpoint_path=self.checkpoint,
+                                        progress=self.interrupt_after_first_batch)
+        self.assertEqual(Note.objects.count(), 2)
+        stats = notes_transfer.import_notes(self.path, batch_size=2, checkpoint_path=self.checkpoint, resume=True)
+        # Строки до контрольной точки заново не читаются: ни одной пропущенной заметки.
+        self.assertEqual((stats.imported, stats.skipped), (5, 0))
+        self.assertEqual(self.records(), expected)
+        self.assertFalse(Path(self.checkpoint).exists())
+
+    def test_existing_uuids_are_skipped(self):
+        notes_transfer.export_notes(self.path, "gzip")
+        Note.objects.order_by("uuid").first().delete()
+
+        stats = notes_transfer.import_notes(self.path)
+        self.assertEqual((stats.imported, stats.skipped), (1, 4))
+        self.assertEqual(Note.objects.count(), 5)
+        self.assertEqual(sum(UserNoteCounter.objects.values_list("note_count", flat=True)), 5)
+
+
+class ActivityStatsTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp(prefix="activity-stats-")
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.log = Path(directory) / "usersActivity.log"
+        self.state = str(Path(directory) / "state.json")
+
+    def write(self, *records: tuple[str | None, str]):
+        with open(self.log, "a") as file:
+            for user, url in records:
+                file.write(json.dumps({"ts": 1700000000, "user": user, "url": url}) + "\n")
+
+    def stats(self, **options) -> dict:
+        output = io.StringIO()
+        call_command("activity_stats", path=str(self.log), json=True, stdout=output, **options)
+        return json.loads(output.getvalue())
+
+    def test_state_keeps_totals(self):
+        self.write(("alice", "/"), ("alice", "/api/notes"), (None, "/"))
+        self.assertEqual(self.stats(state=self.state)["total"], 3)
+
+        self.write(("bob", "/api/notes"), ("alice", "/api/notes"))
+        report = self.stats(state=self.state)
+        # Читаются только новые строки, но итоги - с первого запуска.
+        self.assertEqual((report["total"], report["unique_users"]), (5, 2))
+        self.assertIsNotNone(report["since"])
+        self.assertEqual(report["top_urls"][0], ["/api/notes", 3])
+        self.assertEqual(report["top_user_urls"], [["alice", "/api/notes", 2], ["alice", "/", 1],
+                                                   ["bob", "/api/notes", 1]])
+
+    def test_url_and_user_filters(self):
+        self.write(("alice", "/"), ("alice", "/api/notes"), ("bob", "/api/tags"), ("alice", "/api/tags"))
+        report = self.stats(url="/api/", user="alice")
+        self.assertEqual(report["total"], 2)
+        self.assertEqual(report["top_urls"], [["/api/notes", 1], ["/api/tags", 1]])
+
+        self.stats(state=self.state, user="alice")
+        with self.assertRaises(CommandError):
+            self.stats(state=self.state, user="bob")
+
+
+class ImageVariantQueueTests(TransactionTestCase):
+    """Задачи выполняются в потоках команды со своими подключениями - нужны зафиксированные данные."""
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp(prefix="media-")
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = self.settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        buffer = io.BytesIO()
+        Image.new("RGB", (800, 600)).save(buffer, "JPEG")
+        user = User.objects.create_user("painter", password="password")
+        self.note = Note(title="Картинка", content="", user=user)
+        self.note.image = ContentFile(buffer.getvalue(), name="picture.jpg")
+        self.note.save()
+
+    def test_worker_generates_queued_variants(self):
+        # Сохранение заметки только ставит задачу.
+        self.assertTrue(ImageVariantTask.objects.filter(note=self.note).exists())
+        self.assertEqual(Note.objects.get(pk=self.note.pk).image_variants, {})
+
+        call_command("generate_image_variants", stdout=io.StringIO())
+        self.note.refresh_from_db()
+        self.assertTrue(images.variants_are_current(self.note))
+        self.assertEqual([variant["width"] for variant in self.note.image_variants["variants"]], [160, 320, 640])
+        self.assertFalse(ImageVariantTask.objects.exists())
+
+    def test_failed_task_is_retried_later(self):
+        with mock.patch.object(generate_image_variants, "generate_variants", side_effect=OSError("broken")):
+            call_command("generate_image_variants", retry_delay=60, stdout=io.StringIO(), stderr=io.StringIO())
+        task = ImageVariantTask.objects.get(note=self.note)
+        self.assertEqual((task.attempts, task.last_error), (1, "OSError: broken"))
+        self.assertGreater(task.next_attempt_at, timezone.now() + timedelta(seconds=50))
+
+        # Новая картинка ставит задачу заново, с новыми попытками.
+        images.schedule_variants([self.note])
+        task.refresh_from_db()
+        self.assertEqual(task.attempts, 0)
+        call_command("generate_image_variants", stdout=io.StringIO())
+        self.assertFalse(ImageVariantTask.objects.exists())
+
+
+class ConditionalApiTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user("owner", password="password")
+        cls.stranger = User.objects.create_user("stranger", password="password")
+        cls.note = Note.objects.create(title="Заметка", content="Текст", user=cls.owner)
+
+    def authorization(self, user) -> dict:
+        return {"HTTP_AUTHORIZATION": f"Bearer {RefreshToken.for_user(user).access_token}"}
+
+    def patch(self, user, etag: str):
+        return self.client.patch(
+            f"/api/posts/{self.note.uuid}", {"title": "Новая"}, content_type="application/json",
+            HTTP_IF_MATCH=etag, **self.authorization(user),
+        )
+
+    def test_permissions_are_checked_before_if_match(self):
+        etag = self.client.get(f"/api/posts/{self.note.uuid}")["ETag"]
+        self.assertEqual(self.patch(self.stranger, '"stale"').status_code, 403)
+        self.assertEqual(self.patch(self.owner, '"stale"').status_code, 412)
+
+        response = self.patch(self.owner, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_list_etag_without_aggregate_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/posts/")
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([query for query in queries if "MAX(" in query["sql"].upper()])
+
+        etag = response["ETag"]
+        self.assertEqual(self.client.get("/api/posts/", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.note.tags.add(*Tag.objects.get_or_create_many(["новый"]))
+        self.assertEqual(self.client.get("/api/posts/", HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+@override_settings(ADMIN_LARGE_TABLES={"ENABLED": True, "COUNT_LIMIT": 3})
+class EstimatedCountPaginatorTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user("author", password="password")
+        for index in range(5):
+            Note.objects.create(title=f"Заметка {index}", content="", user=user)
+
+    def test_filtered_count_is_exact_up_to_limit(self):
+        self.assertEqual(EstimatedCountPaginator(Note.objects.filter(title__endswith="1"), 2).count, 1)
+        # Больше `COUNT_LIMIT` строк: показывается предел, страниц - на столько же строк.
+        paginator = EstimatedCountPaginator(Note.objects.filter(title__startswith="Заметка"), 2)
+        self.assertEqual((paginator.count, paginator.num_pages), (3, 2))
+        self.assertEqual(len(paginator.page(2)), 1)
+
+    def test_unfiltered_count(self):
+        # Вне Postgres статистики нет - точный `COUNT(*)`.
+        self.assertEqual(EstimatedCountPaginator(Note.objects.all(), 2).count, 5)
@@ -9,27 +9,36 @@ from django.http import HttpResponseRedirect, Http404, HttpRequest
 from django.core.handlers.wsgi import WSGIRequest
 from django.contrib.auth.decorators import login_required
 from django.views import View
+from django.views.decorators.http import condition
 from django.utils.encoding import force_str
 from django.utils.http import urlsafe_base64_decode
 from django.contrib.auth.tokens import default_token_generator
 
+from .conditional import note_etag, note_last_modified
 from .email import ConfirmUserRegisterEmailSender, ConfirmUserResetPasswordEmailSender
 from .forms import ResetForm, RegisterForm, SetPasswordForm
 from .history_service import HistoryService
+from .pagination import KeysetPaginator, OffsetPaginator
+from .query_budget import query_budget
+from .search import search_notes
 
 from project import settings
 from .models import Note, User, Tag
 
 
+@query_budget(4)
 def home_page_view(request: WSGIRequest):
     # Обязательно! каждая функция view должна принимать первым параметром request.
-    all_notes = Note.objects.all()  # Получение всех записей из таблицы этой модели.
+    all_notes = Note.objects.all().defer("content", "search_vector")  # Список карточек не показывает содержимое.
+    page = KeysetPaginator(all_notes).get_page(request)
     context: dict = {
-        "notes": all_notes
+        "notes": page.object_list,
+        "page": page,
     }
     return render(request, "home.html", context)
 
 
+@query_budget(4)
 def filter_notes_view(request: WSGIRequest):
     """
     Фильтруем записи по запросу пользователя.
@@ -41,43 +50,31 @@ def filter_notes_view(request: WSGIRequest):
 
     # Если строка поиска не пустая, то фильтруем записи по ней.
     if search:
-        # ❗️Нет обращения к базе❗️
-        # Через запятую запросы формируются c ❗️AND❗️
-        # notes_queryset = Note.objects.filter(title__icontains=search, content__icontains=search)
-        # SELECT "posts_note"."uuid", "posts_note"."title", "posts_note"."content", "posts_note"."created_at"
-        # FROM "posts_note" WHERE (
-        # "posts_note"."title" LIKE %search% ESCAPE '\' AND "posts_note"."content" LIKE %search% ESCAPE '\')
-
-        # ❗️Все импорты сверху файла❗️
-        # from django.db.models import Q
-        # Оператор - `|` Означает `ИЛИ`.
-        # Оператор - `&` Означает `И`.
-        notes_queryset = Note.objects.filter(Q(title__icontains=search) | Q(content__icontains=search))
+        # Полнотекстовый поиск (см. `posts/search.py`).
+        # Каждая запись получает `rank` - релевантность и `headline` - фрагмент текста с подсветкой.
+        notes_queryset = search_notes(Note.objects.all(), search).defer("content", "search_vector")
+        # Ранг вычисляется в запросе, поэтому страницы по номеру, а не по курсору.
+        page = OffsetPaginator(notes_queryset, ordering=("-rank", "-uuid")).get_page(request)
 
     else:
         # Если нет строки поиска.
-        notes_queryset = Note.objects.all()  # Получение всех записей из модели.
-
-    notes_queryset = notes_queryset.order_by("-created_at")  # ❗️Нет обращения к базе❗️
-
-    # SELECT "posts_note"."uuid", "posts_note"."title", "posts_note"."content", "posts_note"."created_at"
-    # FROM "posts_note" WHERE
-    # ("posts_note"."title" LIKE %python% ESCAPE '\' OR "posts_note"."content" LIKE %python% ESCAPE '\')
-    # ORDER BY "posts_note"."created_at" DESC
-
-    print(notes_queryset.query)
+        notes_queryset = Note.objects.all().defer("content", "search_vector")  # ❗️Нет обращения к базе❗️
+        # Сортировка по `-created_at` задается пагинатором.
+        page = KeysetPaginator(notes_queryset, order_field="created_at").get_page(request)
 
     context: dict = {
-        "notes": notes_queryset,
+        "notes": page.object_list,
+        "page": page,
         "search_value_form": search,
     }
     return render(request, "home.html", context)
 
 
 @login_required
+# С картинкой: ссылка в хранилище по содержимому (`posts/storage.py`) и задача на копии (`posts/images.py`).
+@query_budget(14)
 def create_note_view(request: WSGIRequest):
     if request.method == "POST":
-        print(request.FILES)
         note = Note.objects.create(
             title=request.POST["title"],
             content=request.POST["content"],
@@ -90,9 +87,13 @@ def create_note_view(request: WSGIRequest):
     return render(request, "create_form.html")
 
 
+@query_budget(7)
+# ETag и Last-Modified: если у клиента актуальная версия, ответ 304 без загрузки заметки.
+@condition(etag_func=note_etag, last_modified_func=note_last_modified)
 def show_note_view(request: WSGIRequest, note_uuid):
     try:
-        note = Note.objects.get(uuid=note_uuid)  # Получение только ОДНОЙ записи.
+        # Шаблон показывает владельца, поэтому сразу вытягиваем `user` через JOIN.
+        note = Note.objects.select_related("user").get(uuid=note_uuid)  # Получение только ОДНОЙ записи.
 
     except Note.DoesNotExist:
         # Если не найдено такой записи.
@@ -139,16 +140,12 @@ def delete_note_view(request: WSGIRequest, note_uuid: str):
 def register(request: WSGIRequest):
     if request.method != "POST":
         return render(request, "registration/register.html")
-    print(request.POST)
     if not request.POST.get("username") or not request.POST.get("email") or not request.POST.get("password1"):
         return render(
             request,
             "registration/register.html",
             {"errors": "Укажите все поля!"}
         )
-    print(User.objects.filter(
-        Q(username=request.POST["username"]) | Q(email=request.POST["email"])
-    ))
     # Если уже есть такой пользователь с username или email.
     if User.objects.filter(
             Q(username=request.POST["username"]) | Q(email=request.POST["email"])
@@ -215,12 +212,15 @@ def confirm_register_view(request: WSGIRequest, uidb64: str, token: str):
     return render(request, "registration/invalid-email-confirm.html", {"username": user.username})
 
 
+@query_budget(5)
 def notes_by_user_view(request: WSGIRequest, user_username: str):
     user = User.objects.get(username=user_username)
-    queryset = Note.objects.filter(user=user)
-    return render(request, "user_posts_list.html", {"notes": queryset, "username": user_username})
+    queryset = Note.objects.filter(user=user).defer("content", "search_vector")
+    page = KeysetPaginator(queryset).get_page(request)
+    return render(request, "user_posts_list.html", {"notes": page.object_list, "page": page, "username": user_username})
 
 
+@query_budget(5)
 def profile_view(request: WSGIRequest, username):
     if request.method == 'POST':
         user = User.objects.get(username=username)
@@ -230,19 +230,25 @@ def profile_view(request: WSGIRequest, username):
         user.save()
         return HttpResponseRedirect(reverse("home",))
     user = User.objects.get(username=username)
-    tags_queryset = Tag.objects.filter(notes__user=user).distinct()
+    # Теги пользователя из счетчиков `UserTagCounter` (см. `posts/counters.py`), без JOIN ... DISTINCT по заметкам.
+    tags_queryset = (
+        Tag.objects.filter(user_counters__user=user, user_counters__note_count__gt=0)
+        .order_by("-user_counters__note_count", "name")
+    )
 
     return render(request, 'profile.html', {'tags': tags_queryset})
 
 
 class ListHistoryView(View):
+    query_budget = 4
+
     def get(self, request: WSGIRequest):
         """
         Метод `get` вызывается автоматический, когда HTTP метод запроса является `GET`.
         """
         history_service = HistoryService(request)
-        ids = history_service.history_ids[::-1]
-        queryset = Note.objects.filter(uuid__in=ids)
+        # История ограничена `HISTORY["LIMIT"]` записями и уже упорядочена по времени просмотра.
+        queryset = history_service.get_notes().defer("content", "search_vector")
         return render(request, "home.html", {"notes": queryset})
 
 
@@ -270,7 +276,6 @@ def confirm_reset_view(request: WSGIRequest, uidb64: str, token: str):
     if default_token_generator.check_token(user, token):
         if request.method == 'POST':
             form = SetPasswordForm(request.POST)
-            print(f'------------------------------------------------{request.POST}-------------------------------')
             if form.is_valid():
                 new_password = form.cleaned_data["password"]
                 user.set_password(new_password)
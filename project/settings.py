@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 import os
+import sys
+import tempfile
 import uuid
 from datetime import timedelta
 from pathlib import Path
@@ -54,11 +56,14 @@ AUTH_USER_MODEL = "posts.User"
 
 
 MIDDLEWARE = [
+    'posts.metrics.MetricsMiddleware',
+    'posts.query_budget.QueryBudgetMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'posts.db_router.ReplicaRoutingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'posts.logfilemiddleware.SimpleMiddleware'
@@ -66,6 +71,42 @@ MIDDLEWARE = [
 
 SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
 
+# Бюджет SQL запросов для view (см. `posts/query_budget.py`).
+# "raise" - исключение при превышении (по умолчанию в тестах: `manage.py test` и pytest),
+# "log" - предупреждение в лог, "off".
+RUNNING_TESTS = 'test' in sys.argv or 'pytest' in sys.modules
+QUERY_BUDGET = {
+    "MODE": os.environ.get('QUERY_BUDGET_MODE', 'raise' if RUNNING_TESTS else 'off'),
+}
+
+# Метрики запросов: `Server-Timing` для персонала и `/metrics` для Prometheus (см. `posts/metrics.py`).
+# `DIR` - общая папка воркеров gunicorn, без нее метрики только текущего процесса.
+# `/metrics` - по `METRICS_TOKEN` или для персонала. `METRICS_ALLOWED_IPS` (через запятую) -
+# только если Prometheus ходит в gunicorn напрямую: за nginx `REMOTE_ADDR` у всех 127.0.0.1.
+METRICS = {
+    "ENABLED": os.environ.get('METRICS', '1') == "1",
+    "DIR": os.environ.get('METRICS_DIR'),
+    "TOKEN": os.environ.get('METRICS_TOKEN'),
+    "ALLOWED_IPS": [ip for ip in os.environ.get('METRICS_ALLOWED_IPS', '').split(',') if ip],
+    "SERVER_TIMING": True,
+}
+
+# Журнал активности пользователей (см. `posts/activity_log.py`).
+ACTIVITY_LOG = {
+    # Тесты пишут журнал во временную папку, а не в `usersActivity.log` репозитория.
+    "PATH": os.environ.get(
+        'ACTIVITY_LOG_PATH',
+        Path(tempfile.mkdtemp(prefix="activity-log-")) / "usersActivity.log" if RUNNING_TESTS
+        else BASE_DIR / "usersActivity.log",
+    ),
+    "QUEUE_SIZE": 10000,  # Если очередь заполнена, записи отбрасываются.
+    "BATCH_SIZE": 500,
+    "FLUSH_INTERVAL": 1.0,
+    "MAX_BYTES": 50 * 1024 * 1024,
+    "BACKUP_COUNT": 10,
+    "COMPRESS": True,
+}
+
 ROOT_URLCONF = 'project.urls'
 
 TEMPLATES = [
@@ -104,41 +145,104 @@ DATABASES = {
     }
 }
 
+# Реплики для чтения (см. `posts/db_router.py`): хосты через запятую,
+# остальные параметры подключения - как у основной базы.
+DATABASE_REPLICA_HOSTS = [host for host in os.environ.get('DATABASE_REPLICA_HOSTS', '').split(',') if host]
+for index, host in enumerate(DATABASE_REPLICA_HOSTS, start=1):
+    DATABASES[f'replica_{index}'] = {
+        **DATABASES['default'],
+        "HOST": host,
+        # Недоступная реплика не должна надолго задерживать проверку (см. `ReplicaMonitor`).
+        "OPTIONS": {
+            **DATABASES['default'].get('OPTIONS', {}),
+            "connect_timeout": int(os.environ.get('DATABASE_REPLICA_CONNECT_TIMEOUT', 2)),
+        },
+        # В тестах реплика - та же база, что и основная.
+        "TEST": {"MIRROR": "default"},
+    }
+if RUNNING_TESTS and not DATABASE_REPLICA_HOSTS:
+    # Для тестов роутера (`posts/tests.py`); в `REPLICAS` не входит, пока тест не включит.
+    DATABASES['replica_1'] = {**DATABASES['default'], "TEST": {"MIRROR": "default"}}
+
+DATABASE_ROUTERS = ['posts.db_router.PrimaryReplicaRouter']
+
+DATABASE_REPLICATION = {
+    "REPLICAS": [f'replica_{index}' for index in range(1, len(DATABASE_REPLICA_HOSTS) + 1)],
+    # Сколько секунд после записи пользователь читает с основной базы.
+    "STICKY_SECONDS": int(os.environ.get('DATABASE_STICKY_SECONDS', 10)),
+    # Реплика, отстающая больше чем на `MAX_LAG` секунд, не используется.
+    "MAX_LAG": float(os.environ.get('DATABASE_REPLICA_MAX_LAG', 5)),
+    "HEALTH_CHECK_INTERVAL": 5,
+}
+
 
 REDIS_CACHE = os.environ.get('DATABASE_CACHE_URL')
 if REDIS_CACHE:
     CACHES = {
         "default": {
-            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            # LRU в памяти процесса перед Redis (см. `posts/cache_backend.py`).
+            'BACKEND': 'posts.cache_backend.TwoTierRedisCache',
             'LOCATION': REDIS_CACHE,
             'KEY_PREFIX': 'test_django_notes_' if DEBUG else 'django_notes_',
+            'OPTIONS': {
+                "LOCAL_MAX_ENTRIES": 1000,
+                "LOCAL_TIMEOUT": 30,
+            }
         }
     }
 else:
     CACHES = {
         "default": {
-            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'BACKEND': 'posts.cache_backend.InstrumentedLocMemCache',
             'KEY_PREFIX': 'test_django_notes_' if DEBUG else 'django_notes_',
             'OPTIONS': {
-                "MAX_ENTRIES": 10,
-                'CULL_FREQUENCY': 2,
+                "MAX_ENTRIES": 10000,
+                'CULL_FREQUENCY': 10,
             }
         }
     }
 
+# История просмотров (см. `posts/history_service.py`).
+# "auto" - Redis, если он настроен, иначе база данных / память процесса.
+HISTORY = {
+    "BACKEND": os.environ.get('HISTORY_BACKEND', 'auto'),
+    "LIMIT": 20,
+}
+
 REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
     # "PAGE_SIZE": 2,
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.BasicAuthentication',
+        'posts.api.authentication.CachedBasicAuthentication',
         'rest_framework.authentication.SessionAuthentication',
         "rest_framework.authentication.TokenAuthentication",  # Для работы djoser.
-        "rest_framework_simplejwt.authentication.JWTAuthentication",  # Для работы JWT.
+        "posts.api.authentication.CachedJWTAuthentication",  # Для работы JWT.
     ]
 }
 
+# Кэш аутентификации API в памяти процесса (см. `posts/api/authentication.py`).
+# "STATELESS" - пользователь JWT (`TokenUser`) собирается из токена без запроса к базе;
+# его нельзя сохранить, поэтому `/api/auth/users/...` с таким токеном отвечают 403.
+API_AUTH_CACHE = {
+    "ENABLED": os.environ.get('API_AUTH_CACHE', '1') == "1",
+    "TTL": 60,
+    "MAX_ENTRIES": 10000,
+    "STATELESS": os.environ.get('API_AUTH_STATELESS', '0') == "1",
+}
+
+_DJOSER_USER_PERMISSIONS = ["djoser.permissions.CurrentUserOrAdmin", "posts.api.permissions.IsDatabaseUser"]
+DJOSER = {
+    "PERMISSIONS": {
+        "user": _DJOSER_USER_PERMISSIONS,
+        "user_list": _DJOSER_USER_PERMISSIONS,
+        "user_delete": _DJOSER_USER_PERMISSIONS,
+        "set_password": _DJOSER_USER_PERMISSIONS,
+        "set_username": _DJOSER_USER_PERMISSIONS,
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -201,6 +305,16 @@ MEDIA_ROOT = BASE_DIR / 'media'  # Корень для сохранения ме
 # что данный URL необходимо рассматривать как файл в папке с медиа.
 MEDIA_URL = 'media/'
 
+# Раздача медиа файлов (см. `posts/media.py`).
+# "python" - файлы отдает Django (Range, sendfile через `wsgi.file_wrapper`),
+# "x-accel-redirect" - nginx, "x-sendfile" - Apache / lighttpd.
+MEDIA_SERVING = {
+    "MODE": os.environ.get('MEDIA_SERVING_MODE', 'python'),
+    "INTERNAL_PREFIX": "/protected-media/",
+    "IMMUTABLE_MAX_AGE": 60 * 60 * 24 * 365,
+    "MAX_AGE": 60 * 60,
+}
+
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
@@ -324,9 +438,46 @@ SIMPLE_JWT = {
     "SLIDING_TOKEN_REFRESH_LIFETIME": timedelta(days=1),
 
     "TOKEN_OBTAIN_SERIALIZER": "rest_framework_simplejwt.serializers.TokenObtainPairSerializer",
-    "TOKEN_REFRESH_SERIALIZER": "rest_framework_simplejwt.serializers.TokenRefreshSerializer",
-    "TOKEN_VERIFY_SERIALIZER": "rest_framework_simplejwt.serializers.TokenVerifySerializer",
-    "TOKEN_BLACKLIST_SERIALIZER": "rest_framework_simplejwt.serializers.TokenBlacklistSerializer",
+    # Проверка черного списка через фильтр Блума (см. `posts/api/token_blacklist.py`).
+    "TOKEN_REFRESH_SERIALIZER": "posts.api.token_blacklist.FilteredTokenRefreshSerializer",
+    "TOKEN_VERIFY_SERIALIZER": "posts.api.token_blacklist.FilteredTokenVerifySerializer",
+    "TOKEN_BLACKLIST_SERIALIZER": "posts.api.token_blacklist.FilteredTokenBlacklistSerializer",
     "SLIDING_TOKEN_OBTAIN_SERIALIZER": "rest_framework_simplejwt.serializers.TokenObtainSlidingSerializer",
     "SLIDING_TOKEN_REFRESH_SERIALIZER": "rest_framework_simplejwt.serializers.TokenRefreshSlidingSerializer",
-}
\ No newline at end of file
+}
+
+# Фильтр Блума для черного списка JWT (см. `posts/api/token_blacklist.py`).
+TOKEN_BLACKLIST = {
+    "SYNC_INTERVAL": 2,
+    "REBUILD_INTERVAL": 60 * 60,
+    "CAPACITY": 100000,
+    "ERROR_RATE": 0.001,
+    "SYNC_MARGIN": int(os.environ.get('TOKEN_BLACKLIST_SYNC_MARGIN', 60)),
+}
+
+# Кол-во заметок на одной странице ленты.
+NOTES_PAGE_SIZE = int(os.environ.get('NOTES_PAGE_SIZE', 20))
+
+# Конфигурация полнотекстового поиска Postgres (см. `posts/search.py`).
+NOTES_SEARCH_CONFIG = os.environ.get('NOTES_SEARCH_CONFIG', 'russian')
+
+# Время жизни кэша карточек заметок в секундах (см. `posts/fragment_cache.py`).
+NOTE_CARD_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Режим админки для больших таблиц (см. `posts/large_admin.py`):
+# оценка кол-ва строк вместо COUNT(*), поиск заметок по полнотекстовому индексу, без `date_hierarchy`.
+ADMIN_LARGE_TABLES = {
+    "ENABLED": os.environ.get('ADMIN_LARGE_TABLES', '0') == "1",
+    "ESTIMATE_THRESHOLD": 10000,
+    # Отфильтрованные списки считаются точно, но не дальше этого кол-ва строк.
+    "COUNT_LIMIT": 10000,
+}
+
+# Уменьшенные копии картинок заметок (см. `posts/images.py`).
+# Создаются воркером `python manage.py generate_image_variants --loop`,
+# `WORKERS` - потоков в нем по умолчанию.
+IMAGE_VARIANTS = {
+    "WORKERS": 2,
+    "WIDTHS": [160, 320, 640, 1280],
+    "QUALITY": 80,
+}
@@ -16,8 +16,6 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include, re_path
-from django.conf.urls.static import serve
-from django.conf import settings
 from djoser.views import TokenCreateView, TokenDestroyView
 from rest_framework_simplejwt.views import (
     TokenObtainPairView,
@@ -26,6 +24,8 @@ from rest_framework_simplejwt.views import (
 )
 
 from posts import views, history_service
+from posts.media import serve_media
+from posts.metrics import metrics_view
 
 
 urlpatterns = [
@@ -45,7 +45,7 @@ urlpatterns = [
     path("redact/<note_uuid>", views.redact_note_view, name="redact-note"),
     path("delete/<note_uuid>", views.delete_note_view, name="delete-note"),
     path("user/<user_username>/posts", views.notes_by_user_view, name="notes_by_user"),
-    re_path(r"^media/(?P<path>.*)$", serve, {"document_root": settings.MEDIA_ROOT}),
+    re_path(r"^media/(?P<path>.*)$", serve_media, name="media"),
     path('ckeditor/', include('ckeditor_uploader.urls')),
     path("profile/<username>", views.profile_view, name="profile-view"),
     path('api/', include('posts.api.urls')),
@@ -55,6 +55,7 @@ urlpatterns = [
     path("api/auth/", include("djoser.urls.jwt")),
     path("api/auth/", include("djoser.urls.base")),
     path("history", views.ListHistoryView.as_view(), name='history'),
+    path("metrics", metrics_view, name="metrics"),
     re_path(r"^token/login/?$", TokenCreateView.as_view(), name="login-api"),
     re_path(r"^token/logout/?$", TokenDestroyView.as_view(), name="logout-api"),
 ]